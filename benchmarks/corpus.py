@@ -0,0 +1,130 @@
+"""
+Corpus of saved MAL news pages for the parser tests (tests/test_utils.py).
+
+    python -m benchmarks.corpus snapshot [--url URL] [--name NAME]
+    python -m benchmarks.corpus update
+    python -m benchmarks.corpus check
+
+Each page is kept as NAME.html.gz next to NAME.json, the articles `extract_news_articles`
+should find in it. `snapshot` fetches a page (MAL news by default) and saves both, so
+review the JSON before committing it. `update` rewrites every JSON with the current parser
+after an intended parser change (review the diff). `check` runs the parse health check and
+times every page.
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests", "fixtures", "mal")
+
+
+def corpus_pages(corpus_dir: str = CORPUS_DIR) -> List[str]:
+    """ Names of the saved pages. """
+    if not os.path.isdir(corpus_dir):
+        return []
+    return sorted(name[:-len(".html.gz")] for name in os.listdir(corpus_dir) if name.endswith(".html.gz"))
+
+
+def load_page(name: str, corpus_dir: str = CORPUS_DIR) -> Tuple[str, Optional[List[Dict]]]:
+    """ The page HTML and its expected articles (None if not recorded yet). """
+    with gzip.open(os.path.join(corpus_dir, f"{name}.html.gz"), "rt", encoding="utf-8") as f:
+        page = f.read()
+    expected_path = os.path.join(corpus_dir, f"{name}.json")
+    expected = None
+    if os.path.exists(expected_path):
+        with open(expected_path, encoding="utf-8") as f:
+            expected = json.load(f)
+    return page, expected
+
+
+def save_page(name: str, page: str, articles: Optional[List[Dict]] = None, corpus_dir: str = CORPUS_DIR) -> None:
+    os.makedirs(corpus_dir, exist_ok=True)
+    # mtime=0 keeps the file identical for identical pages
+    with open(os.path.join(corpus_dir, f"{name}.html.gz"), "wb") as f:
+        f.write(gzip.compress(page.encode("utf-8"), mtime=0))
+    if articles is not None:
+        save_expected(name, articles, corpus_dir)
+
+
+def save_expected(name: str, articles: List[Dict], corpus_dir: str = CORPUS_DIR) -> None:
+    with open(os.path.join(corpus_dir, f"{name}.json"), "w", encoding="utf-8") as f:
+        json.dump(articles, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+
+
+def snapshot(url: Optional[str], name: Optional[str]) -> int:
+    from config import config
+    from utils.helpers import extract_news_articles, fetch_news_page, check_articles
+
+    url = url or str(config.settings.mal_news_url)
+    page = fetch_news_page(url, retries=3, delay=5)
+    if not page:
+        print(f"Could not fetch {url}", file=sys.stderr)
+        return 1
+    name = name or f"mal_news_{datetime.utcnow():%Y%m%d_%H%M}"
+    articles = extract_news_articles(page)
+    save_page(name, page, articles)
+    print(f"Saved {name}: {len(articles)} articles")
+    for problem in check_articles(articles):
+        print(f"  health check: {problem}", file=sys.stderr)
+    return 0
+
+
+def update() -> int:
+    from utils.helpers import extract_news_articles
+
+    for name in corpus_pages():
+        page, expected = load_page(name)
+        articles = extract_news_articles(page)
+        if articles != expected:
+            save_expected(name, articles)
+            print(f"Updated {name}: {len(articles)} articles")
+    return 0
+
+
+def check() -> int:
+    from utils.helpers import extract_news_articles, check_articles
+
+    failed = 0
+    for name in corpus_pages():
+        page, expected = load_page(name)
+        started = time.perf_counter()
+        articles = extract_news_articles(page)
+        elapsed = time.perf_counter() - started
+        problems = check_articles(articles)
+        if expected is not None and articles != expected:
+            problems.append("output differs from the recorded articles")
+        status = "ok" if not problems else "; ".join(problems[:5])
+        print(f"{name}: {len(articles)} articles in {elapsed * 1000:.1f}ms, {status}")
+        failed += bool(problems)
+    return 1 if failed else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    snapshot_parser = commands.add_parser("snapshot", help="Fetch and save a page")
+    snapshot_parser.add_argument("--url")
+    snapshot_parser.add_argument("--name")
+    commands.add_parser("update", help="Re-record the expected articles with the current parser")
+    commands.add_parser("check", help="Health check and time every page")
+    args = parser.parse_args(argv)
+
+    from benchmarks.run import configure_environment
+    with tempfile.TemporaryDirectory(prefix="animenewsbot-corpus-") as workdir:
+        configure_environment(workdir)
+        if args.command == "snapshot":
+            return snapshot(args.url, args.name)
+        if args.command == "update":
+            return update()
+        return check()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,374 @@
+"""
+A local stand-in for the Telegram Bot API, for load tests, benchmarks and update replay.
+
+Point a bot at it with `BOT__BASE_URL=http://127.0.0.1:<port>/bot` (or
+`ExtBot(token, base_url=server.base_url)`). Answers follow Telegram:
+
+- sendMessage/sendPhoto/editMessageText... return Messages, sendMediaGroup a list of them,
+  getChat a ChatFullInfo, getChatMember a ChatMember, getUpdates the queued updates.
+- With `enforce_limits`, sends over the flood limits get a 429 with the `retry_after`
+  Telegram would give: `global_rate` messages/s overall, `chat_rate`/s per private chat
+  (bursts of `chat_burst`) and `group_rate` per minute per group or channel.
+- `error_rate` of the sends get a 429 with `retry_after` at random, on top of that.
+- Chats in `blocked` (or `blocked_ratio` of the private chats) get a 403, like users who
+  blocked the bot.
+
+Every call takes `latency` (+ random `jitter`) seconds. Pages registered in `pages` are
+served on GET, e.g. a MAL fixture for `fetch_news_page`.
+"""
+import asyncio
+import json
+import math
+import random
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+BOT_ID = 1
+
+# Methods that post to a chat, the ones Telegram flood limits
+SEND_METHODS = (
+    "sendMessage", "sendPhoto", "sendMediaGroup", "sendDocument", "sendVideo", "sendAnimation",
+    "copyMessage", "forwardMessage", "editMessageText", "editMessageCaption", "editMessageReplyMarkup",
+)
+
+
+class TelegramError(Exception):
+    def __init__(self, code: int, description: str, retry_after: Optional[int] = None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+
+
+class _Bucket:
+    """ Token bucket, `rate` tokens per second up to `capacity`. """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """ Takes a token, or returns how many seconds until one is available. """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class FakeTelegramServer:
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 retry_after: int = 1, host: str = "127.0.0.1", port: int = 0, seed: Optional[int] = None,
+                 enforce_limits: bool = False, global_rate: float = 30, chat_rate: float = 1,
+                 chat_burst: int = 3, group_rate: float = 20, blocked_ratio: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.host = host
+        self.port = port
+        self.enforce_limits = enforce_limits
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.blocked_ratio = blocked_ratio
+        self.seed = seed or 0
+
+        self.pages: Dict[str, str] = {}
+        self.blocked = set()
+        self.chat_info: Dict[int, Dict] = {}             # chat id -> extra getChat fields (title, username...)
+        self.members: Dict[Tuple[int, int], str] = {}   # (chat id, user id) -> status, see `_member_status`
+
+        self.requests: Counter = Counter()       # method -> requests
+        self.rate_limited: Counter = Counter()   # method -> 429s sent
+        self.forbidden: Counter = Counter()      # method -> 403s sent
+        self.chats = set()
+        self._rng = random.Random(seed)
+        self._message_id = 0
+        self._global_bucket = _Bucket(global_rate, global_rate)
+        self._chat_buckets: Dict[int, _Bucket] = {}
+        self._updates: List[Dict] = []
+        self._updates_added = asyncio.Event()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self) -> "FakeTelegramServer":
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self) -> None:
+        self._updates_added.set()  # Answer pending long polls
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def reset(self) -> None:
+        self.requests.clear()
+        self.rate_limited.clear()
+        self.forbidden.clear()
+        self.chats.clear()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    # --------------------------------------------
+    # Updates
+
+    def add_updates(self, updates: List[Dict]) -> None:
+        """ Queues updates for getUpdates. Missing update_ids are numbered after the last one. """
+        next_id = self._updates[-1]["update_id"] + 1 if self._updates else 1
+        for update in updates:
+            if "update_id" not in update:
+                update = dict(update, update_id=next_id)
+            next_id = update["update_id"] + 1
+            self._updates.append(update)
+        self._updates_added.set()
+
+    @property
+    def pending_updates(self) -> int:
+        return len(self._updates)
+
+    async def _get_updates(self, params: Dict) -> List[Dict]:
+        offset = int(params.get("offset", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        timeout = float(params.get("timeout", 0) or 0)
+        # Like Telegram, asking for an offset confirms the updates before it
+        if offset:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._updates_added.clear()
+            try:
+                await asyncio.wait_for(self._updates_added.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    # --------------------------------------------
+    # HTTP
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Keep-alive: the bot's connection pool reuses connections
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, content_type, payload = await self._respond(method, path, headers, body)
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, path, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        return method, path, headers, body
+
+    @staticmethod
+    def _parse_params(headers: Dict[str, str], body: bytes) -> Dict[str, str]:
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            return dict(parse_qsl(body.decode("utf-8")))
+        if content_type.startswith("multipart/form-data"):
+            # Only the plain fields matter here, uploaded files are ignored
+            boundary = content_type.split("boundary=")[-1].encode()
+            params = {}
+            for part in body.split(b"--" + boundary):
+                head, _, value = part.partition(b"\r\n\r\n")
+                if b"filename=" in head or b'name="' not in head:
+                    continue
+                name = head.split(b'name="')[1].split(b'"')[0].decode()
+                params[name] = value.rstrip(b"\r\n").decode("utf-8", "replace")
+            return params
+        return {}
+
+    async def _respond(self, http_method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[str, str, bytes]:
+        if http_method == "GET" and path in self.pages:
+            return "200 OK", "text/html; charset=utf-8", self.pages[path].encode("utf-8")
+        if not path.startswith("/bot") or "/" not in path[4:]:
+            return "404 Not Found", "text/plain", b"Not found"
+
+        api_method = path.rsplit("/", 1)[1]
+        params = self._parse_params(headers, body)
+        self.requests[api_method] += 1
+
+        if api_method == "getUpdates":
+            return self._json("200 OK", {"ok": True, "result": await self._get_updates(params)})
+
+        delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        try:
+            result = self._call(api_method, params)
+        except TelegramError as e:
+            error = {"ok": False, "error_code": e.code, "description": e.description}
+            if e.retry_after is not None:
+                error["parameters"] = {"retry_after": e.retry_after}
+            return self._json(f"{e.code} Error", error)
+        return self._json("200 OK", {"ok": True, "result": result})
+
+    @staticmethod
+    def _json(status: str, data) -> Tuple[str, str, bytes]:
+        return status, "application/json", json.dumps(data).encode("utf-8")
+
+    # --------------------------------------------
+    # Bot API semantics
+
+    def is_blocked(self, chat_id: int) -> bool:
+        if chat_id in self.blocked:
+            return True
+        # Same answer for a chat on every call
+        return chat_id > 0 and bool(self.blocked_ratio) and random.Random(chat_id * 7919 + self.seed).random() < self.blocked_ratio
+
+    def _check_limits(self, api_method: str, chat_id: int) -> None:
+        if self.error_rate and self._rng.random() < self.error_rate:
+            self.rate_limited[api_method] += 1
+            raise TelegramError(429, f"Too Many Requests: retry after {self.retry_after}", self.retry_after)
+        if not self.enforce_limits:
+            return
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if chat_id > 0:
+                bucket = _Bucket(self.chat_rate, self.chat_burst)
+            else:
+                bucket = _Bucket(self.group_rate / 60, self.group_rate)
+            self._chat_buckets[chat_id] = bucket
+        wait = max(bucket.take(), self._global_bucket.take())
+        if wait:
+            self.rate_limited[api_method] += 1
+            retry_after = max(1, math.ceil(wait))
+            raise TelegramError(429, f"Too Many Requests: retry after {retry_after}", retry_after)
+
+    def _chat(self, chat_id: int) -> Dict:
+        chat = {"id": chat_id, "type": "private" if chat_id > 0 else "channel"}
+        if chat_id > 0:
+            chat["first_name"] = f"User {chat_id}"
+        else:
+            chat["title"] = f"Channel {chat_id}"
+        chat.update(self.chat_info.get(chat_id, {}))
+        return chat
+
+    def _resolve_chat_id(self, value) -> int:
+        """ A chat id or an @username registered in `chat_info`. """
+        if isinstance(value, str) and value.startswith("@"):
+            for chat_id, info in self.chat_info.items():
+                if info.get("username") == value[1:]:
+                    return chat_id
+            raise TelegramError(400, "Bad Request: chat not found")
+        return int(value)
+
+    def _message(self, chat_id: int, params: Dict, **fields) -> Dict:
+        self._message_id += 1
+        message = {
+            "message_id": int(params.get("message_id", self._message_id)),
+            "date": int(time.time()),
+            "chat": self._chat(chat_id),
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"},
+        }
+        for name in ("text", "caption"):
+            if name in params:
+                message[name] = params[name]
+        message.update(fields)
+        return message
+
+    def _member_status(self, chat_id: int, user_id: int) -> str:
+        """ The bot is an admin of every channel and users own them, unless set in `members`. """
+        if (chat_id, user_id) in self.members:
+            return self.members[(chat_id, user_id)]
+        if chat_id < 0:
+            return "administrator" if user_id == BOT_ID else "creator"
+        return "member"
+
+    def _chat_member(self, chat_id: int, user_id: int) -> Dict:
+        status = self._member_status(chat_id, user_id)
+        member = {"status": status, "user": {"id": user_id, "is_bot": user_id == BOT_ID, "first_name": f"User {user_id}"}}
+        if status == "creator":
+            member["is_anonymous"] = False
+        elif status == "administrator":
+            member.update({
+                "can_be_edited": False, "is_anonymous": False, "can_manage_chat": True,
+                "can_delete_messages": True, "can_manage_video_chats": True, "can_restrict_members": True,
+                "can_promote_members": False, "can_change_info": True, "can_invite_users": True,
+                "can_post_stories": True, "can_edit_stories": True, "can_delete_stories": True,
+                "can_post_messages": True, "can_edit_messages": True,
+            })
+        elif status == "kicked":
+            member["until_date"] = 0
+        return member
+
+    def _call(self, api_method: str, params: Dict):
+        if api_method == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": True}
+
+        if api_method == "getChat":
+            chat_id = self._resolve_chat_id(params.get("chat_id"))
+            return dict(self._chat(chat_id), accent_color_id=0, max_reaction_count=11)
+
+        if api_method == "getChatMember":
+            chat_id = self._resolve_chat_id(params.get("chat_id"))
+            return self._chat_member(chat_id, int(params.get("user_id")))
+
+        if api_method not in SEND_METHODS:
+            # answerCallbackQuery, sendChatAction, deleteMessage, setMyCommands...
+            return True
+
+        chat_id = self._resolve_chat_id(params.get("chat_id", 0)) if "chat_id" in params else 0
+        if not chat_id:
+            # Inline message edits return True
+            return True
+        if self.is_blocked(chat_id):
+            self.forbidden[api_method] += 1
+            raise TelegramError(403, "Forbidden: bot was blocked by the user")
+        self._check_limits(api_method, chat_id)
+        self.chats.add(chat_id)
+
+        if api_method == "sendMediaGroup":
+            group_id = f"group{self._message_id + 1}"
+            messages = []
+            for item in json.loads(params.get("media", "[]")):
+                fields = {"media_group_id": group_id}
+                if item.get("caption"):
+                    fields["caption"] = item["caption"]
+                messages.append(self._message(chat_id, {}, **fields))
+            return messages
+        if api_method == "sendPhoto":
+            return self._message(chat_id, params, photo=[{
+                "file_id": f"photo{self._message_id}", "file_unique_id": f"u{self._message_id}", "width": 320, "height": 480,
+            }])
+        return self._message(chat_id, params)
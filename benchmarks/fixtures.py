@@ -0,0 +1,134 @@
+"""
+MAL news pages and Telegram updates for the benchmarks.
+
+Saved pages (`--html`) are used as they are. Otherwise pages are generated with the
+same markup `extract_news_articles` parses on myanimelist.net/news.
+"""
+import random
+import time
+from typing import List
+
+TITLE_WORDS = (
+    "Anime", "Season", "Movie", "Manga", "Announced", "Trailer", "Cast", "Staff", "Premiere",
+    "Sequel", "Visual", "Reveals", "Final", "Arc", "Studio", "Adaptation", "Delayed", "Spring",
+)
+
+# MAL news categories, /news/tag/<slug>
+TAGS = ("new_anime", "manga", "industry", "live_action", "music", "events", "people", "games")
+
+
+def _sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(TITLE_WORDS) for _ in range(words))
+
+
+def news_unit(article_id: int, rng: random.Random) -> str:
+    """ One article block as it appears on the news page. """
+    image_id = rng.randint(100000, 999999)
+    tags = " ".join(f'<a href="https://myanimelist.net/news/tag/{tag}" class="tag">{tag.replace("_", " ").title()}</a>'
+                    for tag in rng.sample(TAGS, rng.randint(1, 3)))
+    return f"""
+<div class="news-unit clearfix rect">
+  <a href="https://myanimelist.net/news/{article_id}" class="image-link">
+    <img src="https://cdn.myanimelist.net/r/100x156/s/common/uploaded_files/{image_id}.jpg?s=abc" class="image" alt="">
+  </a>
+  <div class="news-unit-right">
+    <p class="title"><a href="https://myanimelist.net/news/{article_id}">{_sentence(rng, 8)}</a></p>
+    <div class="text">{_sentence(rng, 40)} ...</div>
+    <div class="information">
+      <p class="info di-ib">Oct {rng.randint(1, 28)}, {rng.randint(1, 12)}:{rng.randint(10, 59)} AM by <a href="https://myanimelist.net/profile/staff">staff</a></p>
+    </div>
+    <div class="tags">{tags}</div>
+  </div>
+</div>"""
+
+
+def news_page(articles: int = 20, first_id: int = 70000000, seed: int = 0) -> str:
+    """ A news page with `articles` articles, ids counting down from `first_id` like MAL. """
+    rng = random.Random(seed)
+    units = "".join(news_unit(first_id - i, rng) for i in range(articles))
+    return f"""<!DOCTYPE html>
+<html><head><title>Anime News - MyAnimeList.net</title></head>
+<body><div id="contentWrapper"><div class="news-list mt16 mr8">{units}
+</div></div></body></html>"""
+
+
+def news_pages(pages: int, articles: int = 20, seed: int = 0) -> List[str]:
+    """ `pages` pages without overlapping articles, as consecutive fetches of a busy feed would see. """
+    return [news_page(articles, first_id=70000000 - page * articles, seed=seed + page) for page in range(pages)]
+
+
+def load_pages(paths: List[str]) -> List[str]:
+    pages = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            pages.append(f.read())
+    return pages
+
+
+# --------------------------------------------
+# Updates
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}", "language_code": "en"}
+
+
+def message_update(user_id: int, text: str, message_id: int, date: int) -> dict:
+    """ A private text message (or /command) from `user_id`, as getUpdates returns it. """
+    message = {
+        "message_id": message_id,
+        "from": _user(user_id),
+        "chat": {"id": user_id, "type": "private", "first_name": f"User {user_id}", "username": f"user{user_id}"},
+        "date": date,
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"message": message}
+
+
+def callback_update(user_id: int, data: str, message_id: int, date: int) -> dict:
+    """ A button press on the bot's message `message_id` in the user's chat. """
+    return {"callback_query": {
+        "id": f"{user_id}{message_id}{len(data)}",
+        "from": _user(user_id),
+        "chat_instance": str(user_id),
+        "data": data,
+        "message": {
+            "message_id": message_id,
+            "from": {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"},
+            "chat": {"id": user_id, "type": "private", "first_name": f"User {user_id}"},
+            "date": date,
+            "text": "Latest News",
+        },
+    }}
+
+
+# A user's session: commands, the /latest menu and the feedback conversation
+USER_FLOW = (
+    ("message", "/start"),
+    ("message", "/help"),
+    ("message", "/subscribe"),
+    ("message", "/latest"),
+    ("callback", "news_page_2"),
+    ("callback", "cancel"),
+    ("message", "/feedback"),
+    ("message", "Love the bot, thanks!"),
+    ("message", "/unsubscribe"),
+)
+
+
+def synthetic_updates(users: int, first_user_id: int = 100000) -> List[dict]:
+    """
+    `USER_FLOW` for `users` users, interleaved step by step so that many conversations
+    are open at the same time. update_ids are left to the server.
+    """
+    now = int(time.time())
+    updates = []
+    for step, (kind, payload) in enumerate(USER_FLOW):
+        for n in range(users):
+            user_id = first_user_id + n
+            if kind == "message":
+                updates.append(message_update(user_id, payload, message_id=step + 1, date=now))
+            else:
+                updates.append(callback_update(user_id, payload, message_id=step, date=now))
+    return updates
@@ -0,0 +1,163 @@
+"""
+Replays an update stream into the bot's Application against the fake Bot API.
+
+    python -m benchmarks.replay updates.jsonl
+    python -m benchmarks.replay --users 2000 --rate 1000 --enforce-limits
+
+Updates are either recorded ones (one Update JSON per line, as getUpdates returns them,
+e.g. `curl .../getUpdates | jq -c '.result[]'`) or `fixtures.USER_FLOW` for `--users`
+synthetic users. The Application comes from `main.build_application`, so every handler
+and conversation runs as in production. By default the updates go through getUpdates
+polling, `--direct` puts them straight on the update queue instead.
+
+Prints the updates/s and per command latency percentiles (from the tracing spans) as JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from benchmarks.fake_telegram import FakeTelegramServer
+from benchmarks.run import configure_environment
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("updates", nargs="?", help="Recorded updates, one JSON object per line")
+    parser.add_argument("--users", type=int, default=1000, help="Synthetic users if no file is given")
+    parser.add_argument("--rate", type=float, default=0, help="Updates fed per second, 0 for all at once")
+    parser.add_argument("--direct", action="store_true", help="Skip getUpdates, put updates on the queue")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--enforce-limits", action="store_true", help="429 sends over Telegram's flood limits")
+    parser.add_argument("--blocked-ratio", type=float, default=0.0, help="Share of users that blocked the bot (403)")
+    parser.add_argument("--rate-limit", type=int, default=0, help="Overall requests/s of the bot's rate limiter, 0 for none")
+    parser.add_argument("--database-url")
+    parser.add_argument("--timeout", type=float, default=600, help="Give up after this many seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    return parser.parse_args(argv)
+
+
+def load_updates(path: str) -> List[Dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def feed(updates: List[Dict], rate: float, deliver) -> None:
+    """ Calls `deliver` with the updates, `rate` per second (in batches of up to 100). """
+    if not rate:
+        deliver(updates)
+        return
+    started = time.perf_counter()
+    batch = max(1, min(100, int(rate // 100) or 1))
+    for i in range(0, len(updates), batch):
+        delay = started + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        deliver(updates[i:i + batch])
+
+
+async def replay(args: argparse.Namespace, workdir: str) -> Dict:
+    server = FakeTelegramServer(
+        args.latency, args.jitter, args.error_rate, seed=args.seed,
+        enforce_limits=args.enforce_limits, blocked_ratio=args.blocked_ratio,
+    )
+    await server.start()
+    configure_environment(workdir, args.database_url, args.rate_limit, base_url=server.base_url)
+
+    from benchmarks import fixtures
+    updates = load_updates(args.updates) if args.updates else fixtures.synthetic_updates(args.users)
+    for update_id, update in enumerate(updates, start=1):
+        update.setdefault("update_id", update_id)
+    os.environ["TRACING__BUFFER_SIZE"] = str(max(2000, len(updates)))
+
+    # Project imports only now that the environment points at the fake API
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    import main
+    from models.database import SessionLocal
+    from models.news import NewsCache
+    from utils.helpers import extract_news_articles
+    from utils.metrics import ERRORS
+    from utils.tracing import command_percentiles
+
+    main.init_db()
+    with SessionLocal() as session:
+        NewsCache.cache_articles(session, extract_news_articles(fixtures.news_page(40, seed=args.seed)))
+
+    app = main.build_application()
+    processed = 0
+    finished = asyncio.Event()
+
+    async def count(update, context) -> None:
+        nonlocal processed
+        processed += 1
+        if processed >= len(updates):
+            finished.set()
+
+    # Own group, so it sees every update after the real handlers
+    app.add_handler(TypeHandler(Update, count), group=1000)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    if args.direct:
+        deliver = lambda batch: [app.update_queue.put_nowait(Update.de_json(u, app.bot)) for u in batch]
+    else:
+        deliver = server.add_updates
+        await app.updater.start_polling(poll_interval=0.0, timeout=1, allowed_updates=Update.ALL_TYPES)
+
+    server.reset()
+    started = time.perf_counter()
+    try:
+        await feed(updates, args.rate, deliver)
+        await asyncio.wait_for(finished.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    seconds = time.perf_counter() - started
+
+    if app.updater.running:
+        await app.updater.stop()
+    await app.stop()
+    await app.post_shutdown(app)
+    await app.shutdown()
+    await server.stop()
+
+    latency = {
+        name: {key: round(value * 1000, 3) if key not in ("count", "errors") else value for key, value in stats.items()}
+        for name, stats in command_percentiles().items()
+    }
+    return {
+        "updates": len(updates),
+        "processed": processed,
+        "seconds": round(seconds, 4),
+        "throughput": round(processed / seconds, 2) if seconds else 0.0,
+        "mode": "direct" if args.direct else "getUpdates",
+        "latency_ms": latency,
+        "handler_errors": ERRORS.value(),
+        "api_requests": dict(server.requests),
+        "rate_limited": dict(server.rate_limited),
+        "forbidden": dict(server.forbidden),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="animenewsbot-replay-") as workdir:
+        result = asyncio.run(replay(args, workdir))
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+    return 0 if result["processed"] == result["updates"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
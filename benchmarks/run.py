@@ -0,0 +1,179 @@
+"""
+Offline benchmark of the ingest-and-deliver pipeline.
+
+    python -m benchmarks.run --populations 1000 10000 100000 --output results.json
+    python -m benchmarks.run --compare baseline.json
+
+Parses MAL pages, caches the articles in SQLite, then sends news and a broadcast to
+synthetic user/channel populations through a local fake Bot API. Prints (and saves)
+the throughput, latency percentiles and peak memory of each stage as JSON. With
+`--compare`, exits with 1 if a stage got slower than the baseline by more than `--tolerance`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", default=["parse", "cache", "articles", "search", "fanout", "broadcast"],
+                        choices=["parse", "cache", "articles", "search", "fanout", "broadcast"])
+    parser.add_argument("--populations", nargs="+", type=int, default=[1000, 10000],
+                        help="Number of users of each run of fanout/broadcast, e.g. 1000 10000 100000")
+    parser.add_argument("--channels-per-1000", type=int, default=10, help="Channels per 1000 users")
+    parser.add_argument("--subscribed-ratio", type=float, default=0.8)
+    parser.add_argument("--html", nargs="*", default=[], help="Saved MAL news pages, generated if none")
+    parser.add_argument("--pages", type=int, default=20, help="Pages to generate")
+    parser.add_argument("--articles-per-page", type=int, default=20)
+    parser.add_argument("--parse-repeat", type=int, default=5)
+    parser.add_argument("--article-rows", type=int, default=3000, help="Cached articles loaded by the articles scenario")
+    parser.add_argument("--archive-rows", type=int, default=200000, help="Archived articles searched by the search scenario")
+    parser.add_argument("--new-articles", type=int, default=2, help="New articles sent in the fanout")
+    parser.add_argument("--latency", type=float, default=0.0, help="Fake API latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra latency up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of API calls answered with a 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after of the injected 429s")
+    parser.add_argument("--rate", type=int, default=0,
+                        help="Overall requests/s of the rate limiter, 0 to effectively disable it")
+    parser.add_argument("--database-url", help="Defaults to a SQLite file in a temporary directory")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="Skip peak memory tracking (faster)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--compare", help="Baseline report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed throughput drop vs the baseline")
+    return parser.parse_args(argv)
+
+
+def configure_environment(workdir: str, database_url: Optional[str] = None, rate: int = 0,
+                          base_url: Optional[str] = None) -> None:
+    """
+    `config` is built from the environment on import, so this runs before any project import.
+    `rate` is the overall requests/s of the rate limiter, 0 to effectively disable it.
+    """
+    os.environ.setdefault("BOT__TOKEN", "123456:benchmark")
+    os.environ.setdefault("BOT__OWNER_ID", "1")
+    os.environ.setdefault("BOT__USERNAME", "benchmark_bot")
+    os.environ.setdefault("BOT__LOG_CHANNEL_ID", "-1009999999999")
+    if base_url:
+        os.environ["BOT__BASE_URL"] = base_url
+    os.environ["DATABASE__URL"] = database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["DATABASE__ECHO"] = "false"
+    os.environ["SETTINGS__DEBUG"] = "false"
+    os.environ["SETTINGS__OVERALL_MAX_RATE"] = str(rate or 1_000_000)
+    os.environ["SETTINGS__GROUP_MAX_RATE"] = str(20 if rate else 1_000_000)
+    os.environ["RATE_LIMIT__BACKEND"] = "memory"
+    os.environ["DELIVERY__USE_WORKERS"] = "false"
+    os.environ["TRACING__OTLP_ENDPOINT"] = ""
+    os.environ["METRICS__ENABLED"] = "false"
+    os.environ["WATCHDOG__ENABLED"] = "false"
+    os.environ["LOGGING__LOG_TO_CONSOLE"] = "false"
+    os.environ["PATHS__LOG_PATH"] = os.path.join(workdir, "logs")
+    if PROJECT_DIR not in sys.path:
+        sys.path.insert(0, PROJECT_DIR)
+
+
+async def run(args: argparse.Namespace) -> List[Dict]:
+    from benchmarks import fixtures, scenarios
+    from benchmarks.fake_telegram import FakeTelegramServer
+
+    pages = fixtures.load_pages(args.html) if args.html else fixtures.news_pages(args.pages, args.articles_per_page, args.seed)
+    results = []
+
+    def record(result) -> None:
+        results.append(result.to_dict())
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    scenarios.reset_database()
+    if "parse" in args.scenarios:
+        record(scenarios.bench_parse(pages, args.parse_repeat))
+    if "cache" in args.scenarios:
+        for result in scenarios.bench_cache(pages):
+            record(result)
+    if "articles" in args.scenarios:
+        for result in scenarios.bench_articles(args.article_rows):
+            record(result)
+    if "search" in args.scenarios:
+        for result in scenarios.bench_search(args.archive_rows):
+            record(result)
+
+    if not {"fanout", "broadcast"} & set(args.scenarios):
+        return results
+    news = [scenarios.Article.from_dict(article) for article in scenarios.extract_news_articles(pages[0])[:args.new_articles]]
+    async with FakeTelegramServer(args.latency, args.jitter, args.error_rate, args.retry_after, seed=args.seed) as server:
+        for population in args.populations:
+            channels = population * args.channels_per_1000 // 1000
+            with scenarios._Measure() as m:
+                scenarios.populate(population, channels, args.subscribed_ratio, args.seed)
+            record(scenarios.Result("populate", population + channels, m.seconds, population=population,
+                                    peak_memory_mb=m.peak_mb))
+            if "fanout" in args.scenarios:
+                for result in await scenarios.bench_fanout(server, news, population):
+                    record(result)
+            if "broadcast" in args.scenarios:
+                record(await scenarios.bench_broadcast(server, population))
+    return results
+
+
+def compare(results: List[Dict], baseline_path: str, tolerance: float) -> List[str]:
+    """ Stages whose throughput dropped by more than `tolerance` compared to the baseline. """
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["scenario"], r["population"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        before = baseline.get((result["scenario"], result["population"]))
+        if not before or not before["throughput"]:
+            continue
+        change = result["throughput"] / before["throughput"] - 1
+        if change < -tolerance:
+            regressions.append(
+                f"{result['scenario']} (population {result['population']}): "
+                f"{before['throughput']:.1f} -> {result['throughput']:.1f}/s ({change:+.0%})"
+            )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="animenewsbot-bench-") as workdir:
+        configure_environment(workdir, args.database_url, args.rate)
+        if not args.no_tracemalloc:
+            tracemalloc.start()
+        started = time.time()
+        results = asyncio.run(run(args))
+        tracemalloc.stop()
+
+    report = {
+        "meta": {
+            "started": started,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "tracemalloc": not args.no_tracemalloc,
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,316 @@
+"""
+The benchmarked stages of the pipeline. Imported by benchmarks/run.py once the
+environment (database, rate limits, log path) is set up, since `config` is read on import.
+"""
+import itertools
+import random
+import time
+import tracemalloc
+from dataclasses import dataclass, field, asdict
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from sqlalchemy import insert, select
+from telegram.constants import ParseMode
+from telegram.ext import Defaults, ExtBot
+from telegram.request import HTTPXRequest
+
+from config import config
+from handlers.command_handlers import broadcast, get_news_chat_ids, send_news_to_subscribers
+from models.database import Base, SessionLocal, db
+from models.news import Article, NewsArchive, NewsCache
+from models.user import Channel, User, UserSettings
+from utils.helpers import extract_news_articles
+from utils.rate_limiter import build_rate_limiter
+
+from benchmarks.fake_telegram import FakeTelegramServer
+
+# Channel ids look like -100xxxxxxxxxx
+CHANNEL_ID_BASE = -1000000000000
+
+
+@dataclass
+class Result:
+    scenario: str
+    items: int
+    seconds: float
+    population: Optional[int] = None
+    latency_ms: Dict[str, float] = field(default_factory=dict)
+    peak_memory_mb: float = 0.0
+    extra: Dict = field(default_factory=dict)
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.seconds if self.seconds else 0.0
+
+    def to_dict(self) -> Dict:
+        return dict(asdict(self), throughput=round(self.throughput, 2), seconds=round(self.seconds, 4))
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """ p50/p95/p99/max of durations in seconds, as milliseconds. """
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    pick = lambda pct: ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+    return {
+        "p50": round(pick(50) * 1000, 3),
+        "p95": round(pick(95) * 1000, 3),
+        "p99": round(pick(99) * 1000, 3),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+class _Measure:
+    """ Wall time and peak traced memory of a block. """
+
+    def __enter__(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.started
+        self.peak_mb = tracemalloc.get_traced_memory()[1] / 2**20 if tracemalloc.is_tracing() else 0.0
+        return False
+
+
+class TimedRequest(HTTPXRequest):
+    """ HTTPXRequest recording how long each Bot API call took. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.durations: List[float] = []
+
+    async def do_request(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(*args, **kwargs)
+        finally:
+            self.durations.append(time.perf_counter() - started)
+
+
+# --------------------------------------------
+# Ingest
+
+def bench_parse(pages: List[str], repeat: int = 1) -> Result:
+    durations = []
+    articles = 0
+    with _Measure() as m:
+        for _ in range(repeat):
+            for page in pages:
+                started = time.perf_counter()
+                articles += len(extract_news_articles(page))
+                durations.append(time.perf_counter() - started)
+    return Result("parse", articles, m.seconds, latency_ms=percentiles(durations),
+                  peak_memory_mb=m.peak_mb, extra={"pages": len(pages) * repeat})
+
+
+def bench_cache(pages: List[str]) -> List[Result]:
+    """ Caches every page twice: first all articles are new, then all are duplicates. """
+    batches = [extract_news_articles(page) for page in pages]
+    results = []
+    for name in ("cache_new", "cache_duplicate"):
+        durations = []
+        with _Measure() as m, SessionLocal() as session:
+            for articles in batches:
+                started = time.perf_counter()
+                NewsCache.cache_articles(session, articles)
+                durations.append(time.perf_counter() - started)
+        results.append(Result(name, sum(len(b) for b in batches), m.seconds,
+                              latency_ms=percentiles(durations), peak_memory_mb=m.peak_mb))
+    return results
+
+
+def bench_articles(rows: int, repeat: int = 5) -> List[Result]:
+    """
+    Loads `rows` cached articles as ORM `NewsCache` instances, as before, and as `Article`s
+    from a Core select like `NewsCache.get_latest`. `held_mb` is the memory they (and the
+    session) hold once loaded, 0 without tracemalloc.
+    """
+    reset_database()
+    with SessionLocal() as session:
+        session.execute(insert(NewsCache), [
+            {"id": NewsCache.generate_id(f"https://myanimelist.net/news/{i}"), "title": f"Article {i} " * 6,
+             "summary": f"Summary of article {i} " * 12, "link": f"https://myanimelist.net/news/{i}",
+             "date": "Oct 1, 10:00 AM", "image_url": f"https://cdn.myanimelist.net/s/common/uploaded_files/{i}.jpg"}
+            for i in range(rows)
+        ])
+        session.commit()
+
+    loaders = {
+        "articles_orm": lambda session: session.execute(
+            select(NewsCache).order_by(NewsCache.created_at.desc()).limit(rows)).scalars().all(),
+        "articles_core": lambda session: NewsCache.get_latest(session, rows),
+    }
+    results = []
+    for name, load in loaders.items():
+        durations = []
+        peak = held = 0.0
+        for _ in range(repeat):
+            with SessionLocal() as session:
+                before = tracemalloc.get_traced_memory()[0]
+                with _Measure() as m:
+                    loaded = load(session)
+                held = max(held, (tracemalloc.get_traced_memory()[0] - before) / 2**20)
+            durations.append(m.seconds)
+            peak = max(peak, m.peak_mb)
+            assert len(loaded) == rows
+            del loaded
+        results.append(Result(name, rows * repeat, sum(durations), latency_ms=percentiles(durations),
+                              peak_memory_mb=peak, extra={"rows": rows, "held_mb": round(held, 3)}))
+    return results
+
+
+SEARCH_WORDS = (
+    "anime", "manga", "season", "movie", "trailer", "announced", "episode", "cast", "studio", "visual",
+    "release", "date", "sequel", "adaptation", "novel", "light", "game", "staff", "opening", "theme",
+    "premiere", "delayed", "finale", "stage", "play", "collaboration", "event", "streaming", "netflix", "crunchyroll",
+    "piece", "one", "attack", "titan", "jujutsu", "kaisen", "spy", "family", "chainsaw", "man",
+)
+SEARCH_QUERIES = ("anime", "one piece", "movie trailer", "jujutsu kaisen season", "chain", "crunchy stream", "netflix finale date")
+
+
+def bench_search(rows: int, repeat: int = 20) -> List[Result]:
+    """
+    Fills the archive with `rows` articles (FTS5 index kept in sync by the triggers) and
+    times `NewsArchive.search` for common, rare, multi-word and prefix queries.
+    """
+    rng = random.Random(0)
+    # Zipf-like word frequencies: the anime words are the most common ones, like in real news
+    vocabulary = list(SEARCH_WORDS) + [f"word{i}" for i in range(20000)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 10) for rank in range(len(vocabulary))))
+    reset_database()
+    with _Measure() as m:
+        with SessionLocal() as session:
+            for start in range(0, rows, 10000):
+                session.execute(insert(NewsArchive), [
+                    {"article_id": NewsCache.generate_id(f"https://myanimelist.net/news/{i}"),
+                     "title": " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=8)).title(),
+                     "summary": " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=40)),
+                     "link": f"https://myanimelist.net/news/{i}", "date": "Oct 1, 10:00 AM"}
+                    for i in range(start, min(start + 10000, rows))
+                ])
+            session.commit()
+    results = [Result("search_index", rows, m.seconds, peak_memory_mb=m.peak_mb, extra={"rows": rows})]
+
+    durations = []
+    with SessionLocal() as session:
+        for _ in range(repeat):
+            for query in SEARCH_QUERIES:
+                started = time.perf_counter()
+                NewsArchive.search(session, query, limit=11, offset=0)
+                durations.append(time.perf_counter() - started)
+    results.append(Result("search_query", len(durations), sum(durations), latency_ms=percentiles(durations),
+                          extra={"rows": rows}))
+    return results
+
+
+# --------------------------------------------
+# Populations
+
+def reset_database() -> None:
+    Base.metadata.drop_all(db)
+    Base.metadata.create_all(db)
+
+
+def populate(users: int, channels: int, subscribed_ratio: float = 0.8, seed: int = 0) -> Dict[str, int]:
+    """
+    Fresh database with `users` users, `subscribed_ratio` of them subscribed, and `channels`
+    channels each added by a different user opted in for channel updates.
+    """
+    rng = random.Random(seed)
+    reset_database()
+    owners = set(rng.sample(range(1, users + 1), min(channels, users)))
+    with SessionLocal() as session:
+        session.execute(insert(User), [
+            {"id": i, "chat_id": i, "first_name": f"User {i}", "username": f"user{i}", "language_code": "en"}
+            for i in range(1, users + 1)
+        ])
+        session.execute(insert(UserSettings), [
+            {"user_id": i, "is_subscribed": rng.random() < subscribed_ratio, "opted_for_channel_updates": i in owners}
+            for i in range(1, users + 1)
+        ])
+        session.execute(insert(Channel), [
+            {"id": CHANNEL_ID_BASE - n, "name": f"Channel {n}", "username": f"channel{n}", "added_by": owner}
+            for n, owner in enumerate(sorted(owners))
+        ])
+        session.commit()
+    return {"users": users, "channels": len(owners)}
+
+
+# --------------------------------------------
+# Delivery
+
+async def make_bot(server: FakeTelegramServer) -> ExtBot:
+    """ A bot with the production rate limiter and defaults, talking to the fake API. """
+    bot = ExtBot(
+        config.bot.token,
+        base_url=server.base_url,
+        request=TimedRequest(connection_pool_size=8),
+        defaults=Defaults(parse_mode=ParseMode.HTML),
+        rate_limiter=build_rate_limiter(),
+    )
+    await bot.initialize()
+    return bot
+
+
+def _api_extra(server: FakeTelegramServer) -> Dict:
+    return {
+        "api_requests": dict(server.requests),
+        "rate_limited": dict(server.rate_limited),
+        "chats_reached": len(server.chats),
+    }
+
+
+async def bench_fanout(server: FakeTelegramServer, news: List[Dict], population: int) -> List[Result]:
+    """ Looks up the recipients like the news job, then sends them `news`. """
+    bot = await make_bot(server)
+    context = SimpleNamespace(bot=bot, bot_data={})
+    try:
+        with _Measure() as lookup, SessionLocal() as session:
+            chat_ids = get_news_chat_ids(session)
+        results = [Result("recipients", len(chat_ids), lookup.seconds, population=population,
+                          peak_memory_mb=lookup.peak_mb)]
+
+        server.reset()
+        bot.request.durations.clear()
+        with _Measure() as m:
+            await send_news_to_subscribers(news, chat_ids, context)
+        sends = len(bot.request.durations)
+        results.append(Result("send_news", sends, m.seconds, population=population,
+                              latency_ms=percentiles(bot.request.durations), peak_memory_mb=m.peak_mb,
+                              extra=dict(_api_extra(server), articles=len(news))))
+        return results
+    finally:
+        await bot.shutdown()
+
+
+async def bench_broadcast(server: FakeTelegramServer, population: int, text: str = "Benchmark broadcast") -> Result:
+    """ Runs /skfj_broadcast as the owner. """
+    bot = await make_bot(server)
+    replies = []
+
+    async def reply_text(text, *args, **kwargs):
+        replies.append(text)
+
+    owner = SimpleNamespace(id=config.bot.owner_id)
+    update = SimpleNamespace(
+        effective_user=owner,
+        effective_chat=owner,
+        message=SimpleNamespace(reply_text=reply_text),
+    )
+    context = SimpleNamespace(bot=bot, bot_data={}, args=text.split())
+    try:
+        server.reset()
+        bot.request.durations.clear()
+        with _Measure() as m:
+            await broadcast(update, context)
+        sends = len(bot.request.durations)
+        return Result("broadcast", sends, m.seconds, population=population,
+                      latency_ms=percentiles(bot.request.durations), peak_memory_mb=m.peak_mb,
+                      extra=dict(_api_extra(server), reply=replies[-1] if replies else None))
+    finally:
+        await bot.shutdown()
+
@@ -1,5 +1,5 @@
 from datetime import timedelta
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pydantic import BaseModel, Field, HttpUrl
 from pydantic_settings import BaseSettings, SettingsConfigDict
 import os
@@ -11,9 +11,14 @@ class BotConfig(BaseModel):
     username: str
     log_channel_id: Optional[int]
     timeout: int = 300
+    base_url: str = "https://api.telegram.org/bot"  # Point at a local Bot API (or benchmarks/fake_telegram.py)
 
 class DatabaseConfig(BaseModel):
     url: str
+    echo: bool = False              # Log every SQL statement (very noisy)
+    write_behind: bool = False      # Group commit registrations and settings changes (see utils/write_behind.py)
+    write_behind_interval: float = 0.2  # Seconds between group commits
+    write_behind_max_batch: int = 500   # Commit earlier once this many writes are waiting
 
 class PathsConfig(BaseModel):
     """Configuration for file paths."""
@@ -38,6 +43,14 @@ class LoggingConfig(BaseModel):
         "apscheduler",
         "urllib3",
     ])
+    async_logging: bool = True      # Write log files from a background thread instead of the event loop
+    json_format: bool = False       # One JSON object per line in the log files
+    queue_size: int = 10000         # Records waiting for the writer thread, extra records are dropped
+    # Max INFO/DEBUG lines per second per call site, for loggers on hot paths
+    rate_limits: Dict[str, int] = Field(default_factory=lambda: {
+        "utils.helpers": 10,
+        "utils.delivery": 10,
+    })
 
 class SettingsConfig(BaseModel):
     """General application settings."""
@@ -51,7 +64,111 @@ class SettingsConfig(BaseModel):
     news_expiration_time: timedelta = timedelta(days=5)
     interval_in_secs: int = 10 * 60 # Minutes
     mal_news_url: HttpUrl = "https://myanimelist.net/news"
+    parse_alert_interval: int = 6 * 60 * 60  # Min seconds between two parse health alerts while it keeps failing
     default_timezone: str = 'UTC'
+    chat_action_delay: float = 1.0  # Seconds a handler runs before the user sees "typing..."
+    stats_refresh_interval: int = 5 * 60  # Seconds between refreshes of the cached admin stats
+    stats_days: int = 7             # Days of sends/subscriptions shown in /skfj_status
+
+class RateLimitConfig(BaseModel):
+    """Where the rate limiter keeps its token buckets (see utils/rate_limiter.py)."""
+    backend: str = "memory"         # memory (this process only), sqlite (same host) or redis
+    sqlite_path: str = "data/ratelimit.sqlite"
+    redis_url: str = "redis://localhost:6379/0"
+    max_retries: int = 0            # Retries after a 429 from Telegram
+    # Share of the overall budget reserved for each lane, lower lanes can't touch it.
+    # The broadcast lane only gets what is left.
+    lane_reserves: Dict[str, float] = Field(default_factory=lambda: {
+        "interactive": 0.2,
+        "alert": 0.1,
+        "news": 0.1,
+    })
+
+class MetricsConfig(BaseModel):
+    """Configuration for the Prometheus style /metrics endpoint."""
+    enabled: bool = True
+    host: str = "127.0.0.1"         # Local only, put a reverse proxy in front to expose it
+    port: int = 9108                # Delivery workers use port + 1 + shard
+    loop_lag_interval: float = 0.5
+
+class TracingConfig(BaseModel):
+    """Configuration for the per update spans (see utils/tracing.py)."""
+    enabled: bool = True
+    buffer_size: int = 2000         # Latest spans kept in memory for /skfj_status
+    otlp_endpoint: Optional[str] = None  # e.g. http://127.0.0.1:4318/v1/traces
+
+class WatchdogConfig(BaseModel):
+    """Configuration for the event loop stall detector (see utils/watchdog.py)."""
+    enabled: bool = True
+    threshold: float = 2.0          # Seconds the loop may be blocked before it counts as a stall
+    check_interval: float = 0.5
+    alert_interval: int = 10 * 60   # Min seconds between two stall alerts
+
+class DeliveryConfig(BaseModel):
+    """Configuration for the out-of-process delivery workers (see worker.py)."""
+    use_workers: bool = False       # Enqueue fan-out sends in the outbox instead of sending inline
+    shards: int = 1                 # Number of worker processes, recipients are split by chat id hash
+    batch_size: int = 50            # Tasks claimed per poll
+    poll_interval: float = 1.0      # Seconds to wait when the outbox is empty
+    lease_secs: int = 120           # A claimed task is re-delivered if not finished within this time
+    max_attempts: int = 5
+    retry_delay_secs: int = 30
+
+class MediaConfig(BaseModel):
+    """Configuration for the article image cache (see utils/media.py)."""
+    enabled: bool = True
+    mode: str = "fallback"          # fallback: send the MAL url, upload our copy if Telegram can't fetch it. local: always upload
+    cache_dir: str = "data/media"
+    max_cache_mb: int = 200         # Least recently used images are evicted above this size
+    max_dimension: int = 1280       # Max width/height in px
+    max_kb: int = 500
+    format: str = "JPEG"            # JPEG or WEBP
+    quality: int = 85
+    download_timeout: float = 10.0
+    concurrency: int = 4            # Parallel image downloads
+
+class MirrorConfig(BaseModel):
+    """Configuration for the Telegraph mirrors of new articles (see utils/mirror.py)."""
+    enabled: bool = False
+    backend: str = "telegraph"      # telegraph, or local (in memory, for tests)
+    access_token: Optional[str] = None  # A new account is created (token saved in data_dir) if not set
+    domain: str = "telegra.ph"
+    author_name: str = "Anime News"
+    author_url: Optional[str] = None
+    concurrency: int = 3            # Articles fetched and published at a time
+    batch_size: int = 10            # Articles per database write
+    fetch_timeout: float = 15.0
+
+class EventsConfig(BaseModel):
+    """Configuration for the analytics event log (see utils/events.py)."""
+    enabled: bool = True
+    flush_interval: float = 5.0     # Seconds between batched inserts
+    batch_size: int = 1000          # Insert earlier once this many events are waiting
+    max_pending: int = 100000       # Events are dropped above this (database down)
+    rollup_interval: int = 10 * 60  # Seconds between rollups into the daily counts
+    retention_days: int = 90        # Raw events older than this are deleted, 0 keeps them
+
+class ChannelsConfig(BaseModel):
+    """Configuration for the channel permission sweep (see utils/channels.py)."""
+    revalidate: bool = True
+    check_ttl_hours: int = 24       # Every channel is checked about once per this period
+    sweep_interval: int = 15 * 60   # Seconds between sweeps, each checks its share of the channels
+    concurrency: int = 4            # getChatMember calls at a time
+
+class InlineConfig(BaseModel):
+    """Configuration for inline mode, @bot <query> (see utils/inline.py)."""
+    enabled: bool = True
+    max_articles: int = 2000        # Latest archived articles held in memory for inline queries
+    page_size: int = 20             # Results per answer, Telegram allows 50
+    cache_time: int = 300           # Seconds Telegram may reuse an answer
+    query_cache_size: int = 256     # Recent queries whose matches are kept
+
+class EditsConfig(BaseModel):
+    """Configuration for editing sent posts when an article changes (see utils/delivery.py)."""
+    enabled: bool = True
+    window_hours: int = 48          # Posts older than this are not edited, and dropped from the ledger
+    concurrency: int = 4            # Edit calls at a time
+    prune_interval: int = 60 * 60   # Seconds between ledger prunes
 
 class AppConfig(BaseSettings):
     """Main application configuration, loaded from environment variables and .env file."""
@@ -60,6 +177,17 @@ class AppConfig(BaseSettings):
     paths: PathsConfig = Field(default_factory=PathsConfig)
     settings: SettingsConfig = Field(default_factory=SettingsConfig)
     logging: LoggingConfig = Field(default_factory=LoggingConfig)
+    delivery: DeliveryConfig = Field(default_factory=DeliveryConfig)
+    rate_limit: RateLimitConfig = Field(default_factory=RateLimitConfig)
+    metrics: MetricsConfig = Field(default_factory=MetricsConfig)
+    watchdog: WatchdogConfig = Field(default_factory=WatchdogConfig)
+    tracing: TracingConfig = Field(default_factory=TracingConfig)
+    media: MediaConfig = Field(default_factory=MediaConfig)
+    mirror: MirrorConfig = Field(default_factory=MirrorConfig)
+    events: EventsConfig = Field(default_factory=EventsConfig)
+    channels: ChannelsConfig = Field(default_factory=ChannelsConfig)
+    inline: InlineConfig = Field(default_factory=InlineConfig)
+    edits: EditsConfig = Field(default_factory=EditsConfig)
 
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -69,7 +197,7 @@ class AppConfig(BaseSettings):
     )
     
     def initialize(self):
-        # Ensure all directories exist
+        # Ensure all directories exist. Called by the entry points, not on import
         self.paths.ensure_directories()
 
 
@@ -77,7 +205,6 @@ class AppConfig(BaseSettings):
 # The globally accessible configuration object
 try:
     config = AppConfig()
-    config.initialize()
 except Exception as e:
     print(f"Error loading configuration: {e}")
     import sys
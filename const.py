@@ -6,9 +6,12 @@ HELP_MENU = """
 /add_channel - Add a channel to the db
 /mychannels - edit your channels
 /latest - fetch the latest news
+/search [words] - search all past news
 /subscribe - get scheduled news update
 /unsubscribe - stop scheduled news update
 /togglenotifications [on/off] - Mute or unmute notifications
+/filter [add|remove|list] - only get (or never get) news about some anime or keywords
+/tags [add|remove|list] - only get news of some categories (manga, industry...)
 /feedback - Send feedback directly to the admin
 /cancel - Cancel current operation
 """
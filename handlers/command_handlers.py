@@ -1,20 +1,37 @@
 import asyncio
+import hashlib
 import os
 import time
+from typing import Dict, List
 from telegram import (
     Update,InlineKeyboardButton, InlineKeyboardMarkup)
-from telegram.constants import ParseMode, ChatAction, ChatType
+from telegram.constants import ParseMode, ChatType
 from telegram.ext import ContextTypes
 from telegram.error import BadRequest
 from models.database import SessionLocal
 from models.user import (
-    User, UserSettings, SubscriptionLog, Channel,
+    User, UserSettings, UserFilter, TagSubscription, Channel, normalize_term,
     )
-from models.news import NewsCache
+from models.news import ArticleTag, NewsArchive, NewsCache, normalize_tag, search_words
 from utils.decorators import *
+from utils.delivery import (
+    build_news_payloads, deactivate_chats, deliver_payload, edit_article_posts, enqueue_payloads, is_gone_error,
+    ledger_entry, record_sent,
+    )
+from utils.media import MEDIA
+from utils.write_behind import defer_write, run_write
+from utils import events
+from utils.events import EVENTS
+from utils.mirror import mirror_articles
+from utils.inline import INLINE_INDEX
+from utils.filters import FilterRouter, TagRouter
+from utils.metrics import ARTICLES, PARSE_FAILURES, format_metrics_summary
+from utils.tracing import format_trace_summary, traced
+from utils.stats import STATS, format_stats
+from utils.rate_limiter import LANE_NEWS, LANE_BROADCAST, format_lane_stats
 from utils.helpers import (
-    fetch_news_page, extract_news_articles, format_uptime,
-    resize_and_process_image, send_critical_alert, escape_html,
+    fetch_news_page, extract_news_articles, check_articles, format_uptime,
+    send_critical_alert, escape_html,
     is_owner)
 from const import HELP_MENU, ADMIN_MENU, ERROR_MSG
 
@@ -50,27 +67,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     welcome_message = f"👋 Hello {escape_html(user_data.get('first_name', 'there'))}, use /help for a list of commands."
     await update.message.reply_text(welcome_message)
     
-    with SessionLocal() as session:
-        try:
-            is_existing_user = User.user_exists(session, user_data["id"], user_data["chat_id"])
-            
-            if not is_existing_user:
-                new_user = User(**user_data)
-                u_settings = UserSettings(user_id=user_data["id"])
-                session.add(new_user)
-                session.add(u_settings)
-                session.commit()
-                return
-        except ValueError as e:
-            session.rollback()
-            logger.exception(f"Registration error: {e}")
-            return
-        except Exception as e:
-            session.rollback()
-            logger.exception(f"Error during user registration: {str(e)}")
-            await send_critical_alert(context, "Error while processing a user registration.", user_data, exc=e)
-            # await context.bot.send_message(chat_id=config.bot.owner_id, text="An error occurred while processing a user registration.")
-            return
+    async def alert_failure(e: Exception) -> None:
+        await send_critical_alert(context, "Error while processing a user registration.", user_data, exc=e)
+
+    try:
+        # Upsert: registers new users and refreshes the profile of known ones. With
+        # write-behind it is committed with the next batch, a flood of /start is a few commits,
+        # and a failure is alerted from there
+        defer_write(lambda session: User.register(session, user_data, commit=False), on_error=alert_failure)
+    except Exception as e:
+        # Without write-behind the write runs here
+        logger.exception(f"Error during user registration: {str(e)}")
+        await alert_failure(e)
+        return
     
     return
 
@@ -112,124 +121,308 @@ async def latest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("Couldn't load the news right now. Try again later.")
     return
 
+
+# Room left for the query in a page button's callback_data (64 bytes with "search:<page>:")
+SEARCH_REF_BYTES = 48
+MAX_LONG_SEARCHES = 20
+
+
+def search_ref(terms: str, user_data: dict) -> str:
+    """
+    What the page buttons of a search carry to find its query again: the query words, or
+    a key in `user_data` for the queries too long for callback_data.
+    """
+    query = " ".join(search_words(terms))
+    if len(query.encode("utf-8")) <= SEARCH_REF_BYTES:
+        return query
+    key = "#" + hashlib.sha256(query.encode("utf-8")).hexdigest()[:12]
+    searches = user_data.setdefault("searches", {})
+    searches.pop(key, None)
+    searches[key] = query
+    if len(searches) > MAX_LONG_SEARCHES:
+        del searches[next(iter(searches))]
+    return key
+
+
+def format_search_page(terms: str, page: int, per_page: int, ref: str) -> tuple:
+    """ The text and keyboard of a page (from 1) of search results, `ref` is from `search_ref` """
+    with SessionLocal() as session:
+        # One more than needed tells if there is a next page
+        articles = NewsArchive.search(session, terms, limit=per_page + 1, offset=(page - 1) * per_page)
+    has_next = len(articles) > per_page
+    articles = articles[:per_page]
+    if not articles:
+        text = f"No news found for <b>{escape_html(terms)}</b>." if page == 1 else "No more results."
+    else:
+        lines = [f"🔎 <b>{escape_html(terms)}</b> (page {page})\n"]
+        for i, article in enumerate(articles, start=(page - 1) * per_page + 1):
+            lines.append(f"{i}. <a href='{article.link}'>{escape_html(article.title)}</a> <i>{escape_html(article.date or '')}</i>")
+        text = "\n".join(lines)
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton("◀️ Previous", callback_data=f"search:{page - 1}:{ref}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next ▶️", callback_data=f"search:{page + 1}:{ref}"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    ''' Command: /search <terms> - Search all the news we ever cached '''
+    terms = " ".join(context.args).strip()
+    if not search_words(terms):
+        await update.effective_message.reply_text("Usage: /search <words>, e.g. /search one piece movie")
+        return
+    try:
+        # The page buttons carry the query, older results messages keep paging their own search
+        ref = search_ref(terms, context.user_data)
+        text, keyboard = format_search_page(terms, 1, config.settings.results_per_page, ref)
+        await update.effective_message.reply_text(text, reply_markup=keyboard, disable_web_page_preview=True)
+    except Exception as e:
+        logger.exception(f"Search for {terms!r} failed: {e}")
+        await update.effective_message.reply_text(ERROR_MSG)
+
+
+async def search_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    ''' Previous/Next buttons of /search '''
+    query = update.callback_query
+    await query.answer()
+    _, page, ref = query.data.split(":", 2)
+    terms = context.user_data.get("searches", {}).get(ref) if ref.startswith("#") else ref
+    if not terms:
+        await query.edit_message_text("This search has expired, search again with /search.")
+        return
+    page = max(1, int(page))
+    text, keyboard = format_search_page(terms, page, config.settings.results_per_page, ref)
+    await query.edit_message_text(text, reply_markup=keyboard, disable_web_page_preview=True)
+
 ####################
 #   User Settings  #
 ####################
 
+async def set_settings(user_id: int, **values) -> bool:
+    """ Upserts the user's settings, False if they were already set like this """
+    return await run_write(lambda session: UserSettings.set_values(session, user_id, commit=False, **values))
+
 async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     ''' Subscribe to receive news on an interval basis '''
     user = update.effective_user
-    with SessionLocal() as session:
-        try:
-            user_settings = UserSettings.get_user_settings(session, user.id)
-            
-            # Check if notifications are already muted
-            if user_settings is not None and user_settings.is_subscribed:
-                await update.effective_message.reply_text("You are already subscribed.")
-                return
-            user_settings.update_user_settings(session, user_id=user.id, subscribed=True)
-            await update.effective_message.reply_text("You will now receive scheduled updates.\nTo unsubscribe use: /unsubscribe.")
-        except Exception as e:
-            session.rollback()
-            logger.exception(f"Error during subscription: {str(e)}")
-            await update.effective_message.reply_text("An error occurred on our side while subscribing.")
+    try:
+        # Nothing changes if the user is already subscribed
+        if not await set_settings(user.id, is_subscribed=True):
+            await update.effective_message.reply_text("You are already subscribed.")
+            return
+        EVENTS.record(user.id, events.SUBSCRIBED)
+        await update.effective_message.reply_text("You will now receive scheduled updates.\nTo unsubscribe use: /unsubscribe.")
+    except Exception as e:
+        logger.exception(f"Error during subscription: {str(e)}")
+        await update.effective_message.reply_text("An error occurred on our side while subscribing.")
 
 async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     ''' Unsubscribe to stop news update schedule '''
     user = update.effective_user
-    with SessionLocal() as session:
-        try:
-            user_settings = UserSettings.get_user_settings(session, user.id)
-            
-            # Check if notifications are already muted
-            if user_settings is not None and not user_settings.is_subscribed:
-                await update.effective_message.reply_text("You are already not subscribed.")
-                return
-            user_settings.update_user_settings(session, user_id=user.id, subscribed=False)
-            await update.effective_message.reply_text("You will stop receiving scheduled updates from now.")
-        except Exception as e:
-            session.rollback()
-            logger.exception(f"Error during subscription: {str(e)}")
-            await update.effective_message.reply_text("An error occurred on our side while subscribing.")
+    try:
+        if not await set_settings(user.id, is_subscribed=False):
+            await update.effective_message.reply_text("You are already not subscribed.")
+            return
+        EVENTS.record(user.id, events.UNSUBSCRIBED)
+        await update.effective_message.reply_text("You will stop receiving scheduled updates from now.")
+    except Exception as e:
+        logger.exception(f"Error during subscription: {str(e)}")
+        await update.effective_message.reply_text("An error occurred on our side while subscribing.")
 
 async def channel_updates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     ''' Subscribe to receive news on an interval basis in added channels '''
     user = update.effective_user
-    with SessionLocal() as session:
-        try:
-            user_settings = UserSettings.get_user_settings(session, user.id)
-            
-            # Check if notifications are already muted
-            if user_settings is not None and user_settings.opted_for_channel_updates:
-                await update.effective_message.reply_text("You are already subscribed for channel updates.")
-                return
-            user_settings.update_user_settings(session, user_id=user.id, opted_for_channel_updates=True)
-            await update.effective_message.reply_text("You will now receive scheduled updates in all your added channels.\nTo unsubscribe use: /unsubscribe_channel.")
-        except Exception as e:
-            logger.exception(f"Error during channel subscription: {str(e)}")
-            await update.effective_message.reply_text("An error occurred on our side while adding your channel.")
+    try:
+        if not await set_settings(user.id, opted_for_channel_updates=True):
+            await update.effective_message.reply_text("You are already subscribed for channel updates.")
+            return
+        EVENTS.record(user.id, events.CHANNEL_OPT_IN)
+        await update.effective_message.reply_text("You will now receive scheduled updates in all your added channels.\nTo unsubscribe use: /unsubscribe_channel.")
+    except Exception as e:
+        logger.exception(f"Error during channel subscription: {str(e)}")
+        await update.effective_message.reply_text("An error occurred on our side while adding your channel.")
 
 async def unchannel_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     ''' Unsubscribe to stop news update schedule in channels '''
     user = update.effective_user
-    with SessionLocal() as session:
-        try:
-            user_settings = UserSettings.get_user_settings(session, user.id)
-            
-            # Check if subscrition is are already false
-            if user_settings is not None and not user_settings.opted_for_channel_updates:
-                await update.effective_message.reply_text("You are already not subscribed for channel updates.")
-                return
-            user_settings.update_user_settings(session, user_id=user.id, opted_for_channel_updates=False)
-            await update.effective_message.reply_text("You will stop receiving scheduled updates in added channels from now.")
-        except Exception as e:
-            logger.exception(f"Error during channel subscription: {str(e)}")
-            await update.effective_message.reply_text("An error occurred on our side while removing your channel.")
+    try:
+        if not await set_settings(user.id, opted_for_channel_updates=False):
+            await update.effective_message.reply_text("You are already not subscribed for channel updates.")
+            return
+        EVENTS.record(user.id, events.CHANNEL_OPT_OUT)
+        await update.effective_message.reply_text("You will stop receiving scheduled updates in added channels from now.")
+    except Exception as e:
+        logger.exception(f"Error during channel subscription: {str(e)}")
+        await update.effective_message.reply_text("An error occurred on our side while removing your channel.")
+
+
+# Per-user cap, every term goes into the automaton of each news cycle
+MAX_FILTERS = 30
+FILTER_USAGE = (
+    "Usage:\n"
+    "/filter add one piece, frieren - only get news about these\n"
+    "/filter add -live action - never get news about this\n"
+    "/filter remove one piece\n"
+    "/filter list"
+)
+
+
+def parse_filter_terms(text: str) -> Dict[str, bool]:
+    """ {normalized term: exclude} from comma separated terms, "-" in front excludes """
+    terms = {}
+    for part in text.split(","):
+        part = part.strip()
+        exclude = part.startswith(("-", "!"))
+        term = normalize_term(part.lstrip("-!"))[:100]
+        if term:
+            terms[term] = exclude
+    return terms
+
+
+async def filter_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    ''' Command: /filter add|remove|list - Keywords and titles to include or exclude '''
+    user = update.effective_user
+    action = context.args[0].lower() if context.args else "list"
+    terms = parse_filter_terms(" ".join(context.args[1:]))
+    try:
+        with SessionLocal() as session:
+            if action == "add" and terms:
+                existing = {f.term for f in UserFilter.get_user_filters(session, user.id)}
+                # Switching a filter between include and exclude doesn't take another slot
+                if len(existing | set(terms)) > MAX_FILTERS:
+                    await update.effective_message.reply_text(f"You can have at most {MAX_FILTERS} filters.")
+                    return
+                added = UserFilter.set_terms(session, user.id, terms)
+                await update.effective_message.reply_text(f"✅ {added} filter(s) added, {len(terms) - added} updated.")
+            elif action == "remove" and terms:
+                removed = UserFilter.remove_terms(session, user.id, list(terms))
+                await update.effective_message.reply_text(f"🗑 {removed} filter(s) removed.")
+            elif action == "list":
+                user_filters = UserFilter.get_user_filters(session, user.id)
+                if not user_filters:
+                    await update.effective_message.reply_text(f"You have no filters, you get all the news.\n\n{FILTER_USAGE}")
+                    return
+                included = [escape_html(f.term) for f in user_filters if not f.exclude]
+                excluded = [escape_html(f.term) for f in user_filters if f.exclude]
+                lines = ["<b>Your filters</b>"]
+                if included:
+                    lines.append(f"✅ Only news about: {', '.join(included)}")
+                if excluded:
+                    lines.append(f"🚫 Never news about: {', '.join(excluded)}")
+                await update.effective_message.reply_text("\n".join(lines))
+            else:
+                await update.effective_message.reply_text(FILTER_USAGE)
+    except Exception as e:
+        logger.exception(f"Error during /filter {action}: {e}")
+        await update.effective_message.reply_text(ERROR_MSG)
 
 
-async def toggle_notifications(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+# Per-chat cap on tag subscriptions
+MAX_TAGS = 20
+TAGS_USAGE = (
+    "Usage:\n"
+    "/tags add manga, industry - only get news with one of these tags\n"
+    "/tags remove manga\n"
+    "/tags list\n"
+    "/tags @yourchannel add manga - same for a channel you added"
+)
+
+
+def parse_tags(text: str) -> List[str]:
+    """ Normalized tags from comma separated ones, "Live Action" is live_action """
+    tags = []
+    for part in text.split(","):
+        tag = normalize_tag(part)
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tags
+
+
+async def tags_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    ''' Command: /tags [@channel] add|remove|list - Subscribe to MAL news categories '''
     user = update.effective_user
-    with SessionLocal() as session:
-        try:
-            # Check for arguments
-            if len(context.args) == 0:
-                # If no argument, get current setting
-                user_settings = UserSettings.create_or_get_user_settings(session, user.id)
-                new_setting = not user_settings.notifications_disabled # Toggle the current state
-                if UserSettings.update_notifications_disabled(session ,user_id=user.id, notification_in=new_setting):
-                    status_message = "Notifications are now turned OFF." if new_setting else "Notifications are now turned ON."
-                    await update.effective_message.reply_text(status_message)
+    args = list(context.args)
+    target = args.pop(0) if args and (args[0].startswith("@") or args[0].lstrip("-").isdigit()) else None
+    action = args[0].lower() if args else "list"
+    tags = parse_tags(" ".join(args[1:]))
+    try:
+        with SessionLocal() as session:
+            chat_id, title = user.id, "Your tags"
+            if target:
+                # Channels are stored with their link, see _process_channel
+                if target.startswith("@"):
+                    channel = Channel.get_channel(session, username=f"https://t.me/{target[1:]}")
                 else:
-                    await update.effective_message.reply_text("Failed to update your notification settings.")
-                return
-            
-            # Ensure user has sent exactly one expected valid argument ('on' or 'off')
-            if len(context.args) != 1:
-                await update.effective_message.reply_text(
-                    "Usage: /togglenotifications <on | off> or /togglenotifications",
-                    parse_mode=ParseMode.MARKDOWN)
-                return
+                    channel = Channel.get_channel(session, channel_id=int(target))
+                if channel is None or channel.added_by != user.id:
+                    await update.effective_message.reply_text("That is not one of your channels, see /mychannels.")
+                    return
+                chat_id, title = channel.id, f"Tags of {escape_html(channel.name)}"
+            if action == "add" and tags:
+                # Tags already followed don't take another slot
+                if len(set(TagSubscription.get_chat_tags(session, chat_id)) | set(tags)) > MAX_TAGS:
+                    await update.effective_message.reply_text(f"A chat can follow at most {MAX_TAGS} tags.")
+                    return
+                added = TagSubscription.add_tags(session, chat_id, tags)
+                await update.effective_message.reply_text(f"✅ {added} tag(s) added.")
+            elif action == "remove" and tags:
+                removed = TagSubscription.remove_tags(session, chat_id, tags)
+                await update.effective_message.reply_text(f"🗑 {removed} tag(s) removed.")
+            elif action == "list":
+                chat_tags = TagSubscription.get_chat_tags(session, chat_id)
+                popular = ", ".join(tag for tag, _ in ArticleTag.get_popular(session))
+                lines = [f"<b>{title}</b>",
+                         f"🏷 Only news tagged: {', '.join(chat_tags)}" if chat_tags else "None, all the news is sent."]
+                if popular:
+                    lines.append(f"\nTags on MAL lately: {popular}")
+                lines.append(f"\n{TAGS_USAGE}")
+                await update.effective_message.reply_text("\n".join(lines))
+            else:
+                await update.effective_message.reply_text(TAGS_USAGE)
+    except Exception as e:
+        logger.exception(f"Error during /tags {action}: {e}")
+        await update.effective_message.reply_text(ERROR_MSG)
 
-            new_notification = str(context.args[0]).lower()
-            if new_notification not in ("on", "off"):
-                await update.effective_message.reply_text("Please specify either 'on' or 'off' for notifications.")
-                return
 
-            # Convert input to boolean
-            notification_setting = new_notification == "off"
-            # Store the new interval (can be stored in the database or in-memory)
-            if UserSettings.update_notifications_disabled(session, user_id=user.id, notification_in=notification_setting):
-                # Inform the user about the update
-                await update.effective_message.reply_text(f"Notifications are now {'muted' if notification_setting else 'enabled'}.")
-            else:
-                await update.effective_message.reply_text("Failed to update your notification settings.")
+async def toggle_notifications(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    try:
+        # Check for arguments
+        if len(context.args) == 0:
+            # No argument: flip the current setting, in the same statement that reads it
+            new_setting = await run_write(
+                lambda session: UserSettings.toggle(session, user.id, "notifications_disabled", commit=False))
+            EVENTS.record(user.id, events.MUTED if new_setting else events.UNMUTED)
+            status_message = "Notifications are now turned OFF." if new_setting else "Notifications are now turned ON."
+            await update.effective_message.reply_text(status_message)
+            return
+        
+        # Ensure user has sent exactly one expected valid argument ('on' or 'off')
+        if len(context.args) != 1:
+            await update.effective_message.reply_text(
+                "Usage: /togglenotifications <on | off> or /togglenotifications",
+                parse_mode=ParseMode.MARKDOWN)
             return
 
-        except Exception as e:
-            logger.exception(f"Error during toggle_notifications: {str(e)}")
-            await update.message.reply_text("An error occurred while updating your notification settings.")
+        new_notification = str(context.args[0]).lower()
+        if new_notification not in ("on", "off"):
+            await update.effective_message.reply_text("Please specify either 'on' or 'off' for notifications.")
             return
 
+        # Convert input to boolean
+        notification_setting = new_notification == "off"
+        if await set_settings(user.id, notifications_disabled=notification_setting):
+            EVENTS.record(user.id, events.MUTED if notification_setting else events.UNMUTED)
+        # Inform the user about the update
+        await update.effective_message.reply_text(f"Notifications are now {'muted' if notification_setting else 'enabled'}.")
+        return
+
+    except Exception as e:
+        logger.exception(f"Error during toggle_notifications: {str(e)}")
+        await update.message.reply_text("An error occurred while updating your notification settings.")
+        return
+
 ####################
 #  Admin Commands  #
 ####################
@@ -261,18 +454,24 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # minutes, seconds = divmod(remainder, 60)
     uptime_seconds = time.time() - start_time
     uptime_text = format_uptime(uptime_seconds)
-    with SessionLocal() as session:
-        try:
-            total_users: int = User.get_total_users(session=session)
-            status = (
-                f"<b>Status</b>\n\n"
-                f"<b>🤖 Bot Status</b>: Online\n"
-                # f"<b>⏱️ Uptime</b>: {hours}h {minutes}m {seconds}s\n"
-                f"<b>⏱️ Uptime</b>: {uptime_text}\n"
-                f"<b>👥 Total Users</b>: {total_users}")
-            await update.message.reply_text(status)
-        except Exception as e:
-            await update.message.reply_text(f"There was an error fetching status: {e}")
+    try:
+        stats = await STATS.get()
+        status = (
+            f"<b>Status</b>\n\n"
+            f"<b>🤖 Bot Status</b>: Online\n"
+            # f"<b>⏱️ Uptime</b>: {hours}h {minutes}m {seconds}s\n"
+            f"<b>⏱️ Uptime</b>: {uptime_text}\n"
+            f"{format_stats(stats, STATS.age)}")
+        lane_stats = format_lane_stats(context.bot.rate_limiter)
+        if lane_stats:
+            status += f"\n\n{lane_stats}"
+        status += f"\n\n{format_metrics_summary()}"
+        trace_summary = format_trace_summary()
+        if trace_summary:
+            status += f"\n\n{trace_summary}"
+        await update.message.reply_text(status)
+    except Exception as e:
+        await update.message.reply_text(f"There was an error fetching status: {e}")
 
 def remove_job_if_exists(name: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Remove job with given name. Returns whether job was removed."""
@@ -286,97 +485,120 @@ def remove_job_if_exists(name: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
 # --------------------------------------------
 # Send News to Subscribers
 
+def get_news_chat_ids(session) -> list:
+    """Chats that get the news: subscribed users and the active channels of opted in users."""
+    # Users who blocked the bot and channels it can't post in are skipped (see track_chat_member)
+    return UserSettings.get_all_subscribed_users(session) + Channel.get_news_channel_ids(session)
+
+
 async def send_news_to_subscribers(news, chat_ids, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send new news to subscribers or channels."""
     if not news:
         logger.info("No new news articles to send.")
         return
 
-    # Helper function to send the news to a single chat (user or channel)
-    async def send_to_chat(chat_id, article, is_channel=False):
-        message_text = f"<b>{article.get('title')}</b>\n\n<i>{article.get('summary')}</i>"
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("📜 Read More", url=article.get('link'))]
-        ])
+    # Users' keyword filters and the tag subscriptions, loaded once per cycle
+    router = await asyncio.to_thread(FilterRouter.load)
+    tags = await asyncio.to_thread(TagRouter.load, news)
+    messages = build_news_payloads(news, chat_ids, router, tags)
 
-        if article.get('image_url'):
-            try:
-                # Send photo for both users and channels
-                await context.bot.send_photo(
-                    chat_id=chat_id,
-                    photo=article.get('image_url'),
-                    caption=message_text,
-                    reply_markup=keyboard)
-            except Exception as e:
-                logger.exception(f"Failed to send photo to chat {chat_id}: {str(e)}")
-        else:
-            try:
-                # Send message for both users and channels
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=message_text,
-                    reply_markup=keyboard)
-            except Exception as e:
-                logger.exception(f"Failed to send message to chat {chat_id}: {str(e)}")
-
-    # Send news to channels (always with buttons)
-    for chat_id in chat_ids:
-        if chat_id < 0:  # Channel ID check
-            for article in news:
-                await send_to_chat(chat_id, article, is_channel=True)
-
-    # For users: handle based on the number of news articles
-    if len(news) < 5:
-        # Send individual articles to user_ids
-        for chat_id in chat_ids:
-            if chat_id > 0:  # User ID check
-                for article in news:
-                    await send_to_chat(chat_id, article)
-    else:
-        # Send clickable headlines to users if there are 6 or more articles
-        headlines_text = "<b>Latest News:</b>\n\n"
-        for article in news:
-            headlines_text += f"- <a href='{article.get('link')}'>{article.get('title')}</a>\n"
+    # Leave the sending to the delivery workers (worker.py) so fan-out does not compete with updates
+    if config.delivery.use_workers:
+        queued = enqueue_payloads(messages)
+        logger.info(f"Queued {queued} message(s) for the delivery workers.")
+        return
 
-        for chat_id in chat_ids:
-            if chat_id > 0:  # User ID check
-                try:
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=headlines_text)
-                except Exception as e:
-                    logger.exception(f"Failed to send message to user {chat_id}: {str(e)}")
+    gone = set()
+    sent = []
+    for chat_id, payload in messages:
+        if chat_id in gone:
+            continue
+        try:
+            message = await deliver_payload(context.bot, chat_id, payload, rate_limit_args={"lane": LANE_NEWS})
+            entry = ledger_entry(chat_id, payload, message)
+            if entry:
+                sent.append(entry)
+        except Exception as e:
+            # Not retried here
+            EVENTS.record(chat_id, events.DELIVERY_FAILED)
+            if is_gone_error(e):
+                logger.warning(f"Chat {chat_id} can't be reached anymore: {e}")
+                gone.add(chat_id)
+                continue
+            logger.exception(f"Failed to send {payload['kind']} to chat {chat_id}: {str(e)}")
+    if sent:
+        # Kept for editing the posts if the articles change, see edit_article_posts
+        await asyncio.to_thread(record_sent, sent)
+    if gone:
+        with SessionLocal() as session:
+            deactivate_chats(session, gone)
 
 
+async def alert_parse_failure(context: ContextTypes.DEFAULT_TYPE, fetched: bool, articles: int, problems: list) -> None:
+    """ Alerts the admins once when parsing breaks, then at most every `parse_alert_interval` while it stays broken """
+    now = time.monotonic()
+    last_alert = context.bot_data.get("parse_alert_at")
+    if last_alert is not None and now - last_alert < config.settings.parse_alert_interval:
+        context.bot_data["parse_alerts_suppressed"] = context.bot_data.get("parse_alerts_suppressed", 0) + 1
+        return
+    context.bot_data["parse_alert_at"] = now
+    context_data = {"fetched": fetched, "articles": articles, "problems": "; ".join(problems[:10])}
+    suppressed = context.bot_data.pop("parse_alerts_suppressed", 0)
+    if suppressed:
+        context_data["failed polls not alerted"] = suppressed
+    await send_critical_alert(context, "MAL parse health check failed", context_data)
+
+
+@traced("job:update_news_articles")
 async def update_news_articles(context: ContextTypes.DEFAULT_TYPE) -> None:
     ''' Initialize the fetching and caching of new news article at n interval '''
     logger.info("Fetching news article...")
     job = context.job
     chat_id = job.data['chat_id']
     try:
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
         msg_to_edit = await context.bot.send_message(chat_id=chat_id, text="Fetching feed...")
         html_page = fetch_news_page(config.settings.mal_news_url)
-        articles = extract_news_articles(html_page)
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        # Parse in a thread so the loop stays free for updates
+        articles = await asyncio.to_thread(extract_news_articles, html_page) if html_page else []
+        problems = check_articles(articles)
+        if problems:
+            # Most likely MAL changed its markup, better to hear it now than from subscribers
+            PARSE_FAILURES.inc()
+            logger.error(f"MAL parse health check failed: {problems}")
+            await alert_parse_failure(context, html_page is not None, len(articles), problems)
+            if not articles:
+                await msg_to_edit.edit_text(text="❌ No articles parsed, see the alert.")
+                return
+        else:
+            # Healthy again, the next failure is alerted right away
+            context.bot_data.pop("parse_alert_at", None)
+            context.bot_data.pop("parse_alerts_suppressed", None)
         msg_to_edit = await msg_to_edit.edit_text(text="Done")
         await asyncio.sleep(1)
         
         with SessionLocal() as session:
-            await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
             msg_to_edit = await msg_to_edit.edit_text(text="Caching articles...")
             await asyncio.sleep(1)
+            changed = NewsCache.update_changed(session, articles)
             news_count, new_news = NewsCache.cache_articles(session, articles)
+        if changed and config.edits.enabled:
+            # Edit the posts already sent rather than sending the articles again
+            logger.info(f"{len(changed)} cached article(s) changed on MAL, editing their posts.")
+            context.application.create_task(edit_article_posts(context.bot, changed))
+        if new_news and config.media.enabled:
+            # Download the images while we look up the recipients and start sending
+            context.application.create_task(MEDIA.prefetch(article.image_url for article in new_news))
+        if (new_news or changed) and config.inline.enabled:
+            await asyncio.to_thread(INLINE_INDEX.refresh)
+        ARTICLES.inc(news_count, result="new")
+        ARTICLES.inc(len(articles) - news_count, result="duplicate")
         msg = f"✅ {news_count} new article(s) cached."
         logger.info(msg)
         await msg_to_edit.edit_text(msg)
         if new_news:
             try:
                 with SessionLocal() as session:
-                    user_chat_ids = UserSettings.get_all_subscribed_users(session)
-                    opted_for_channel = UserSettings.get_all_opted_users(session)
-                    channel_ids = [channel.id for user_id in opted_for_channel for channel in Channel.get_all_user_channels(session, user_id)]
-                    chat_ids = user_chat_ids + channel_ids
+                    chat_ids = get_news_chat_ids(session)
             except Exception as e:
                 logger.exception(f"Error whilst fetching subscribed users: {e}")
                 msg_title = "Error whilst fetching subscribed users"
@@ -384,6 +606,9 @@ async def update_news_articles(context: ContextTypes.DEFAULT_TYPE) -> None:
                 # await context.bot.send_message(chat_id=chat_id, text=f"An error occurred: {e}")
             # Send the new news to subscribers
             await send_news_to_subscribers(new_news, chat_ids, context)
+            if config.mirror.enabled:
+                # Only once the fan-out is done (or queued), it never waits for Telegraph
+                context.application.create_task(mirror_articles(new_news))
     except Exception as e:
         logger.exception(f"Error whilst fetching or caching news articles: {e}")
         msg_title = "Error whilst fetching or caching news articles"
@@ -434,11 +659,9 @@ async def stop_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 @restricted
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     ''' Command: /broadcast - Send a message to all users (Admin Only) '''
-    uchat_id = update.effective_chat.id
 
     # Ensure there's a message to broadcast
     if len(context.args) == 0:
-        await context.bot.send_chat_action(chat_id=uchat_id, action=ChatAction.TYPING)
         await update.message.reply_text("Usage: /broadcast <message>", parse_mode=ParseMode.MARKDOWN)
         return
 
@@ -452,26 +675,40 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             # Fetch all users
             user_chat_ids = User.get_all_chatIds(session)
 
+            if config.delivery.use_workers:
+                payload = {"kind": "message", "text": message_to_broadcast, "lane": LANE_BROADCAST}
+                queued = enqueue_payloads([(chat_id[0], payload) for chat_id in user_chat_ids])
+                await update.message.reply_text(f"📢 Broadcast queued for {queued} chats.")
+                logger.info(f"Broadcast queued for {queued} chats.")
+                return
+
             # Broadcast the message to each user
+            gone = set()
             for chat_id in user_chat_ids:
                 try:
-                    await context.bot.send_chat_action(chat_id=chat_id[0], action=ChatAction.TYPING)
-                    await context.bot.send_message(chat_id=chat_id[0], text=message_to_broadcast)
+                    await context.bot.send_message(chat_id=chat_id[0], text=message_to_broadcast,
+                                                   rate_limit_args={"lane": LANE_BROADCAST})
                     logger.info(f"Message sent to {chat_id[0]}")
                     msg_sent.append(chat_id[0])
-                except BadRequest as e:
-                    await update.message.reply_text(f"BadRequest: {e}")
-                    logger.exception(f"Error: {e}")
-                    msg_failed.append(chat_id[0])
-                    return
+                    EVENTS.record(chat_id[0], events.DELIVERED)
                 except Exception as e:
-                    logger.exception(f"Failed to send message to {chat_id[0]}: {str(e)}")
-                    msg_title = f"Failed to send message to {chat_id[0]}"
                     msg_failed.append(chat_id[0])
-                    await send_critical_alert(context, msg_title, context.bot_data, exc=e)
+                    EVENTS.record(chat_id[0], events.DELIVERY_FAILED)
+                    if is_gone_error(e):
+                        # Blocked the bot or deleted: deactivated below, like the news fan-out does
+                        logger.warning(f"Chat {chat_id[0]} can't be reached anymore: {e}")
+                        gone.add(chat_id[0])
+                    elif isinstance(e, BadRequest):
+                        # One bad chat doesn't stop the broadcast
+                        logger.warning(f"BadRequest sending to {chat_id[0]}: {e}")
+                    else:
+                        logger.exception(f"Failed to send message to {chat_id[0]}: {str(e)}")
+                        msg_title = f"Failed to send message to {chat_id[0]}"
+                        await send_critical_alert(context, msg_title, context.bot_data, exc=e)
+            if gone:
+                deactivate_chats(session, gone)
 
             isSuccessful = "successfully" if not msg_failed else f"with {len(msg_failed)} errors"
-            await context.bot.send_chat_action(chat_id=uchat_id, action=ChatAction.TYPING)
             await update.message.reply_text(f"📢 Broadcast message sent {isSuccessful}.\n<b>✅ Sent to:</b> {len(msg_sent)} chats.\n<b>❌ Failed:</b> {len(msg_failed)}")
             logger.info(f"Broadcast message sent {isSuccessful}.\nSent to: {len(msg_sent)}chats.\nFailed: {len(msg_failed)}")
             return
@@ -1,5 +1,6 @@
 import asyncio
 import re
+from datetime import datetime
 from textwrap import dedent
 
 from telegram import (
@@ -17,6 +18,7 @@ from models.database import SessionLocal
 from models.user import User, UserSettings, Channel
 from models.news import NewsCache
 from utils.decorators import *
+from utils.channels import can_post
 from utils.helpers import (
     build_menu, get_data_paginated, get_channels, get_news,
     get_user_channels, send_critical_alert, escape_html,
@@ -75,9 +77,16 @@ async def _process_channel(session: Session, update: Update, context: ContextTyp
     Handles the core logic for processing and adding a channel.
     """
     try:
-        # Check if bot is an admin in the channel and has required permissions
-        bot_member = await context.bot.get_chat_member(chat_id=channel.id, user_id=context.bot.id)
-        if not (bot_member.status == 'administrator' and bot_member.can_post_messages):
+        # Both lookups at once: the bot needs admin rights to post, the user must be an admin.
+        # Their errors are raised in the order the checks were made one after the other
+        bot_member, user_member = await asyncio.gather(
+            context.bot.get_chat_member(chat_id=channel.id, user_id=context.bot.id),
+            context.bot.get_chat_member(chat_id=channel.id, user_id=user_id),
+            return_exceptions=True,
+        )
+        if isinstance(bot_member, BaseException):
+            raise bot_member
+        if not can_post(bot_member):
             await update.message.reply_text(ADMIN_CHECK_FAILURE)
             # (
             #     f"I am not an admin with the required 'post messages' and 'delete messages' permissions "
@@ -86,7 +95,8 @@ async def _process_channel(session: Session, update: Update, context: ContextTyp
             return ConversationHandler.END
         
         # --- USER PERMISSIONS CHECK ---
-        user_member = await context.bot.get_chat_member(chat_id=channel.id, user_id=user_id)
+        if isinstance(user_member, BaseException):
+            raise user_member
         if user_member.status not in ['administrator', 'creator']:
             await update.message.reply_text(
                 "🚫You are not an admin in the channel. I can't process this."
@@ -96,6 +106,8 @@ async def _process_channel(session: Session, update: Update, context: ContextTyp
         # Check if exists
         exists: bool = Channel.channel_exists(session, channel.id)
         if exists:
+            # We just checked it, in case it was disabled while the bot had no rights
+            Channel.record_checks(session, {channel.id: True}, datetime.utcnow())
             prod_text = dedent(f"""
             ℹ️ The channel <b>{escape_html(channel.title)}</b> is already registered.
             
@@ -110,6 +122,7 @@ async def _process_channel(session: Session, update: Update, context: ContextTyp
             name=channel.title,
             username= f"https://t.me/{channel.username}" if channel.username else "",
             added_by=user_id,
+            checked_at=datetime.utcnow(),
         )
         session.add(new_channel)
         session.commit()
@@ -533,8 +546,11 @@ async def handle_selected_news(update: Update, context: ContextTypes.DEFAULT_TYP
         
         context.user_data["selected_news_index"] = news_index
         article_text = f"<b>{selected_article.title}</b>\n\n<i>{selected_article.summary}</i>"
+        read_buttons = [InlineKeyboardButton("📜 Read More", url=selected_article.link)]
+        if selected_article.telegraph_url:
+            read_buttons.append(InlineKeyboardButton("⚡ Instant View", url=selected_article.telegraph_url))
         keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("📜 Read More", url=selected_article.link)],
+            read_buttons,
             [InlineKeyboardButton("⬅️ Back", callback_data="news_page_1")]
         ])
         
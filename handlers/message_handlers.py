@@ -0,0 +1,72 @@
+import asyncio
+
+from telegram import ChatMember, ChatMemberUpdated, Update
+from telegram.constants import ChatType
+from telegram.ext import ContextTypes
+
+from models.database import SessionLocal
+from models.user import Channel, User
+from utils import events
+from utils.channels import can_post
+from utils.inline import INLINE_INDEX, MAX_RESULTS, build_inline_result
+from utils.events import EVENTS
+from config import config
+
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__, config.paths.log_path+"/handlers.log")
+
+
+def is_reachable(member_update: ChatMemberUpdated) -> bool:
+    """ Whether the bot can still send to the chat after this my_chat_member update """
+    member = member_update.new_chat_member
+    if member_update.chat.type == ChatType.CHANNEL:
+        return can_post(member)
+    if member.status == ChatMember.RESTRICTED:
+        return bool(getattr(member, "is_member", False)) and bool(getattr(member, "can_send_messages", False))
+    return member.status in (ChatMember.MEMBER, ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+
+
+async def track_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    my_chat_member: the bot was blocked/unblocked by a user, or removed from/added to a
+    channel, or its rights changed. Flags the user or channel so the news skip it.
+    """
+    member_update = update.my_chat_member
+    chat = member_update.chat
+    active = is_reachable(member_update)
+    try:
+        with SessionLocal() as session:
+            if chat.type == ChatType.PRIVATE:
+                changed = User.set_active(session, [chat.id], active)
+            else:
+                # Only registered channels have a row, other chats are ignored
+                changed = Channel.set_active(session, [chat.id], active)
+    except Exception as e:
+        logger.exception(f"Failed to update chat {chat.id} from my_chat_member: {e}")
+        return
+    if changed:
+        logger.info(f"Chat {chat.id} ({chat.type}) is now {'active' if active else 'inactive'}.")
+        if chat.type == ChatType.PRIVATE:
+            EVENTS.record(chat.id, events.UNBLOCKED if active else events.BLOCKED)
+
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """ Answers @bot <query> from the in-memory index """
+    query = update.inline_query
+    if not INLINE_INDEX.loaded:
+        # Only the first query after a restart reads the database
+        await asyncio.to_thread(INLINE_INDEX.refresh)
+    try:
+        offset = max(0, int(query.offset or 0))
+    except ValueError:
+        offset = 0
+    limit = min(config.inline.page_size, MAX_RESULTS)
+    articles, has_more = INLINE_INDEX.search(query.query, offset, limit)
+    await query.answer(
+        [build_inline_result(article) for article in articles],
+        # Same answer for everyone, so Telegram can serve repeated queries itself
+        cache_time=config.inline.cache_time,
+        is_personal=False,
+        next_offset=str(offset + limit) if has_more else "",
+    )
@@ -1,3 +1,12 @@
+import sys
+
+# Before the other imports so that they are timed, see utils/startup.py
+if "--profile-startup" in sys.argv:
+    from utils import startup
+    startup.enable()
+
+import argparse
+import asyncio
 import time
 import os
 from datetime import datetime
@@ -6,11 +15,12 @@ from datetime import datetime
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import (
-    AIORateLimiter,
     Application,
     ApplicationBuilder,
     CallbackQueryHandler,
     CallbackContext,
+    ChatMemberHandler,
+    InlineQueryHandler,
     CommandHandler,
     ConversationHandler,
     Defaults,
@@ -28,6 +38,10 @@ from handlers.command_handlers import (
     help_command,
     ignore_all,
     latest,
+    search,
+    search_page,
+    filter_command,
+    tags_command,
     start,
     start_schedule,
     status,
@@ -54,11 +68,26 @@ from handlers.conversation_handlers import (
     SELECTING_CHANNEL,
     SELECTING_NEWS,
 )
-# from handlers.message_handlers import ()
+from handlers.message_handlers import inline_query, track_chat_member
 from config import config
-from models.database import Base, db
+from models.database import Base, SessionLocal, db, upgrade_schema
+from models.news import NewsArchive
 from utils.helpers import send_critical_alert
+from utils.metrics import ERRORS, monitor_loop_lag, start_metrics_server
+from utils.tracing import InstrumentedApplication, start_exporter, stop_exporter
+from utils.media import MEDIA
+from utils.write_behind import WRITES
+from utils.events import EVENTS, rollup_events_job
+from utils.channels import revalidate_channels_job
+from utils.delivery import prune_sent_messages_job
+from utils.inline import INLINE_INDEX
+from utils.stats import refresh_stats
+from utils.rate_limiter import build_rate_limiter
 from utils.logger import setup_logger
+from utils.watchdog import start_watchdog
+from utils import startup
+
+startup.imports_done()
 
 filterwarnings(action="ignore", message=r".*CallbackQueryHandler", category=PTBUserWarning)
 
@@ -68,8 +97,13 @@ ERROR_COUNT_24H = 0
 logger = setup_logger(__name__, config.paths.log_path+"/main.log")
 
 def init_db():
-    """Creates tables if they don't exist."""
+    """Creates tables if they don't exist, adds new columns to existing ones and archives cached articles."""
     Base.metadata.create_all(db)
+    upgrade_schema(db)
+    with SessionLocal() as session:
+        archived = NewsArchive.backfill(session)
+    if archived:
+        logger.info(f"Archived {archived} cached article(s).")
 
 # ---------------------------
 # GLOBAL ERROR HANDLER
@@ -81,6 +115,7 @@ async def error_handler(update: Update, context: CallbackContext):
     """
     global ERROR_COUNT_24H
     ERROR_COUNT_24H += 1
+    ERRORS.inc()
     context.bot_data['error_count_24h'] = ERROR_COUNT_24H
     # Log the error details
     logger.exception(f"A general error occurred: {context.error}", exc_info=True)
@@ -110,31 +145,69 @@ async def post_init(app: Application) -> None:
     logger.info(f"Bot start time set to {datetime.fromtimestamp(START_TIME)}.")
     app.bot_data['error_count_24h'] = ERROR_COUNT_24H
     logger.info(f"Bot error count set to {ERROR_COUNT_24H}.")
+
+    # Metrics endpoint and event loop lag sampling
+    with startup.phase("post_init: metrics server"):
+        app.bot_data['metrics_server'] = await start_metrics_server()
+    app.bot_data['loop_lag_monitor'] = asyncio.create_task(monitor_loop_lag(config.metrics.loop_lag_interval))
+    with startup.phase("post_init: watchdog"):
+        app.bot_data['watchdog'] = start_watchdog(app)
+    with startup.phase("post_init: span exporter"):
+        start_exporter()
+    if config.inline.enabled:
+        with startup.phase("post_init: inline index"):
+            await asyncio.to_thread(INLINE_INDEX.refresh)
+    # Admin stats are computed in the background, /skfj_status only reads the cache
+    app.job_queue.run_repeating(refresh_stats, config.settings.stats_refresh_interval, first=1, name="refresh_stats")
+    # Daily event counts for the stats, from the raw event log
+    app.job_queue.run_repeating(rollup_events_job, config.events.rollup_interval, first=5, name="rollup_events")
+    if config.channels.revalidate:
+        # Checks a share of the channels every sweep, see utils/channels.py
+        app.job_queue.run_repeating(revalidate_channels_job, config.channels.sweep_interval, first=60,
+                                    name="revalidate_channels")
+    if config.edits.enabled:
+        # Posts older than the edit window are not edited anymore, no need to remember them
+        app.job_queue.run_repeating(prune_sent_messages_job, config.edits.prune_interval, first=120,
+                                    name="prune_sent_messages")
     
     logger.info("post_init is complete.")
+    if startup.enabled():
+        print(startup.report(), file=sys.stderr, flush=True)
 
-def start_bot() -> None:
-    """The main entry point for the bot."""
-    # Initializing db
-    init_db()
-    
+async def post_shutdown(app: Application) -> None:
+    """Runs after the application has shut down."""
+    watchdog = app.bot_data.get('watchdog')
+    if watchdog:
+        watchdog.stop()
+    await stop_exporter()
+    await MEDIA.close()
+    await WRITES.close()
+    await EVENTS.close()
+    lag_monitor = app.bot_data.get('loop_lag_monitor')
+    if lag_monitor:
+        lag_monitor.cancel()
+    server = app.bot_data.get('metrics_server')
+    if server:
+        server.close()
+        await server.wait_closed()
+
+def build_application() -> Application:
+    """Builds the Application with all the handlers, without starting it."""
     defaults = Defaults(parse_mode=ParseMode.HTML)
-    # Configure the rate limiter
-    rate_limiter = AIORateLimiter(
-        overall_max_rate=config.settings.overall_max_rate,      # Max 30 requests per second across all chats
-        overall_time_period=config.settings.overall_time_period,
-        group_max_rate=config.settings.group_max_rate,        # Max 20 requests per minute in a single group
-        group_time_period=config.settings.group_time_period
-    )
+    # Configure the rate limiter (shared with the delivery workers unless RATE_LIMIT__BACKEND=memory)
+    rate_limiter = build_rate_limiter(share=config.delivery.shards + 1 if config.delivery.use_workers else 1)
     # persistence... Uncomment the code below for persistence
     # persistence = PicklePersistence(filepath="data/districtbot_persistence.pkl")
     
     app = (ApplicationBuilder()
            .token(config.bot.token)
+           .base_url(config.bot.base_url)
            .defaults(defaults)
            .rate_limiter(rate_limiter)
         #    .persistence(persistence) # Uncomment for persistend
            .post_init(post_init)
+           .post_shutdown(post_shutdown)
+           .application_class(InstrumentedApplication)
            .build())
     
 
@@ -156,6 +229,7 @@ def start_bot() -> None:
             },
         fallbacks=[CommandHandler('cancel', cancel, filters=filters.ChatType.PRIVATE)],
         conversation_timeout=400,
+        name="channels",
     )
     
     conv_handler_feedback = ConversationHandler(
@@ -164,6 +238,7 @@ def start_bot() -> None:
             FEEDBACK: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_feedback)]
         },
         fallbacks=[CommandHandler("cancel", cancel, filters=filters.ChatType.PRIVATE)],
+        name="feedback",
     )
     
     conv_handler_news = ConversationHandler(
@@ -174,6 +249,7 @@ def start_bot() -> None:
         },
         fallbacks=[CommandHandler('cancel', cancel, filters=filters.ChatType.PRIVATE)],
         conversation_timeout=400,
+        name="news",
     )
     
     ##############################################
@@ -186,6 +262,10 @@ def start_bot() -> None:
     app.add_handler(CommandHandler('unsubscribe', unsubscribe, filters=filters.ChatType.PRIVATE))
     app.add_handler(CommandHandler('subscribe_channel', channel_updates, filters=filters.ChatType.PRIVATE))
     app.add_handler(CommandHandler('unsubscribe_channel', unchannel_update, filters=filters.ChatType.PRIVATE))
+    app.add_handler(CommandHandler('search', search, filters=filters.ChatType.PRIVATE))
+    app.add_handler(CommandHandler('filter', filter_command, filters=filters.ChatType.PRIVATE))
+    app.add_handler(CommandHandler('tags', tags_command, filters=filters.ChatType.PRIVATE))
+    app.add_handler(CallbackQueryHandler(search_page, pattern=r"^search:\d+:"))
     
     #############################
     #       Admin commands      #
@@ -204,15 +284,35 @@ def start_bot() -> None:
     app.add_handler(conv_handler_news)
     
     
+    # Bot blocked/unblocked by a user, removed from/added to a channel
+    app.add_handler(ChatMemberHandler(track_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+    if config.inline.enabled:
+        # @bot <query>, needs inline mode enabled with @BotFather (/setinline)
+        app.add_handler(InlineQueryHandler(inline_query))
+    
     # Ignoring all other messages
     app.add_handler(MessageHandler(filters.ALL & filters.ChatType.PRIVATE, ignore_all))
     
     # Register the global error handler
     app.add_error_handler(error_handler)
+    return app
+
+def start_bot() -> None:
+    """The main entry point for the bot."""
+    config.initialize()
+    # Initializing db
+    with startup.phase("init_db"):
+        init_db()
+    with startup.phase("build_application"):
+        app = build_application()
     
     logger.info("Starting bot...")
     app.run_polling(allowed_updates=Update.ALL_TYPES, timeout=config.bot.timeout)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Anime news bot")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Print import and startup timings once the bot is up")
+    parser.parse_args()
     logger.info("Script started")
     start_bot()
\ No newline at end of file
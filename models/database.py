@@ -1,7 +1,74 @@
-from sqlalchemy import create_engine
+import time
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import declarative_base, sessionmaker
 from config import config
+from utils.metrics import DB_QUERY_SECONDS
+from utils.tracing import add_db_time
 
 Base = declarative_base()
-db = create_engine(config.database.url, echo=config.settings.debug, future=True)
-SessionLocal = sessionmaker(bind=db, autoflush=False)
\ No newline at end of file
+db = create_engine(config.database.url, echo=config.database.echo, future=True)
+SessionLocal = sessionmaker(bind=db, autoflush=False)
+
+
+@event.listens_for(db, "before_cursor_execute")
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(db, "after_cursor_execute")
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    DB_QUERY_SECONDS.observe(elapsed, statement=statement.lstrip().split(None, 1)[0].upper())
+    add_db_time(elapsed)
+
+
+@event.listens_for(db, "handle_error")
+def _query_failed(context):
+    # No after_cursor_execute for a failed statement, drop its start time
+    started = context.connection.info.get("query_started") if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def upgrade_schema(engine=db) -> None:
+    """
+    Adds the columns and indexes that are missing from existing tables (create_all only
+    creates tables). New columns must be nullable or have a server default.
+    """
+    from sqlalchemy import inspect, text
+
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=engine.dialect)}'
+                if column.server_default is not None:
+                    # So the existing rows get the default rather than NULL
+                    default = column.server_default.arg
+                    if isinstance(default, str):
+                        default = "'" + default.replace("'", "''") + "'"
+                    else:
+                        default = default.compile(dialect=engine.dialect)
+                    ddl += f" DEFAULT {default}"
+                conn.execute(text(ddl))
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+
+
+def upsert_insert(session, model):
+    """ The dialect's INSERT for `model`, which has on_conflict_do_update/on_conflict_do_nothing """
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"No upsert support for {dialect}")
+    return insert(model)
@@ -0,0 +1,251 @@
+import json
+import zlib
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Tuple
+from sqlalchemy import String, Text, DateTime, Index, select, update, or_, and_
+from sqlalchemy.orm import Mapped, mapped_column, Session
+from sqlalchemy.sql import func
+from .database import Base, upsert_insert
+from config import config
+
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__, config.paths.log_path+"/models.log")
+
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+
+def shard_for(chat_id: int, shards: int) -> int:
+    """ Stable shard number of a chat id (the same in every process) """
+    if shards <= 1:
+        return 0
+    return zlib.crc32(str(chat_id).encode("utf-8")) % shards
+
+
+class DeliveryTask(Base):
+    """
+    A single outbound message waiting in the delivery outbox.
+
+    Attributes:
+        id (int): Auto increment id, also the delivery order.
+        chat_id (int): Target user or channel id.
+        shard (int): Worker shard the task belongs to, see `shard_for`.
+        payload (str): JSON encoded message, see `utils.delivery.deliver_payload`.
+        status (str): pending, sending, sent or failed.
+        attempts (int): Number of delivery attempts so far.
+        available_at (datetime): The task is not claimed before this time.
+        claimed_by (str): Id of the worker currently holding the task.
+        lease_until (datetime): When a `sending` task is considered abandoned.
+        error (str): Last delivery error.
+    """
+    __tablename__ = "delivery_outbox"
+    __table_args__ = (
+        Index("ix_delivery_outbox_claim", "shard", "status", "available_at"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    chat_id: Mapped[int] = mapped_column(nullable=False)
+    shard: Mapped[int] = mapped_column(default=0)
+    payload: Mapped[str] = mapped_column(Text, nullable=False)
+    status: Mapped[str] = mapped_column(String(10), default=PENDING)
+    attempts: Mapped[int] = mapped_column(default=0)
+    available_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    claimed_by: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    lease_until: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    created_at: Mapped[Optional[datetime]] = mapped_column(DateTime, server_default=func.now())
+    sent_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+    @property
+    def data(self) -> Dict:
+        return json.loads(self.payload)
+
+    @staticmethod
+    def enqueue(session: Session, messages: List[Tuple[int, Dict]], shards: int = 1) -> int:
+        """
+        Add (chat_id, payload) pairs to the outbox in one transaction.
+
+        Returns:
+            int: The number of queued tasks.
+        """
+        if not messages:
+            return 0
+        now = datetime.utcnow()
+        session.add_all([
+            DeliveryTask(
+                chat_id=chat_id,
+                shard=shard_for(chat_id, shards),
+                payload=json.dumps(payload),
+                available_at=now,
+            )
+            for chat_id, payload in messages
+        ])
+        session.commit()
+        return len(messages)
+
+    @staticmethod
+    def claim_batch(session: Session, shard: int, worker_id: str, limit: int, lease_secs: int) -> List["DeliveryTask"]:
+        """
+        Claim up to `limit` due tasks of a shard, including tasks whose lease expired
+        because their worker died mid-batch.
+        """
+        now = datetime.utcnow()
+        due = or_(
+            and_(DeliveryTask.status == PENDING, DeliveryTask.available_at <= now),
+            and_(DeliveryTask.status == SENDING, DeliveryTask.lease_until < now),
+        )
+        ids = session.execute(
+            select(DeliveryTask.id)
+            .where(DeliveryTask.shard == shard, due)
+            .order_by(DeliveryTask.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        ).scalars().all()
+        if not ids:
+            session.commit()
+            return []
+
+        session.execute(
+            update(DeliveryTask)
+            .where(DeliveryTask.id.in_(ids), due)
+            .values(status=SENDING, claimed_by=worker_id,
+                    lease_until=now + timedelta(seconds=lease_secs),
+                    attempts=DeliveryTask.attempts + 1)
+        )
+        session.commit()
+        return session.execute(
+            select(DeliveryTask)
+            .where(DeliveryTask.id.in_(ids), DeliveryTask.claimed_by == worker_id, DeliveryTask.status == SENDING)
+            .order_by(DeliveryTask.id)
+        ).scalars().all()
+
+    @staticmethod
+    def mark_sent(session: Session, task_ids: List[int]) -> None:
+        if not task_ids:
+            return
+        session.execute(
+            update(DeliveryTask)
+            .where(DeliveryTask.id.in_(task_ids))
+            .values(status=SENT, sent_at=datetime.utcnow(), lease_until=None, error=None)
+        )
+        session.commit()
+
+    @staticmethod
+    def mark_failed(session: Session, task_id: int, error: str, retry_in: Optional[int] = None) -> None:
+        """ Record a failed attempt. The task is retried after `retry_in` seconds, or given up if None. """
+        values = {"error": error[:1000], "lease_until": None, "claimed_by": None}
+        if retry_in is None:
+            values["status"] = FAILED
+        else:
+            values["status"] = PENDING
+            values["available_at"] = datetime.utcnow() + timedelta(seconds=retry_in)
+        session.execute(update(DeliveryTask).where(DeliveryTask.id == task_id).values(**values))
+        session.commit()
+
+    @staticmethod
+    def release(session: Session, task_ids: List[int], retry_in: int = 0) -> None:
+        """ Puts claimed tasks back unsent (not counted as an attempt), due in `retry_in` seconds """
+        if not task_ids:
+            return
+        session.execute(
+            update(DeliveryTask)
+            .where(DeliveryTask.id.in_(task_ids))
+            .values(status=PENDING, claimed_by=None, lease_until=None, attempts=DeliveryTask.attempts - 1,
+                    available_at=datetime.utcnow() + timedelta(seconds=retry_in))
+        )
+        session.commit()
+
+    @staticmethod
+    def pending_count(session: Session, shard: Optional[int] = None) -> int:
+        query = select(func.count()).select_from(DeliveryTask).where(DeliveryTask.status.in_((PENDING, SENDING)))
+        if shard is not None:
+            query = query.where(DeliveryTask.shard == shard)
+        return session.scalar(query) or 0
+
+    @staticmethod
+    def sent_per_day(session: Session, since: datetime) -> Dict[str, int]:
+        """ {"YYYY-MM-DD": messages sent} since `since` (only what is still in the outbox, see purge_finished) """
+        day = func.date(DeliveryTask.sent_at)
+        rows = session.execute(
+            select(day, func.count())
+            .where(DeliveryTask.status == SENT, DeliveryTask.sent_at >= since)
+            .group_by(day)
+        ).all()
+        return {str(date): count for date, count in rows}
+
+    @staticmethod
+    def purge_finished(session: Session, older_than: timedelta = timedelta(days=7)) -> int:
+        """ Delete sent/failed tasks older than `older_than` to keep the outbox small. """
+        cutoff = datetime.utcnow() - older_than
+        deleted = session.query(DeliveryTask).filter(
+            DeliveryTask.status.in_((SENT, FAILED)),
+            DeliveryTask.created_at < cutoff,
+        ).delete(synchronize_session=False)
+        session.commit()
+        return deleted
+
+    def __repr__(self) -> str:
+        return f"(Task:{self.id} Chat:{self.chat_id} Shard:{self.shard} Status:{self.status} Attempts:{self.attempts})"
+
+
+class SentMessage(Base):
+    """
+    Ledger of the news posts sent per article, so they can be edited in place when the
+    article changes (see utils/delivery.py). Digests are not recorded. Rows older than the
+    edit window are pruned.
+    """
+    __tablename__ = "sent_messages"
+
+    article_id: Mapped[str] = mapped_column(String(64), primary_key=True)  # NewsCache.id
+    chat_id: Mapped[int] = mapped_column(primary_key=True)
+    message_id: Mapped[int] = mapped_column(nullable=False)
+    kind: Mapped[str] = mapped_column(String(8))  # "photo" (caption) or "message" (text)
+    sent_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+    @staticmethod
+    def record(session: Session, sent: List[Tuple[str, int, int, str]]) -> None:
+        """ Adds (article_id, chat_id, message_id, kind) rows, the latest post per chat wins """
+        if not sent:
+            return
+        now = datetime.utcnow()
+        stmt = upsert_insert(session, SentMessage)
+        session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[SentMessage.article_id, SentMessage.chat_id],
+                set_={"message_id": stmt.excluded.message_id, "kind": stmt.excluded.kind,
+                      "sent_at": stmt.excluded.sent_at}),
+            [{"article_id": article_id, "chat_id": chat_id, "message_id": message_id, "kind": kind, "sent_at": now}
+             for article_id, chat_id, message_id, kind in sent],
+        )
+        session.commit()
+
+    @staticmethod
+    def get_for_articles(session: Session, article_ids: List[str], since: datetime) -> List[Tuple[str, int, int, str]]:
+        """ (article_id, chat_id, message_id, kind) of the posts of `article_ids` sent since `since` """
+        if not article_ids:
+            return []
+        return session.execute(
+            select(SentMessage.article_id, SentMessage.chat_id, SentMessage.message_id, SentMessage.kind)
+            .where(SentMessage.article_id.in_(article_ids), SentMessage.sent_at >= since)
+            .order_by(SentMessage.article_id, SentMessage.chat_id)
+        ).all()
+
+    @staticmethod
+    def forget(session: Session, posts: List[Tuple[str, int]]) -> int:
+        """ Drops the (article_id, chat_id) posts that can't be edited anymore """
+        deleted = 0
+        for article_id, chat_id in posts:
+            deleted += session.query(SentMessage).filter_by(article_id=article_id, chat_id=chat_id).delete()
+        session.commit()
+        return deleted
+
+    @staticmethod
+    def prune(session: Session, before: datetime) -> int:
+        """ Deletes the posts sent before `before`, too old to be edited """
+        deleted = session.query(SentMessage).filter(SentMessage.sent_at < before).delete(synchronize_session=False)
+        session.commit()
+        return deleted
@@ -1,9 +1,11 @@
-from sqlalchemy import String, Text, DateTime, desc, select
+import re
+from sqlalchemy import DDL, String, bindparam, Text, DateTime, and_, desc, event, insert, or_, select, text, update
 from sqlalchemy.orm import Mapped, mapped_column, Session
 from sqlalchemy.sql import func
-from .database import Base
+from .database import Base, upsert_insert
+from dataclasses import dataclass
 from hashlib import sha256
-from typing import Optional, List, Dict
+from typing import Iterable, Optional, List, Dict, Tuple
 from config import config
 
 from utils.logger import setup_logger
@@ -21,6 +23,8 @@ class NewsCache(Base):
     date: Mapped[Optional[str]] = mapped_column(String(50))
     image_url: Mapped[Optional[str]] = mapped_column(String(500), nullable=True)
     created_at: Mapped[DateTime] = mapped_column(DateTime, server_default=func.now())
+    telegraph_url: Mapped[Optional[str]] = mapped_column(String(500), nullable=True)  # Full text mirror, see utils/mirror.py
+    content_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)  # See `hash_content`
     
     @staticmethod
     def generate_id(link: str) -> str:
@@ -28,6 +32,10 @@ class NewsCache(Base):
 
     @staticmethod
     def cache_articles(session: Session, articles: List[Dict], max_cache: int = 3000) -> tuple:
+        """
+        Caches the parsed articles, returns (new count, new articles as `Article`s).
+        New articles are archived too, so the ones trimmed from the cache stay searchable.
+        """
         new_count = 0
         new_news = []
         for article in articles:
@@ -42,14 +50,17 @@ class NewsCache(Base):
                 link=article["link"],
                 date=article["date"],
                 image_url=article.get("image_url"),
+                content_hash=NewsCache.hash_content(article),
             )
             session.add(news)
-            new_news.append(article)
+            new_news.append(Article.from_dict(article, article_id))
             new_count += 1
 
+        NewsArchive.archive(session, new_news)
+        ArticleTag.add(session, {article.id: article.tags for article in new_news})
         session.commit()
         
-        # Trim old entries if over limit
+        # Trim old entries if over limit, they stay in the archive
         if max_cache:
             total = session.scalar(select(func.count()).select_from(NewsCache))
             if total and total > max_cache:
@@ -63,8 +74,284 @@ class NewsCache(Base):
         return new_count, new_news
     
     @staticmethod
-    def get_latest(session: Session, limit: int = 10) -> List["NewsCache"]:
+    def hash_content(article: Dict) -> str:
+        """ Hash of what a news post shows, changes when MAL edits the article """
+        content = "\x1f".join((article["title"], article.get("summary") or "", article.get("image_url") or ""))
+        return sha256(content.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def update_changed(session: Session, articles: List[Dict]) -> List["Article"]:
+        """
+        Updates the cached articles whose content changed since they were cached (and
+        their archived copy), returns them as `Article`s. Articles cached before content
+        hashes existed just get theirs.
+        """
+        parsed = {NewsCache.generate_id(article["link"]): article for article in articles}
+        if not parsed:
+            return []
+        rows = session.execute(select(NewsCache.id, NewsCache.content_hash).where(NewsCache.id.in_(list(parsed))))
+        changed, updates = [], []
+        for article_id, old_hash in rows:
+            article = parsed[article_id]
+            new_hash = NewsCache.hash_content(article)
+            if new_hash == old_hash:
+                continue
+            updates.append({"id": article_id, "title": article["title"], "summary": article["summary"],
+                            "date": article["date"], "image_url": article.get("image_url"), "content_hash": new_hash})
+            if old_hash is not None:
+                changed.append(Article.from_dict(article, article_id))
+        if not updates:
+            return []
+        session.execute(update(NewsCache), updates)
+        session.execute(
+            # Core statement: a bulk update by a non primary key column
+            update(NewsArchive.__table__)
+            .where(NewsArchive.__table__.c.article_id == bindparam("b_id"))
+            .values(title=bindparam("b_title"), summary=bindparam("b_summary"), image_url=bindparam("b_image_url")),
+            [{"b_id": row["id"], "b_title": row["title"], "b_summary": row["summary"], "b_image_url": row["image_url"]}
+             for row in updates],
+        )
+        ArticleTag.add(session, {article.id: article.tags for article in changed})
+        session.commit()
+        return changed
+
+    @staticmethod
+    def get_total_articles(session: Session) -> int:
+        return session.scalar(select(func.count()).select_from(NewsCache)) or 0
+    
+    @staticmethod
+    def get_latest(session: Session, limit: int = 10) -> List["Article"]:
+        rows = session.execute(
+            select(*ARTICLE_COLUMNS).order_by(NewsCache.created_at.desc()).limit(limit)
+        )
+        return [Article(*row) for row in rows]
+
+
+    @staticmethod
+    def get_telegraph_urls(session: Session, ids: List[str]) -> Dict[str, str]:
+        """ {id: telegraph_url} for the articles of `ids` that are mirrored already """
+        if not ids:
+            return {}
+        rows = session.execute(
+            select(NewsCache.id, NewsCache.telegraph_url)
+            .where(NewsCache.id.in_(ids), NewsCache.telegraph_url.is_not(None))
+        )
+        return dict(rows.all())
+
+    @staticmethod
+    def set_telegraph_urls(session: Session, urls: Dict[str, str]) -> None:
+        if not urls:
+            return
+        session.execute(
+            update(NewsCache),
+            [{"id": article_id, "telegraph_url": url} for article_id, url in urls.items()],
+        )
+        session.execute(
+            # Core statement: a bulk update by a non primary key column
+            update(NewsArchive.__table__)
+            .where(NewsArchive.__table__.c.article_id == bindparam("b_id"))
+            .values(telegraph_url=bindparam("b_url")),
+            [{"b_id": article_id, "b_url": url} for article_id, url in urls.items()],
+        )
+        session.commit()
+
+
+class NewsArchive(Base):
+    """
+    Every article we ever cached, `news_cache` only keeps the latest `max_cache`.
+
+    On SQLite, title and summary are indexed in the FTS5 table `news_search` (external
+    content, kept in sync by triggers on this table) for `search`.
+    """
+    __tablename__ = "news_archive"
+
+    id: Mapped[int] = mapped_column(primary_key=True)  # Also the rowid in news_search
+    article_id: Mapped[str] = mapped_column(String(64), unique=True)  # NewsCache.id
+    title: Mapped[str] = mapped_column(String(300))
+    summary: Mapped[Optional[str]] = mapped_column(Text)
+    link: Mapped[str] = mapped_column(String(500))
+    date: Mapped[Optional[str]] = mapped_column(String(50))
+    image_url: Mapped[Optional[str]] = mapped_column(String(500), nullable=True)
+    telegraph_url: Mapped[Optional[str]] = mapped_column(String(500), nullable=True)
+    created_at: Mapped[DateTime] = mapped_column(DateTime, server_default=func.now(), index=True)
+
+    @staticmethod
+    def archive(session: Session, articles: List["Article"]) -> None:
+        """ Adds the articles that are not archived yet (no commit) """
+        if not articles:
+            return
+        session.execute(
+            upsert_insert(session, NewsArchive).on_conflict_do_nothing(index_elements=[NewsArchive.article_id]),
+            [{"article_id": article.id, "title": article.title, "summary": article.summary, "link": article.link,
+              "date": article.date, "image_url": article.image_url, "telegraph_url": article.telegraph_url}
+             for article in articles],
+        )
+
+    @staticmethod
+    def backfill(session: Session) -> int:
+        """ Archives the cached articles from before the archive existed """
+        columns = ("title", "summary", "link", "date", "image_url", "telegraph_url", "created_at")
+        missing = (select(NewsCache.id, *(getattr(NewsCache, column) for column in columns))
+                   .where(NewsCache.id.not_in(select(NewsArchive.article_id)))
+                   .order_by(NewsCache.created_at))
+        result = session.execute(insert(NewsArchive).from_select(("article_id", *columns), missing))
+        session.commit()
+        return result.rowcount
+
+    @staticmethod
+    def search(session: Session, terms: str, limit: int = 10, offset: int = 0) -> List["Article"]:
+        """
+        Archived articles matching all the words of `terms` (stemmed: "movies" finds
+        "movie"), best matches first, title matches weighing more. Newest first without
+        FTS5 (not SQLite).
+        """
+        words = search_words(terms)
+        if not words:
+            return []
+        if session.get_bind().dialect.name == "sqlite":
+            query = " ".join(f'"{word}"' for word in words)
+            # Only the newest SEARCH_CANDIDATES matches are ranked: FTS5 returns them in rowid
+            # order and stops there, so a word found in half the archive costs no more
+            rows = session.execute(text(
+                "SELECT a.article_id, a.title, a.summary, a.link, a.date, a.image_url, a.telegraph_url "
+                "FROM (SELECT rowid, bm25(news_search, 5.0, 1.0) AS score FROM news_search "
+                "      WHERE news_search MATCH :query ORDER BY rowid DESC LIMIT :candidates) AS found "
+                "JOIN news_archive a ON a.id = found.rowid "
+                "ORDER BY found.score, a.id DESC LIMIT :limit OFFSET :offset"
+            ), {"query": query, "candidates": SEARCH_CANDIDATES, "limit": limit, "offset": offset})
+        else:
+            rows = session.execute(
+                select(*ARCHIVE_COLUMNS)
+                .where(and_(*(or_(NewsArchive.title.ilike(f"%{escape_like(word)}%", escape="\\"),
+                                  NewsArchive.summary.ilike(f"%{escape_like(word)}%", escape="\\"))
+                              for word in words)))
+                .order_by(NewsArchive.created_at.desc()).limit(limit).offset(offset))
+        return [Article(*row) for row in rows]
+
+    @staticmethod
+    def get_latest(session: Session, limit: int) -> List["Article"]:
+        rows = session.execute(select(*ARCHIVE_COLUMNS).order_by(NewsArchive.id.desc()).limit(limit))
+        return [Article(*row) for row in rows]
+
+    @staticmethod
+    def get_total_archived(session: Session) -> int:
+        return session.scalar(select(func.count()).select_from(NewsArchive)) or 0
+
+
+class ArticleTag(Base):
+    """
+    MAL categories of an article ("manga", "industry", "live_action"...), normalized by
+    `normalize_tag`. Kept with the archive, see `TagSubscription` for the routing.
+    """
+    __tablename__ = "article_tags"
+
+    article_id: Mapped[str] = mapped_column(String(64), primary_key=True)  # NewsCache.id
+    tag: Mapped[str] = mapped_column(String(50), primary_key=True, index=True)
+
+    @staticmethod
+    def add(session: Session, tags: Dict[str, Iterable[str]]) -> None:
+        """ Stores {article id: tags} (no commit) """
+        rows = [{"article_id": article_id, "tag": tag} for article_id, article_tags in tags.items()
+                for tag in set(article_tags)]
+        if rows:
+            session.execute(
+                upsert_insert(session, ArticleTag).on_conflict_do_nothing(
+                    index_elements=[ArticleTag.article_id, ArticleTag.tag]),
+                rows,
+            )
+
+    @staticmethod
+    def get_tags(session: Session, article_ids: List[str]) -> Dict[str, List[str]]:
+        """ {article id: sorted tags} for the articles of `article_ids` that have tags """
+        result: Dict[str, List[str]] = {}
+        if not article_ids:
+            return result
+        rows = session.execute(
+            select(ArticleTag.article_id, ArticleTag.tag)
+            .where(ArticleTag.article_id.in_(article_ids)).order_by(ArticleTag.tag))
+        for article_id, tag in rows:
+            result.setdefault(article_id, []).append(tag)
+        return result
+
+    @staticmethod
+    def get_popular(session: Session, limit: int = 20) -> List[Tuple[str, int]]:
+        """ (tag, articles) of the most used tags """
+        count = func.count().label("articles")
         return session.execute(
-            select(NewsCache).order_by(NewsCache.created_at.desc()).limit(limit)
-        ).scalars().all()
+            select(ArticleTag.tag, count).group_by(ArticleTag.tag).order_by(count.desc(), ArticleTag.tag).limit(limit)
+        ).all()
+
+
+# Matches ranked by a search (the newest ones), 50 pages of results
+SEARCH_CANDIDATES = 500
+
+
+def search_words(terms: str) -> List[str]:
+    """ The words of a search, without FTS5 syntax (quotes, operators) """
+    return re.findall(r"\w+", terms.lower())[:10]
+
+
+def escape_like(text: str) -> str:
+    """ `text` matched literally by LIKE (escape character: backslash) """
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def normalize_tag(text: str) -> str:
+    """ "Live-Action" -> "live_action", how tags are stored and subscribed to """
+    return "_".join(re.findall(r"\w+", text.lower()))[:50]
+
+
+# FTS5 index of the archive, created and dropped with the table (SQLite only)
+_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS news_search USING fts5("
+    "title, summary, content='news_archive', content_rowid='id', "
+    "tokenize='porter unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS news_archive_ai AFTER INSERT ON news_archive BEGIN "
+    "INSERT INTO news_search(rowid, title, summary) VALUES (new.id, new.title, new.summary); END",
+    "CREATE TRIGGER IF NOT EXISTS news_archive_ad AFTER DELETE ON news_archive BEGIN "
+    "INSERT INTO news_search(news_search, rowid, title, summary) VALUES ('delete', old.id, old.title, old.summary); END",
+    "CREATE TRIGGER IF NOT EXISTS news_archive_au AFTER UPDATE OF title, summary ON news_archive BEGIN "
+    "INSERT INTO news_search(news_search, rowid, title, summary) VALUES ('delete', old.id, old.title, old.summary); "
+    "INSERT INTO news_search(rowid, title, summary) VALUES (new.id, new.title, new.summary); END",
+)
+for _statement in _SEARCH_DDL:
+    event.listen(NewsArchive.__table__, "after_create", DDL(_statement).execute_if(dialect="sqlite"))
+event.listen(NewsArchive.__table__, "after_drop", DDL("DROP TABLE IF EXISTS news_search").execute_if(dialect="sqlite"))
+
+
+@dataclass(frozen=True, slots=True)
+class Article:
+    """
+    A cached article as menus, caches and the fan-out use it: read-only, no ORM state,
+    a fraction of the memory of a `NewsCache` instance.
+    """
+    id: str
+    title: str
+    summary: Optional[str]
+    link: str
+    date: Optional[str]
+    image_url: Optional[str] = None
+    telegraph_url: Optional[str] = None
+    tags: Tuple[str, ...] = ()  # Only set on freshly parsed articles, see `ArticleTag`
+
+    @classmethod
+    def from_dict(cls, article: Dict, article_id: Optional[str] = None) -> "Article":
+        """ From a dict of `extract_news_articles` """
+        return cls(
+            article_id or NewsCache.generate_id(article["link"]),
+            article["title"], article.get("summary"), article["link"],
+            article.get("date"), article.get("image_url"),
+            tags=tuple(article.get("tags") or ()),
+        )
+
+
+# Selected (in this order) to build `Article`s straight from rows
+ARTICLE_COLUMNS = (
+    NewsCache.id, NewsCache.title, NewsCache.summary, NewsCache.link,
+    NewsCache.date, NewsCache.image_url, NewsCache.telegraph_url,
+)
 
+ARCHIVE_COLUMNS = (
+    NewsArchive.article_id, NewsArchive.title, NewsArchive.summary, NewsArchive.link,
+    NewsArchive.date, NewsArchive.image_url, NewsArchive.telegraph_url,
+)
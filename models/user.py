@@ -1,9 +1,10 @@
-from typing import Optional, List
-from sqlalchemy import ForeignKey, DateTime, String, select
+import re
+from typing import Iterable, Optional, List, Dict, Set
+from sqlalchemy import ForeignKey, DateTime, String, select, insert, update, or_, not_, false, true
 from sqlalchemy.orm import mapped_column, relationship, Mapped, Session
 from sqlalchemy.sql import func
-from .database import Base
-from datetime import datetime
+from .database import Base, upsert_insert
+from datetime import datetime, timedelta
 from config import config
 
 from utils.logger import setup_logger
@@ -24,9 +25,11 @@ class User(Base):
         username (str): The Telegram username of the user.
         is_subscribed (bool): Whether the user is subscribed for news update.
         rate_tier (str): is the user a free or premium user of the service.
-        filters (dict): a dictionary of user filters to include.
+        filters: keywords and titles to include or exclude, see `UserFilter`.
         joined_at (datetime): Timestamp when the user joined the bot.
         language_code (str): User's language code.
+        is_active (bool): False once the user blocked the bot (kept up to date from
+            my_chat_member updates), they get no news until they unblock it.
     """
     
     __tablename__ = "users"
@@ -38,6 +41,7 @@ class User(Base):
     username: Mapped[str] = mapped_column(nullable=True)
     joined_at: Mapped[Optional[datetime]] = mapped_column(DateTime, default=func.now())
     language_code: Mapped[Optional[str]]
+    is_active: Mapped[bool] = mapped_column(default=True, server_default=true(), index=True)
     settings: Mapped["UserSettings"] = relationship("UserSettings", back_populates="user", uselist=False)
     
     @staticmethod
@@ -69,13 +73,49 @@ class User(Base):
         session.commit()
         return
     
+    @staticmethod
+    def register(session, user_data: Dict, commit: bool = True) -> bool:
+        """
+        Adds the user with default settings, or refreshes their profile if they exist.
+        Returns True for a new user. Two statements, one commit, no reads.
+        """
+        stmt = upsert_insert(session, User).values(**user_data)
+        profile = {key: stmt.excluded[key] for key in user_data if key != "id"}
+        session.execute(stmt.on_conflict_do_update(index_elements=[User.id], set_=profile))
+        # Only a new user gets a settings row, so it tells us whether the user is new
+        settings = (upsert_insert(session, UserSettings)
+                    .values(user_id=user_data["id"])
+                    .on_conflict_do_nothing(index_elements=[UserSettings.user_id])
+                    .returning(UserSettings.user_id))
+        created = session.execute(settings).first() is not None
+        if commit:
+            session.commit()
+        return created
+    
     @staticmethod
     def get_all_userIds(session) -> List:
         return [user.id for user in session.query(User.id).all()]
     
+    @staticmethod
+    def get_all_chatIds(session) -> List:
+        return session.query(User.chat_id).filter(User.is_active == True).all()
+    
+    @staticmethod
+    def set_active(session, user_ids: List[int], active: bool, commit: bool = True) -> int:
+        """ Marks users as (in)active, returns how many changed """
+        if not user_ids:
+            return 0
+        result = session.execute(
+            update(User)
+            .where(User.id.in_(user_ids), User.is_active.is_distinct_from(active))
+            .values(is_active=active))
+        if commit:
+            session.commit()
+        return result.rowcount
+
     @staticmethod
     def get_total_users(session) -> int:
-        return len(session.query(User.id).all())
+        return session.scalar(select(func.count(User.id))) or 0
     
     def __repr__(self) -> str:
         return f"({self.id}, {self.chat_id}) {self.first_name} {self.last_name} {self.username}"
@@ -100,8 +140,11 @@ class UserSettings(Base):
     
     @staticmethod
     def get_all_subscribed_users(session) -> List[int]:
-        """ Class method to get all subscribed users """
-        return [user.user_id for user in session.query(UserSettings.user_id).filter(UserSettings.is_subscribed == True).all()]
+        """ Class method to get all subscribed users (that did not block the bot) """
+        query = (select(UserSettings.user_id)
+                 .join(User, User.id == UserSettings.user_id)
+                 .where(UserSettings.is_subscribed == True, User.is_active == True))
+        return list(session.scalars(query))
     
     @staticmethod
     def get_all_opted_users(session) -> List[int]:
@@ -109,13 +152,44 @@ class UserSettings(Base):
         return [user.user_id for user in session.query(UserSettings.user_id).filter(UserSettings.opted_for_channel_updates == True).all()]
     
     @staticmethod
-    def create_or_get_user_settings(session, user_id: int):
-        user_settings = session.query(UserSettings).filter_by(user_id=user_id).first()
-        if not user_settings:
-            user_settings = UserSettings(user_id=user_id)  # default OFF notifications
-            session.add(user_settings)
+    def count_settings(session) -> Dict[str, int]:
+        """ Number of subscribed and channel opted users, in one query """
+        subscribed, opted = session.execute(select(
+            func.count().filter(UserSettings.is_subscribed == True),
+            func.count().filter(UserSettings.opted_for_channel_updates == True),
+        )).one()
+        return {"subscribed": subscribed or 0, "channel_opted": opted or 0}
+    
+    @staticmethod
+    def set_values(session, user_id: int, commit: bool = True, **values) -> bool:
+        """
+        Inserts or updates the user's settings (columns as keywords) in one statement.
+        Returns False if they already had these values, nothing is written then.
+        """
+        stmt = upsert_insert(session, UserSettings).values(user_id=user_id, **values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UserSettings.user_id],
+            set_={key: stmt.excluded[key] for key in values},
+            where=or_(*(getattr(UserSettings, key).is_distinct_from(stmt.excluded[key]) for key in values)),
+        ).returning(UserSettings.user_id)
+        changed = session.execute(stmt).first() is not None
+        if commit:
+            session.commit()
+        return changed
+    
+    @staticmethod
+    def toggle(session, user_id: int, field: str, commit: bool = True) -> bool:
+        """ Flips a boolean setting (True for a new row) in one statement, returns the new value """
+        column = getattr(UserSettings, field)
+        stmt = upsert_insert(session, UserSettings).values(user_id=user_id, **{field: True})
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UserSettings.user_id],
+            set_={field: not_(func.coalesce(column, false()))},
+        ).returning(column)
+        value = session.execute(stmt).scalar_one()
+        if commit:
             session.commit()
-        return user_settings
+        return bool(value)
     
     @staticmethod
     def update_user_settings(session, user_id: int,
@@ -123,24 +197,15 @@ class UserSettings(Base):
                              notifications: bool = None,
                              subscribed: bool = None,
                              opted_for_channel_updates: bool = None,) -> None:
-        user_settings = session.query(UserSettings).filter_by(user_id=user_id).first()
-        if user_settings:
-            # Update existing settings
-            if interval is not None:
-                user_settings.interval = interval
-            if notifications is not None:
-                user_settings.notifications_disabled = notifications
-            if subscribed is not None:
-                user_settings.is_subscribed = subscribed
-            if opted_for_channel_updates is not None:
-                user_settings.opted_for_channel_updates = opted_for_channel_updates
-            
-            session.add(user_settings)  # Mark as modified
-        else:
-            # Create new settings
-            user_settings: UserSettings = UserSettings(user_id=user_id, interval=interval, notifications_disabled=notifications, is_subscribed=subscribed)
-            session.add(user_settings)  # Add new settings
-        session.commit()
+        values = {
+            "interval": interval,
+            "notifications_disabled": notifications,
+            "is_subscribed": subscribed,
+            "opted_for_channel_updates": opted_for_channel_updates,
+        }
+        values = {key: value for key, value in values.items() if value is not None}
+        if values:
+            UserSettings.set_values(session, user_id, **values)
         return
     
     @staticmethod
@@ -155,21 +220,6 @@ class UserSettings(Base):
         except Exception as e:
             logger.exception(f"Something bad happened updating interval: {e}")
     
-    @staticmethod
-    def update_notifications_disabled(session, user_id: int, notification_in: bool) -> bool:
-        try:
-            user_settings = session.query(UserSettings).filter_by(user_id=user_id).first()
-            logger.debug(f"user settings: {user_settings}")
-            if user_settings:
-                user_settings.notifications_disabled = notification_in
-                session.commit()
-                logger.debug("notification setting updated")
-                return True
-            return False
-        except Exception as e:
-            session.rollback()
-            logger.exception(f"Failed to update notification setting for user {user_id}: {e}")
-            return False
 
 
 class Channel(Base):
@@ -182,6 +232,9 @@ class Channel(Base):
         username (str): Telegram username of the channel.
         added_by (int): ID of the user who added the channel.
         added_at (datetime): Timestamp when the channel was added.
+        is_active (bool): False while the bot can't post in the channel (removed, or no
+            more admin rights), kept up to date from my_chat_member updates.
+        checked_at (datetime): Last time the bot's rights were checked (utils/channels.py).
     """
     __tablename__ = "channels"
     
@@ -190,6 +243,8 @@ class Channel(Base):
     username: Mapped[str] = mapped_column(nullable=True)
     added_by: Mapped[int] = mapped_column(ForeignKey('users.id'), nullable=False)
     added_at: Mapped[Optional[datetime]] = mapped_column(DateTime, default=func.now())
+    is_active: Mapped[bool] = mapped_column(default=True, server_default=true(), index=True)
+    checked_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True, index=True)
     
     @staticmethod
     def add_channel(session, channel_id: int, name: str, username: (str | None), user_id: int) -> None:
@@ -263,6 +318,50 @@ class Channel(Base):
         statement = select(Channel)
         return session.scalars(statement).all()
     
+    @staticmethod
+    def get_news_channel_ids(session) -> List[int]:
+        """ Active channels of the users opted in for channel updates, in one query """
+        query = (select(Channel.id)
+                 .join(UserSettings, UserSettings.user_id == Channel.added_by)
+                 .where(UserSettings.opted_for_channel_updates == True, Channel.is_active == True))
+        return list(session.scalars(query))
+    
+    @staticmethod
+    def set_active(session, channel_ids: List[int], active: bool, commit: bool = True) -> int:
+        """ Marks channels as (in)active, returns how many changed """
+        if not channel_ids:
+            return 0
+        result = session.execute(
+            update(Channel)
+            .where(Channel.id.in_(channel_ids), Channel.is_active.is_distinct_from(active))
+            .values(is_active=active))
+        if commit:
+            session.commit()
+        return result.rowcount
+    
+    @staticmethod
+    def get_due_for_check(session, checked_before: datetime, limit: int) -> List[int]:
+        """ Channels not checked since `checked_before`, never checked ones first """
+        query = (select(Channel.id)
+                 .where(or_(Channel.checked_at.is_(None), Channel.checked_at < checked_before))
+                 .order_by(Channel.checked_at.is_not(None), Channel.checked_at)
+                 .limit(limit))
+        return list(session.scalars(query))
+    
+    @staticmethod
+    def record_checks(session, results: Dict[int, bool], checked_at: datetime) -> None:
+        """ Stores the result of permission checks: {channel id: bot can post} """
+        for active in (True, False):
+            ids = [channel_id for channel_id, can_post in results.items() if can_post is active]
+            if ids:
+                session.execute(update(Channel).where(Channel.id.in_(ids))
+                                .values(is_active=active, checked_at=checked_at))
+        session.commit()
+    
+    @staticmethod
+    def get_total_channels(session) -> int:
+        return session.scalar(select(func.count(Channel.id))) or 0
+    
     @staticmethod
     def delete_channel(session, channel_id: int) -> bool:
         """Delete a channel by its ID."""
@@ -284,17 +383,199 @@ class Channel(Base):
         return f"(ID:{self.id} Name:{self.name}) Username:{self.username} Added by:{self.added_by} Date added:{self.added_at}"
 
 
+class UserFilter(Base):
+    """
+    A keyword or anime title a user wants (include) or doesn't want (exclude) in their
+    news. Terms are stored normalized (see `normalize_term`). Users with include terms
+    only get the articles that match one of them, excluded terms always win.
+    """
+    __tablename__ = "user_filters"
+
+    user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), primary_key=True)
+    term: Mapped[str] = mapped_column(String(100), primary_key=True)
+    exclude: Mapped[bool] = mapped_column(default=False)
+
+    @staticmethod
+    def set_terms(session: Session, user_id: int, terms: Dict[str, bool]) -> int:
+        """ Adds or updates {term: exclude} for the user, returns the number of new terms """
+        if not terms:
+            return 0
+        existing = set(session.scalars(select(UserFilter.term).where(
+            UserFilter.user_id == user_id, UserFilter.term.in_(list(terms)))))
+        stmt = upsert_insert(session, UserFilter)
+        session.execute(
+            stmt.on_conflict_do_update(index_elements=[UserFilter.user_id, UserFilter.term],
+                                       set_={"exclude": stmt.excluded.exclude}),
+            [{"user_id": user_id, "term": term, "exclude": exclude} for term, exclude in terms.items()],
+        )
+        session.commit()
+        return len(set(terms) - existing)
+
+    @staticmethod
+    def remove_terms(session: Session, user_id: int, terms: List[str]) -> int:
+        deleted = (session.query(UserFilter)
+                   .filter(UserFilter.user_id == user_id, UserFilter.term.in_(terms))
+                   .delete(synchronize_session=False))
+        session.commit()
+        return deleted
+
+    @staticmethod
+    def get_user_filters(session: Session, user_id: int) -> List["UserFilter"]:
+        return session.scalars(select(UserFilter).where(UserFilter.user_id == user_id).order_by(UserFilter.term)).all()
+
+    @staticmethod
+    def get_all_filters(session: Session) -> List[tuple]:
+        """ (user_id, term, exclude) of every filter """
+        return session.execute(select(UserFilter.user_id, UserFilter.term, UserFilter.exclude)).all()
+
+
+def normalize_term(text: str) -> str:
+    """ Lowercase words separated by single spaces, how filter terms and articles are compared """
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+class TagSubscription(Base):
+    """
+    A MAL category (see `models.news.ArticleTag`) a user or channel subscribed to. Chats
+    with subscriptions only get the articles tagged with one of them, the others get all.
+    """
+    __tablename__ = "tag_subscriptions"
+
+    chat_id: Mapped[int] = mapped_column(primary_key=True)  # User or channel id
+    tag: Mapped[str] = mapped_column(String(50), primary_key=True, index=True)
+
+    @staticmethod
+    def add_tags(session: Session, chat_id: int, tags: List[str]) -> int:
+        """ Subscribes the chat to `tags`, returns the number of new subscriptions """
+        if not tags:
+            return 0
+        existing = set(session.scalars(select(TagSubscription.tag).where(
+            TagSubscription.chat_id == chat_id, TagSubscription.tag.in_(tags))))
+        session.execute(
+            upsert_insert(session, TagSubscription).on_conflict_do_nothing(
+                index_elements=[TagSubscription.chat_id, TagSubscription.tag]),
+            [{"chat_id": chat_id, "tag": tag} for tag in set(tags)],
+        )
+        session.commit()
+        return len(set(tags) - existing)
+
+    @staticmethod
+    def remove_tags(session: Session, chat_id: int, tags: List[str]) -> int:
+        deleted = (session.query(TagSubscription)
+                   .filter(TagSubscription.chat_id == chat_id, TagSubscription.tag.in_(tags))
+                   .delete(synchronize_session=False))
+        session.commit()
+        return deleted
+
+    @staticmethod
+    def get_chat_tags(session: Session, chat_id: int) -> List[str]:
+        return session.scalars(
+            select(TagSubscription.tag).where(TagSubscription.chat_id == chat_id).order_by(TagSubscription.tag)).all()
+
+    @staticmethod
+    def get_subscribers(session: Session, tags: Iterable[str]) -> Dict[str, Set[int]]:
+        """ {tag: chat ids} for `tags`, through the tag index """
+        tags = list(set(tags))
+        result: Dict[str, Set[int]] = {}
+        if not tags:
+            return result
+        rows = session.execute(select(TagSubscription.tag, TagSubscription.chat_id).where(TagSubscription.tag.in_(tags)))
+        for tag, chat_id in rows:
+            result.setdefault(tag, set()).add(chat_id)
+        return result
+
+    @staticmethod
+    def get_subscribed_chats(session: Session) -> Set[int]:
+        """ Chats with at least one subscription, the ones that don't get untagged news """
+        return set(session.scalars(select(TagSubscription.chat_id).distinct()))
+
+
 class SubscriptionLog(Base):
+    """
+    Append-only event log: subscriptions, channel opt-ins, mutes and delivery outcomes
+    (see utils/events.py for the actions). Written in batches by `utils.events.EVENTS`
+    and rolled up into `DailyEventCount`, which is what the stats read.
+    """
     __tablename__ = "subscription_log"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    tg_user_id: Mapped[int] = mapped_column(index=True)
-    action: Mapped[str] = mapped_column(String) # "subscribed", "unsubscribed"
-    timestamp: Mapped[Optional[datetime]] = mapped_column(DateTime, default=func.now())
+    tg_user_id: Mapped[int] = mapped_column(index=True)  # User or channel id
+    action: Mapped[str] = mapped_column(String) # "subscribed", "unsubscribed", "delivered"...
+    timestamp: Mapped[Optional[datetime]] = mapped_column(DateTime, default=func.now(), index=True)
     
     @staticmethod
     def log(session:Session, tg_user_id, action) -> None:
         log = SubscriptionLog(tg_user_id=tg_user_id, action=action)
         session.add(log)
         session.commit()
-        return
\ No newline at end of file
+        return
+    
+    @staticmethod
+    def log_many(session: Session, events: List[Dict]) -> None:
+        """ One batched INSERT for dicts of tg_user_id, action and timestamp """
+        if events:
+            session.execute(insert(SubscriptionLog), events)
+            session.commit()
+    
+    @staticmethod
+    def counts_per_day(session: Session, since: Optional[datetime] = None) -> Dict[str, Dict[str, int]]:
+        """ {"YYYY-MM-DD": {"subscribed": n, "unsubscribed": n}} since `since`, from the raw log """
+        day = func.date(SubscriptionLog.timestamp)
+        query = select(day, SubscriptionLog.action, func.count()).group_by(day, SubscriptionLog.action)
+        if since is not None:
+            query = query.where(SubscriptionLog.timestamp >= since)
+        result: Dict[str, Dict[str, int]] = {}
+        for date, action, count in session.execute(query).all():
+            result.setdefault(str(date), {})[action] = count
+        return result
+    
+    @staticmethod
+    def purge(session: Session, before: datetime) -> int:
+        """ Deletes raw events older than `before` (rolled up long ago) """
+        deleted = session.query(SubscriptionLog).filter(SubscriptionLog.timestamp < before).delete(synchronize_session=False)
+        session.commit()
+        return deleted
+
+
+class DailyEventCount(Base):
+    """ Events per day and action, rolled up from `SubscriptionLog` """
+    __tablename__ = "daily_event_counts"
+
+    day: Mapped[str] = mapped_column(String(10), primary_key=True)  # YYYY-MM-DD (UTC)
+    action: Mapped[str] = mapped_column(String(32), primary_key=True)
+    count: Mapped[int] = mapped_column(default=0)
+    
+    @staticmethod
+    def rollup(session: Session) -> int:
+        """
+        Recounts the days from the day before the last rolled up one (events of a day can
+        arrive a bit after midnight) or all days on the first run. Returns the rows written.
+        """
+        last_day = session.scalar(select(func.max(DailyEventCount.day)))
+        since = datetime.strptime(last_day, "%Y-%m-%d") - timedelta(days=1) if last_day else None
+        rows = [
+            {"day": day, "action": action, "count": count}
+            for day, counts in SubscriptionLog.counts_per_day(session, since).items()
+            for action, count in counts.items()
+        ]
+        if rows:
+            stmt = upsert_insert(session, DailyEventCount)
+            session.execute(
+                stmt.on_conflict_do_update(index_elements=[DailyEventCount.day, DailyEventCount.action],
+                                           set_={"count": stmt.excluded.count}),
+                rows,
+            )
+        session.commit()
+        return len(rows)
+    
+    @staticmethod
+    def counts_per_day(session: Session, since: datetime) -> Dict[str, Dict[str, int]]:
+        """ {"YYYY-MM-DD": {action: n}} since `since`, as of the last rollup """
+        rows = session.execute(
+            select(DailyEventCount.day, DailyEventCount.action, DailyEventCount.count)
+            .where(DailyEventCount.day >= since.strftime("%Y-%m-%d"))
+        ).all()
+        result: Dict[str, Dict[str, int]] = {}
+        for day, action, count in rows:
+            result.setdefault(day, {})[action] = count
+        return result
@@ -0,0 +1,13 @@
+import os
+import tempfile
+
+# `config` is read from the environment on import: give the tests a throwaway setup
+_workdir = tempfile.mkdtemp(prefix="animenewsbot-tests-")
+os.environ.setdefault("BOT__TOKEN", "123456:test")
+os.environ.setdefault("BOT__OWNER_ID", "1")
+os.environ.setdefault("BOT__USERNAME", "test_bot")
+os.environ.setdefault("BOT__LOG_CHANNEL_ID", "0")
+os.environ.setdefault("DATABASE__URL", f"sqlite:///{os.path.join(_workdir, 'test.db')}")
+os.environ.setdefault("SETTINGS__DEBUG", "false")
+os.environ.setdefault("LOGGING__LOG_TO_CONSOLE", "false")
+os.environ.setdefault("PATHS__LOG_PATH", os.path.join(_workdir, "logs"))
@@ -1 +1,161 @@
 # Test Handlers 
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from config import config
+from models.database import Base, SessionLocal, db, upgrade_schema
+from models.user import Channel, TagSubscription, User, UserFilter, UserSettings
+
+
+@pytest.fixture
+def database():
+    Base.metadata.create_all(db)
+    upgrade_schema(db)
+    yield
+    with SessionLocal() as session:
+        session.query(Channel).delete()
+        session.query(UserFilter).delete()
+        session.query(TagSubscription).delete()
+        session.query(UserSettings).delete()
+        session.query(User).delete()
+        session.commit()
+
+
+class Bot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return SimpleNamespace(message_id=len(self.sent))
+
+
+def test_parse_alert_cooldown(monkeypatch):
+    from handlers.command_handlers import alert_parse_failure
+
+    monkeypatch.setattr(config.bot, "log_channel_id", -1)
+    context = SimpleNamespace(bot=Bot(), bot_data={})
+    for _ in range(3):
+        asyncio.run(alert_parse_failure(context, True, 0, ["no articles parsed"]))
+    assert len(context.bot.sent) == 1
+    assert context.bot_data["parse_alerts_suppressed"] == 2
+    # Once the cooldown is over, with the count of the polls not alerted
+    context.bot_data["parse_alert_at"] -= config.settings.parse_alert_interval
+    asyncio.run(alert_parse_failure(context, True, 0, ["no articles parsed"]))
+    assert len(context.bot.sent) == 2 and "failed polls not alerted" in context.bot.sent[1][1]
+
+
+class Message:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def _update(user_id=1):
+    message = Message()
+    return SimpleNamespace(message=message, effective_message=message,
+                           effective_user=SimpleNamespace(id=user_id)), message
+
+
+def test_add_channel_without_bot_rights():
+    from telegram.error import BadRequest
+    from const import ADMIN_CHECK_FAILURE
+    from handlers.conversation_handlers import _process_channel
+    from models.database import SessionLocal
+
+    class ChannelBot:
+        id = 42
+
+        async def get_chat_member(self, chat_id, user_id):
+            if user_id == self.id:
+                return SimpleNamespace(status="member")
+            raise BadRequest("User not found")
+
+    update, message = _update()
+    channel = SimpleNamespace(id=-1001, title="Channel", username="channel")
+    with SessionLocal() as session:
+        asyncio.run(_process_channel(session, update, SimpleNamespace(bot=ChannelBot(), user_data={}), channel, 1))
+    # Same answer as when the lookups ran one after the other
+    assert message.replies == [ADMIN_CHECK_FAILURE]
+
+
+def test_search_pages_keep_their_query():
+    from handlers.command_handlers import search_ref
+
+    user_data = {}
+    assert search_ref("One Piece, movie!", user_data) == "one piece movie" and user_data == {}
+    # Too long for callback_data: kept under a key, each search its own
+    first = search_ref(" ".join(["shingeki no kyojin final season"] * 3), user_data)
+    second = search_ref(" ".join(["kimetsu no yaiba hashira training"] * 3), user_data)
+    assert first.startswith("#") and first != second
+    assert len(f"search:9999:{first}".encode()) <= 64
+    assert user_data["searches"][first].startswith("shingeki")
+
+
+def test_filter_limit_counts_new_terms(monkeypatch, database):
+    from handlers import command_handlers
+    from handlers.command_handlers import filter_command
+
+    monkeypatch.setattr(command_handlers, "MAX_FILTERS", 2)
+    for args in (["add", "one", "piece,", "frieren"], ["add", "-one", "piece,", "frieren"], ["add", "naruto"]):
+        update, message = _update(user_id=50)
+        asyncio.run(filter_command(update, SimpleNamespace(args=args)))
+    # Re-adding or flipping a filter fits, a third one doesn't
+    assert [reply.split()[0] for reply in message.replies] == ["You"]
+    with SessionLocal() as session:
+        assert {f.term: f.exclude for f in UserFilter.get_user_filters(session, 50)} == {"one piece": True, "frieren": False}
+
+
+def test_tags_for_a_registered_channel(database):
+    from handlers.command_handlers import tags_command
+    from handlers.conversation_handlers import _process_channel
+
+    class ChannelBot:
+        id = 42
+
+        async def get_chat_member(self, chat_id, user_id):
+            if user_id == self.id:
+                return SimpleNamespace(status="administrator", can_post_messages=True)
+            return SimpleNamespace(status="administrator")
+
+    update, message = _update(user_id=60)
+    channel = SimpleNamespace(id=-1060, title="Manga News", username="thatchannel")
+    with SessionLocal() as session:
+        asyncio.run(_process_channel(session, update, SimpleNamespace(bot=ChannelBot(), user_data={}), channel, 60))
+    assert "added successfully" in message.replies[-1]
+
+    update, message = _update(user_id=60)
+    asyncio.run(tags_command(update, SimpleNamespace(args=["@thatchannel", "add", "manga"])))
+    assert message.replies == ["✅ 1 tag(s) added."]
+    with SessionLocal() as session:
+        assert TagSubscription.get_chat_tags(session, -1060) == ["manga"]
+
+
+def test_broadcast_skips_unreachable_chats(monkeypatch, database):
+    from telegram.error import BadRequest, Forbidden
+    from handlers.command_handlers import broadcast
+
+    class BroadcastBot(Bot):
+        async def send_message(self, chat_id, text, **kwargs):
+            if chat_id == 72:
+                raise Forbidden("Forbidden: bot was blocked by the user")
+            if chat_id == 73:
+                raise BadRequest("Message is too long")
+            return await super().send_message(chat_id, text, **kwargs)
+
+    monkeypatch.setattr(config.bot, "log_channel_id", -1)
+    with SessionLocal() as session:
+        for user_id in (71, 72, 73, 74):
+            User.register(session, {"id": user_id, "chat_id": user_id, "first_name": "Some", "username": None})
+    update, message = _update()
+    context = SimpleNamespace(bot=BroadcastBot(), bot_data={}, args=["Hello"])
+    asyncio.run(broadcast.__wrapped__(update, context))
+    # The broadcast went on past the bad chat, without alerting about the blocked user
+    assert [chat_id for chat_id, _ in context.bot.sent] == [71, 74]
+    assert "Failed:</b> 2" in message.replies[-1]
+    with SessionLocal() as session:
+        assert sorted(chat_id for chat_id, in User.get_all_chatIds(session)) == [71, 73, 74]
@@ -0,0 +1,380 @@
+# Test Models
+import asyncio
+
+import pytest
+
+from models.database import Base, SessionLocal, db, upgrade_schema
+from models.user import Channel, DailyEventCount, SubscriptionLog, TagSubscription, User, UserFilter, UserSettings
+
+
+@pytest.fixture(autouse=True)
+def database():
+    Base.metadata.create_all(db)
+    upgrade_schema(db)
+    yield
+    with SessionLocal() as session:
+        session.query(Channel).delete()
+        session.query(UserFilter).delete()
+        session.query(TagSubscription).delete()
+        session.query(UserSettings).delete()
+        session.query(SubscriptionLog).delete()
+        session.query(DailyEventCount).delete()
+        session.query(User).delete()
+        session.commit()
+
+
+def _user(user_id, username="someone"):
+    return {"id": user_id, "chat_id": user_id, "first_name": "Some", "last_name": None,
+            "username": username, "language_code": "en"}
+
+
+def test_register_is_an_upsert():
+    with SessionLocal() as session:
+        assert User.register(session, _user(1)) is True
+        assert User.register(session, _user(1, username="renamed")) is False
+        assert session.get(User, 1).username == "renamed"
+        settings = UserSettings.get_user_settings(session, 1)
+        assert settings.is_subscribed is False and settings.notifications_disabled is False
+
+
+def test_set_values_reports_changes():
+    with SessionLocal() as session:
+        User.register(session, _user(2))
+        assert UserSettings.set_values(session, 2, is_subscribed=True) is True
+        assert UserSettings.set_values(session, 2, is_subscribed=True) is False
+        # No settings row yet: inserted
+        assert UserSettings.set_values(session, 3, opted_for_channel_updates=True) is True
+        session.expire_all()
+        assert UserSettings.get_user_settings(session, 2).is_subscribed is True
+        assert UserSettings.get_user_settings(session, 3).opted_for_channel_updates is True
+
+
+def test_toggle():
+    with SessionLocal() as session:
+        assert UserSettings.toggle(session, 4, "notifications_disabled") is True  # New row
+        assert UserSettings.toggle(session, 4, "notifications_disabled") is False
+        assert UserSettings.toggle(session, 4, "notifications_disabled") is True
+
+
+def test_write_behind_group_commit():
+    from utils.write_behind import WriteBehind
+
+    def failing(session):
+        raise ValueError("bad op")
+
+    errors = []
+
+    async def on_error(e):
+        errors.append(e)
+
+    async def run():
+        writes = WriteBehind(interval=0.05, max_batch=1000)
+        for i in range(20):
+            writes.defer(lambda session, i=i: User.register(session, _user(100 + i), commit=False), on_error)
+        writes.defer(failing, on_error)
+        # Committed with the deferred ones, the failing one does not take them down
+        results = await asyncio.gather(
+            writes.submit(lambda session: UserSettings.toggle(session, 100, "is_subscribed", commit=False)),
+            writes.submit(failing), return_exceptions=True)
+        await writes.close()
+        return results
+
+    subscribed, error = asyncio.run(run())
+    assert subscribed is True
+    assert isinstance(error, ValueError)
+    assert [str(e) for e in errors] == ["bad op"]  # Only the failing deferred op
+    with SessionLocal() as session:
+        assert User.get_total_users(session) == 20
+
+
+def test_events_are_written_in_batches_and_rolled_up():
+    from datetime import datetime, timedelta
+    from utils.events import EventRecorder, SUBSCRIBED, DELIVERED
+
+    async def run():
+        recorder = EventRecorder(flush_interval=60, batch_size=10, max_pending=1000)
+        for i in range(10):
+            recorder.record(i, DELIVERED)
+        await asyncio.sleep(0.1)  # batch_size reached: flushed without waiting for the interval
+        written = len(recorder._pending) == 0
+        recorder.record(1, SUBSCRIBED)
+        await recorder.close()
+        return written
+
+    assert asyncio.run(run()) is True
+    with SessionLocal() as session:
+        assert session.query(SubscriptionLog).count() == 11
+        assert DailyEventCount.rollup(session) == 2
+        # Rolling up again recounts the recent days instead of adding to them
+        assert DailyEventCount.rollup(session) == 2
+        today = datetime.utcnow().strftime("%Y-%m-%d")
+        counts = DailyEventCount.counts_per_day(session, datetime.utcnow() - timedelta(days=1))
+        assert counts[today] == {DELIVERED: 10, SUBSCRIBED: 1}
+
+
+def test_inactive_chats_get_no_news():
+    from handlers.command_handlers import get_news_chat_ids
+
+    with SessionLocal() as session:
+        for user_id in (10, 11):
+            User.register(session, _user(user_id))
+            UserSettings.set_values(session, user_id, is_subscribed=True, opted_for_channel_updates=True)
+        session.add_all([Channel(id=-100, name="Kept", added_by=10), Channel(id=-101, name="Removed", added_by=11)])
+        session.commit()
+        assert sorted(get_news_chat_ids(session)) == [-101, -100, 10, 11]
+
+        assert User.set_active(session, [11], False) == 1
+        assert User.set_active(session, [11], False) == 0  # Already inactive
+        assert Channel.set_active(session, [-101], False) == 1
+        assert sorted(get_news_chat_ids(session)) == [-100, 10]
+        assert User.get_all_chatIds(session) == [(10,)]
+
+        Channel.set_active(session, [-101], True)
+        assert sorted(get_news_chat_ids(session)) == [-101, -100, 10]
+
+
+def test_chat_member_reachability():
+    from datetime import datetime
+    from telegram import Chat, ChatMemberAdministrator, ChatMemberBanned, ChatMemberMember, ChatMemberUpdated
+    from telegram import User as TelegramUser
+    from handlers.message_handlers import is_reachable
+
+    bot = TelegramUser(id=42, first_name="Bot", is_bot=True)
+    old = ChatMemberMember(user=bot)
+
+    def updated(chat_type, new):
+        chat = Chat(id=-100 if chat_type != Chat.PRIVATE else 1, type=chat_type)
+        return ChatMemberUpdated(chat=chat, from_user=bot, date=datetime.now(), old_chat_member=old,
+                                 new_chat_member=new)
+
+    def admin(can_post):
+        return ChatMemberAdministrator(
+            user=bot, can_be_edited=False, is_anonymous=False, can_manage_chat=True, can_delete_messages=True,
+            can_manage_video_chats=False, can_restrict_members=False, can_promote_members=False,
+            can_change_info=False, can_invite_users=False, can_post_stories=False, can_edit_stories=False,
+            can_delete_stories=False, can_post_messages=can_post)
+
+    assert is_reachable(updated(Chat.PRIVATE, ChatMemberMember(user=bot))) is True
+    assert is_reachable(updated(Chat.PRIVATE, ChatMemberBanned(user=bot, until_date=None))) is False
+    assert is_reachable(updated(Chat.CHANNEL, admin(True))) is True
+    assert is_reachable(updated(Chat.CHANNEL, admin(False))) is False
+    assert is_reachable(updated(Chat.CHANNEL, ChatMemberMember(user=bot))) is False
+
+
+def test_channel_revalidation_sweep():
+    from types import SimpleNamespace
+    from telegram.error import Forbidden, NetworkError
+    from utils.channels import revalidate_channels
+
+    class Bot:
+        id = 42
+        calls = []
+
+        async def get_chat_member(self, chat_id, user_id, rate_limit_args=None):
+            self.calls.append(chat_id)
+            if chat_id == -201:
+                raise Forbidden("Forbidden: bot was kicked from the channel chat")
+            if chat_id == -202:
+                raise NetworkError("timed out")
+            return SimpleNamespace(status="administrator", can_post_messages=chat_id != -203)
+
+    with SessionLocal() as session:
+        User.register(session, _user(20))
+        session.add_all([Channel(id=-200 - i, name=f"C{i}", added_by=20) for i in range(4)])
+        session.commit()
+
+    bot = Bot()
+    # Spread over the day: one sweep only checks its share
+    results = asyncio.run(revalidate_channels(bot))
+    assert len(bot.calls) == 1
+    results.update(asyncio.run(revalidate_channels(bot, limit=10)))
+    assert results == {-200: True, -201: False, -203: False}  # -202 could not be checked
+    with SessionLocal() as session:
+        assert sorted(Channel.get_news_channel_ids(session)) == []  # Not opted in
+        UserSettings.set_values(session, 20, opted_for_channel_updates=True)
+        assert sorted(Channel.get_news_channel_ids(session)) == [-202, -200]
+    # Checked ones are cached until their TTL, the failed one is retried
+    bot.calls.clear()
+    asyncio.run(revalidate_channels(bot, limit=10))
+    assert bot.calls == [-202]
+
+
+def test_archive_search():
+    from sqlalchemy import select
+    from models.news import NewsArchive, NewsCache, escape_like
+
+    titles = ["One Piece movie announced", "Frieren season 2 trailer", "One Piece anime gets a new trailer",
+              "Spy x Family movies"]
+    articles = [{"title": title, "summary": f"Summary {i}", "link": f"https://myanimelist.net/news/search{i}",
+                 "date": "Oct 1"} for i, title in enumerate(titles)]
+    with SessionLocal() as session:
+        session.query(NewsArchive).delete()
+        session.query(NewsCache).delete()
+        session.commit()
+        NewsCache.cache_articles(session, articles, max_cache=2)
+        # Trimmed from the cache, still archived and searchable
+        assert NewsCache.get_total_articles(session) == 2
+        assert NewsArchive.get_total_archived(session) == 4
+        assert {a.title for a in NewsArchive.search(session, "one piece")} == {titles[0], titles[2]}
+        assert [a.title for a in NewsArchive.search(session, "MOVIE")] == [titles[3], titles[0]]  # Stemmed, newest first
+        pages = [NewsArchive.search(session, "trailer", limit=1, offset=offset) for offset in (0, 1, 2)]
+        assert {page[0].title for page in pages[:2]} == {titles[1], titles[2]} and pages[2] == []
+        assert NewsArchive.search(session, '" OR *') == []
+        # Matched literally without FTS5 too
+        like = select(NewsArchive.title).where(NewsArchive.title.ilike(f"%{escape_like('_')}%", escape="\\"))
+        assert session.execute(like).all() == []
+
+        # The index follows updates and deletes
+        session.query(NewsArchive).filter_by(link=articles[1]["link"]).update({"title": "Frieren season 2 date"})
+        session.commit()
+        assert [a.title for a in NewsArchive.search(session, "trailer")] == [titles[2]]
+        session.query(NewsArchive).filter_by(link=articles[2]["link"]).delete()
+        session.commit()
+        assert NewsArchive.search(session, "trailer") == []
+
+
+def test_user_filters():
+    from models.user import normalize_term
+
+    assert normalize_term("  One-Piece:  EGGHEAD! ") == "one piece egghead"
+    with SessionLocal() as session:
+        User.register(session, _user(30))
+        assert UserFilter.set_terms(session, 30, {"one piece": False, "live action": True}) == 2
+        assert UserFilter.set_terms(session, 30, {"one piece": True}) == 0  # Updated
+        assert [(f.term, f.exclude) for f in UserFilter.get_user_filters(session, 30)] == [
+            ("live action", True), ("one piece", True)]
+        assert UserFilter.remove_terms(session, 30, ["one piece", "unknown"]) == 1
+
+
+def test_tag_subscriptions():
+    from models.news import ArticleTag, NewsArchive, NewsCache, normalize_tag
+    from utils.delivery import build_news_payloads
+    from utils.filters import TagRouter
+
+    assert normalize_tag(" Live-Action ") == "live_action"
+    articles = [{"title": f"Article {i}", "summary": "", "link": f"https://myanimelist.net/news/tag{i}",
+                 "date": "Oct 1", "tags": tags}
+                for i, tags in enumerate([["manga", "industry"], ["live_action"], []])]
+    with SessionLocal() as session:
+        session.query(NewsArchive).delete()
+        session.query(NewsCache).delete()
+        session.query(ArticleTag).delete()
+        session.query(TagSubscription).delete()
+        session.commit()
+        _, news = NewsCache.cache_articles(session, articles)
+        assert ArticleTag.get_tags(session, [article.id for article in news]) == {
+            news[0].id: ["industry", "manga"], news[1].id: ["live_action"]}
+        assert ArticleTag.get_popular(session, 1) == [("industry", 1)]
+
+        assert TagSubscription.add_tags(session, 1, ["manga", "music"]) == 2
+        assert TagSubscription.add_tags(session, 1, ["manga"]) == 0
+        assert TagSubscription.add_tags(session, -100, ["live_action"]) == 1
+        assert TagSubscription.remove_tags(session, 1, ["music", "unknown"]) == 1
+        assert TagSubscription.get_chat_tags(session, 1) == ["manga"]
+        assert TagSubscription.get_subscribers(session, ["manga", "live_action", "music"]) == {
+            "manga": {1}, "live_action": {-100}}
+
+    router = TagRouter.load(news)
+    assert router.restricted == {1, -100}
+    assert router.blocked(news[0]) == {-100} and router.blocked(news[2]) == {1, -100}
+    sent = {}
+    for chat_id, payload in build_news_payloads(news, [1, 2, -100, -200], tags=router):
+        sent.setdefault(chat_id, []).append(payload["link"][-1])
+    assert sent == {-100: ["1"], -200: ["0", "1", "2"], 1: ["0"], 2: ["0", "1", "2"]}
+
+
+def test_changed_articles_edit_their_posts():
+    from datetime import datetime, timedelta
+    from telegram.error import BadRequest
+    from models.delivery import SentMessage
+    from models.news import NewsArchive, NewsCache
+    from utils.delivery import edit_article_posts, prune_sent_messages
+
+    class Bot:
+        edits = []
+
+        async def edit_message_caption(self, chat_id, message_id, caption, reply_markup=None, rate_limit_args=None):
+            if message_id == 13:
+                raise BadRequest("Message to edit not found")
+            self.edits.append((chat_id, message_id, caption))
+
+        async def edit_message_text(self, text, chat_id, message_id, reply_markup=None, rate_limit_args=None):
+            self.edits.append((chat_id, message_id, text))
+
+    articles = [{"title": f"Article {i}", "summary": "Old", "link": f"https://myanimelist.net/news/edit{i}",
+                 "date": "Oct 1", "image_url": "https://cdn.myanimelist.net/1.jpg" if i == 0 else None}
+                for i in range(2)]
+    with SessionLocal() as session:
+        session.query(NewsArchive).delete()
+        session.query(NewsCache).delete()
+        session.query(SentMessage).delete()
+        session.commit()
+        _, news = NewsCache.cache_articles(session, articles)
+        assert NewsCache.update_changed(session, articles) == []
+        SentMessage.record(session, [(news[0].id, 1, 11, "photo"), (news[0].id, 2, 12, "photo"),
+                                     (news[0].id, 3, 13, "photo"), (news[1].id, 1, 14, "message")])
+        # Outside of the edit window
+        session.query(SentMessage).filter_by(chat_id=2).update({"sent_at": datetime.utcnow() - timedelta(days=3)})
+        session.commit()
+
+        articles[0]["summary"] = "Updated"
+        changed = NewsCache.update_changed(session, articles)
+        assert [article.summary for article in changed] == ["Updated"]
+        assert NewsArchive.search(session, "updated")[0].id == news[0].id
+        assert NewsCache.update_changed(session, articles) == []
+
+    bot = Bot()
+    assert asyncio.run(edit_article_posts(bot, changed)) == 1
+    assert bot.edits == [(1, 11, "<b>Article 0</b>\n\n<i>Updated</i>")]
+    with SessionLocal() as session:
+        # The deleted post is forgotten
+        assert {chat_id for _, chat_id, _, _ in SentMessage.get_for_articles(
+            session, [news[0].id], datetime.utcnow() - timedelta(days=7))} == {1, 2}
+    assert prune_sent_messages() == 1
+
+
+def test_worker_keeps_chat_order():
+    from types import SimpleNamespace
+    from telegram.error import NetworkError
+    from models.delivery import DeliveryTask, PENDING, SENT
+    from worker import process_batch
+
+    class Bot:
+        sent = []
+
+        async def send_message(self, chat_id, text, reply_markup=None, rate_limit_args=None):
+            # The first message of each chat is the slowest
+            await asyncio.sleep(0.05 if text.endswith("0") else 0)
+            if text == "2-0":
+                raise NetworkError("timed out")
+            self.sent.append(text)
+            return SimpleNamespace(message_id=len(self.sent))
+
+    with SessionLocal() as session:
+        session.query(DeliveryTask).delete()
+        session.commit()
+        DeliveryTask.enqueue(session, [(chat_id, {"kind": "message", "text": f"{chat_id}-{i}"})
+                                       for i in range(3) for chat_id in (1, 2)])
+    bot = Bot()
+    assert asyncio.run(process_batch(bot, 0, "test")) == 6
+    assert [text for text in bot.sent if text.startswith("1-")] == ["1-0", "1-1", "1-2"]
+    assert not [text for text in bot.sent if text.startswith("2-")]  # Held behind the failed one
+    with SessionLocal() as session:
+        tasks = session.query(DeliveryTask).order_by(DeliveryTask.id).all()
+        assert [(task.chat_id, task.status, task.attempts) for task in tasks if task.chat_id == 2] == [
+            (2, PENDING, 1), (2, PENDING, 0), (2, PENDING, 0)]
+        assert {task.status for task in tasks if task.chat_id == 1} == {SENT}
+        session.query(DeliveryTask).delete()
+        session.commit()
+
+
+def test_failed_query_does_not_leak_timings():
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+
+    with db.connect() as conn:
+        with pytest.raises(OperationalError):
+            conn.execute(text("SELECT * FROM no_such_table"))
+        assert conn.info.get("query_started") == []
+        conn.execute(text("SELECT 1"))
+        assert conn.info["query_started"] == []
@@ -1 +1,412 @@
-# Test Utilities 
+# Test Utilities
+import time
+
+import pytest
+
+from benchmarks.corpus import corpus_pages, load_page
+from utils.helpers import check_articles, extract_news_articles, get_clean_image_url
+
+# Per page, best of a few runs. A MAL page parses in ~20ms on a laptop, this leaves room for slow CI
+PARSE_BUDGET_SECONDS = 0.25
+
+PAGES = corpus_pages()
+
+
+def test_corpus_not_empty():
+    assert PAGES, "tests/fixtures/mal has no pages, see python -m benchmarks.corpus"
+
+
+@pytest.mark.parametrize("name", PAGES)
+def test_corpus_extraction(name):
+    page, expected = load_page(name)
+    assert expected is not None, f"{name} has no expected articles, run python -m benchmarks.corpus update"
+    assert extract_news_articles(page) == expected
+
+
+@pytest.mark.parametrize("name", PAGES)
+def test_corpus_health_check(name):
+    page, _ = load_page(name)
+    assert check_articles(extract_news_articles(page)) == []
+
+
+@pytest.mark.parametrize("name", PAGES)
+def test_corpus_parse_time(name):
+    page, _ = load_page(name)
+    timings = []
+    for _ in range(3):
+        started = time.perf_counter()
+        extract_news_articles(page)
+        timings.append(time.perf_counter() - started)
+    assert min(timings) < PARSE_BUDGET_SECONDS
+
+
+def test_health_check_no_articles():
+    assert check_articles(extract_news_articles("<html><body><div class='news-list'></div></body></html>")) \
+        == ["no articles parsed"]
+
+
+def test_health_check_markup_change():
+    # Same page with the title renamed and relative links: parses, but the output is wrong
+    page, _ = load_page(PAGES[0])
+    page = page.replace('class="title"', 'class="headline"')
+    assert check_articles(extract_news_articles(page)) == ["no articles parsed"]
+
+    articles = [{"title": "A title", "summary": "", "link": "/news/1", "date": "", "image_url": None}]
+    problems = check_articles(articles)
+    assert "article 0: unexpected link '/news/1'" in problems
+    assert "summary missing from every article" in problems
+    assert "date missing from every article" in problems
+    assert "image_url missing from every article" in problems
+
+
+def test_title_without_link_is_skipped():
+    page = """<div class="news-unit"><p class="title">No link</p></div>
+    <div class="news-unit"><p class="title"><a href="https://myanimelist.net/news/1">Linked</a></p></div>"""
+    assert [a["title"] for a in extract_news_articles(page)] == ["Linked"]
+
+
+def test_get_clean_image_url():
+    assert get_clean_image_url("https://cdn.myanimelist.net/r/100x156/s/common/uploaded_files/1.jpg?s=abc") \
+        == "https://cdn.myanimelist.net/s/common/uploaded_files/1.jpg"
+
+
+def _image_bytes(size, mode="RGBA"):
+    from io import BytesIO
+    from PIL import Image
+    output = BytesIO()
+    Image.effect_noise(size, 64).convert(mode).save(output, "PNG")
+    return output.getvalue()
+
+
+def test_normalize_image():
+    from io import BytesIO
+    from PIL import Image
+    from utils.media import normalize_image
+
+    data = normalize_image(_image_bytes((3000, 1500)), max_dimension=1280, max_bytes=200 * 1024)
+    assert len(data) <= 200 * 1024
+    with Image.open(BytesIO(data)) as image:
+        assert image.format == "JPEG" and image.size == (1280, 640)
+
+
+def test_media_cache_dedup_and_eviction(tmp_path):
+    import os
+    from utils.media import MediaCache
+
+    cache = MediaCache(str(tmp_path), max_bytes=10 ** 9)
+    image = _image_bytes((200, 200))
+    first = cache._store("https://cdn.example/a.jpg", image)
+    # Same content under another URL shares the file
+    assert cache._store("https://cdn.example/b.jpg", image) == first
+    assert cache.path("https://cdn.example/b.jpg") == first
+
+    cache.max_bytes = os.path.getsize(first) + 1
+    os.utime(first, (0, 0))  # Least recently used
+    second = cache._store("https://cdn.example/c.jpg", _image_bytes((300, 300)))
+    assert not os.path.exists(first)
+    assert cache.path("https://cdn.example/a.jpg") is None
+    assert cache.path("https://cdn.example/c.jpg") == second
+
+
+def test_media_cache_concurrent_stores(tmp_path):
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+    from utils.media import MediaCache
+
+    cache = MediaCache(str(tmp_path), max_bytes=10 ** 9)
+    images = {f"https://cdn.example/{size}.jpg": _image_bytes((size, size)) for size in range(100, 140)}
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda item: cache._store(*item), images.items()))
+    assert set(cache._index) == set(images)
+    files = [entry for entry in os.scandir(tmp_path) if entry.name != "index.json"]
+    assert cache._total == sum(entry.stat().st_size for entry in files)
+
+
+ARTICLE_PAGE = """<html><body><div class="news-container">
+<h1 class="title"><a href="/news/1">Sequel Announced</a></h1>
+<div class="content clearfix">
+  <p>The <b>sequel</b> was <span>announced</span> today.</p>
+  <h2>Staff</h2>
+  <img class="userimg" data-src="https://cdn.myanimelist.net/images/1.jpg" src="/img/placeholder.gif">
+  <script>track()</script>
+  <table><tr><td><a href="/anime/1">Anime</a></td></tr></table>
+</div></div></body></html>"""
+
+
+def test_extract_article_content():
+    from utils.mirror import extract_article_content
+
+    title, nodes = extract_article_content(ARTICLE_PAGE, "https://myanimelist.net/news/1")
+    assert title == "Sequel Announced"
+    assert nodes == [
+        {"tag": "p", "children": ["The ", {"tag": "b", "children": ["sequel"]}, " was ", "announced", " today."]},
+        {"tag": "h3", "children": ["Staff"]},
+        {"tag": "img", "attrs": {"src": "https://cdn.myanimelist.net/images/1.jpg"}},
+        {"tag": "a", "attrs": {"href": "https://myanimelist.net/anime/1"}, "children": ["Anime"]},
+    ]
+
+
+def test_mirror_articles_once():
+    import asyncio
+    from models.database import Base, SessionLocal, db, upgrade_schema
+    from models.news import Article, NewsCache
+    from utils.mirror import LocalTelegraph, mirror_articles
+
+    Base.metadata.create_all(db)
+    upgrade_schema(db)
+    articles = [{"title": f"Article {i}", "summary": "", "link": f"https://myanimelist.net/news/{i}",
+                 "date": "", "image_url": None} for i in range(5)]
+    with SessionLocal() as session:
+        _, articles = NewsCache.cache_articles(session, articles)
+    assert all(isinstance(article, Article) for article in articles)
+
+    fetched = []
+
+    async def fetch(url):
+        fetched.append(url)
+        return ARTICLE_PAGE
+
+    publisher = LocalTelegraph()
+    urls = asyncio.run(mirror_articles(articles, publisher, fetch))
+    assert len(urls) == len(publisher.pages) == 5
+    with SessionLocal() as session:
+        assert NewsCache.get_telegraph_urls(session, list(urls)) == urls
+    # Mirrors are kept, nothing is fetched again
+    assert asyncio.run(mirror_articles(articles, publisher, fetch)) == {}
+    assert len(fetched) == 5
+
+
+def test_upgrade_schema_adds_columns(tmp_path):
+    from sqlalchemy import create_engine, inspect, text
+    from models.database import Base, upgrade_schema
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE news_cache (id VARCHAR PRIMARY KEY, title VARCHAR(300))"))
+    upgrade_schema(engine)
+    columns = {column["name"] for column in inspect(engine).get_columns("news_cache")}
+    assert {"telegraph_url", "image_url", "created_at"} <= columns
+    assert not inspect(engine).has_table("users")  # Only existing tables are upgraded
+
+    # Existing rows get the server default of a new column
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE channels (id INTEGER PRIMARY KEY, name VARCHAR, added_by INTEGER)"))
+        conn.execute(text("INSERT INTO channels VALUES (-100, 'Old', 1)"))
+    upgrade_schema(engine)
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT is_active FROM channels")).scalar() == 1
+    assert "ix_channels_is_active" in {index["name"] for index in inspect(engine).get_indexes("channels")}
+
+
+def test_get_latest_returns_articles():
+    import dataclasses
+    from models.database import Base, SessionLocal, db, upgrade_schema
+    from models.news import Article, NewsCache
+
+    Base.metadata.create_all(db)
+    upgrade_schema(db)
+    parsed = {"title": "Latest", "summary": "S", "link": "https://myanimelist.net/news/99",
+              "date": "Oct 1", "image_url": "https://cdn.myanimelist.net/99.jpg"}
+    with SessionLocal() as session:
+        NewsCache.cache_articles(session, [parsed])
+        latest = {article.link: article for article in NewsCache.get_latest(session, 50)}
+    article = latest[parsed["link"]]
+    assert article == Article.from_dict(parsed)
+    assert not hasattr(article, "__dict__")
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        article.title = "Changed"
+
+
+def test_inline_index():
+    from models.news import Article
+    from utils.inline import NewsIndex, build_inline_result
+
+    def article(i, title, summary=""):
+        return Article(f"id{i}", title, summary, f"https://myanimelist.net/news/{i}", "Oct 1",
+                       image_url=f"https://cdn.myanimelist.net/{i}.jpg")
+
+    index = NewsIndex(cache_size=2)
+    index.load([
+        article(0, "Frieren season 2 trailer", "New visual for One Piece fans too"),
+        article(1, "One Piece movie announced"),
+        article(2, "Spy x Family season 3", "From the studio behind One Piece"),
+        article(3, "One Punch Man delayed"),
+    ])
+    titles = lambda articles: [a.title for a in articles]
+    # Prefixes, title matches before summary matches, newest first
+    assert titles(index.search("one pi")[0]) == ["One Piece movie announced", "Frieren season 2 trailer",
+                                                 "Spy x Family season 3"]
+    assert titles(index.search("SEASON")[0]) == ["Frieren season 2 trailer", "Spy x Family season 3"]
+    assert index.search("naruto") == ([], False)
+    # Empty query: the latest articles, paginated
+    page, more = index.search("", offset=0, limit=3)
+    assert len(page) == 3 and more
+    page, more = index.search("", offset=3, limit=3)
+    assert titles(page) == ["One Punch Man delayed"] and not more
+    assert len(index._snapshot.matches) == 2  # Oldest query evicted
+    # A reload starts from a fresh cache, queries never mix old and new articles
+    index.load([article(4, "One Piece chapter break")])
+    assert titles(index.search("one pi")[0]) == ["One Piece chapter break"]
+
+    result = build_inline_result(article(5, "A <b> title", "Summary & more"))
+    assert result.thumbnail_url.endswith("5.jpg")
+    assert "&lt;b&gt;" in result.input_message_content.message_text
+    assert result.reply_markup.inline_keyboard[0][0].url == "https://myanimelist.net/news/5"
+
+
+def test_aho_corasick():
+    from utils.filters import AhoCorasick
+
+    automaton = AhoCorasick(["he", "she", "his", "hers"])
+    assert {automaton.patterns[i] for i in automaton.find("ushers")} == {"she", "he", "hers"}
+    assert automaton.find("xyz") == set()
+    assert AhoCorasick([]).find("anything") == set()
+
+
+def test_filter_routing():
+    from models.news import Article
+    from utils.delivery import build_news_payloads
+    from utils.filters import FilterRouter
+
+    news = [Article(f"id{i}", title, "Summary", f"https://myanimelist.net/news/{i}", "Oct 1")
+            for i, title in enumerate(["One Piece: Egghead arc", "Someone live action news", "Frieren season 2"])]
+    router = FilterRouter([
+        (1, "one piece", False),   # Only One Piece
+        (2, "live action", True),  # Everything but live action
+        (3, "frieren", False), (3, "one piece", False), (3, "season", True),
+    ])
+    assert 1 not in router.blocked(news[0]) and 1 in router.blocked(news[1])  # "someone" is not "one"
+    assert 2 in router.blocked(news[1]) and 2 not in router.blocked(news[2])
+    assert 3 in router.blocked(news[2])  # Excluded term wins over the include
+
+    messages = build_news_payloads(news, [1, 2, 3, 4, -100], router)
+    sent = {}
+    for chat_id, payload in messages:
+        sent.setdefault(chat_id, []).append(payload["link"][-1])
+    assert sent == {-100: ["0", "1", "2"], 1: ["0"], 2: ["0", "2"], 3: ["0"], 4: ["0", "1", "2"]}
+
+
+def test_rate_limiter_lane_floors():
+    from utils.rate_limiter import LANES, MemoryBucketStore, SharedRateLimiter, _refill
+
+    reserves = {"interactive": 0.2, "alert": 0.1, "news": 0.1}
+    limiter = SharedRateLimiter(MemoryBucketStore(), overall_max_rate=30, lane_reserves=reserves)
+    assert [limiter._floors[lane] for lane in LANES] == pytest.approx([0, 6, 9, 12])
+    # A bucket of 1 token (many memory backed shards): every lane can take it when full
+    for rate in (1, 2):
+        limiter = SharedRateLimiter(MemoryBucketStore(), overall_max_rate=rate, lane_reserves=reserves)
+        for floor in limiter._floors.values():
+            assert floor <= rate - 1
+            assert _refill(None, 0, 1000, rate, rate, floor)[1] == 0
+
+
+def test_interactive_preempts_news():
+    import asyncio
+    from utils.rate_limiter import LANE_NEWS, MemoryBucketStore, SharedRateLimiter
+
+    limiter = SharedRateLimiter(MemoryBucketStore(), overall_max_rate=10, overall_time_period=100,
+                                lane_reserves={"interactive": 0.5})
+    sent = []
+
+    async def send(lane):
+        async def callback():
+            sent.append(lane)
+        args = {"lane": lane} if lane else None
+        await limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": 1}, args)
+
+    async def main():
+        # News drains the bucket down to the interactive reserve, then waits
+        news = asyncio.gather(*(send(LANE_NEWS) for _ in range(6)))
+        await asyncio.sleep(0.05)
+        assert sent.count(LANE_NEWS) == 5
+        # A reply still goes out at once
+        await asyncio.wait_for(send(None), 1)
+        assert sent[-1] is None
+        news.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await news
+
+    asyncio.run(main())
+
+
+def test_sqlite_bucket_store_is_shared(tmp_path):
+    import threading
+    from utils.rate_limiter import SQLiteBucketStore
+
+    # Two stores on one file, as the bot and a worker process would have
+    path = str(tmp_path / "buckets.sqlite")
+    bot, worker = SQLiteBucketStore(path), SQLiteBucketStore(path)
+    taken = [store.acquire("overall", 0.001, 4) for store in (bot, worker, bot, worker)]
+    assert taken == [0, 0, 0, 0]
+    assert worker.acquire("overall", 0.001, 4) > 0 and bot.acquire("overall", 0.001, 4) > 0
+
+    # A shorter 429 elsewhere doesn't shorten the pause
+    now = time.time()
+    bot.pause_until(now + 60)
+    worker.pause_until(now + 5)
+    assert bot.paused_until() == worker.paused_until() == now + 60
+
+    # The connections of other threads are closed too
+    thread = threading.Thread(target=bot.paused_until)
+    thread.start()
+    thread.join()
+    conns = list(bot._conns)
+    assert len(conns) == 2
+    bot.close()
+    worker.close()
+    for conn in conns:
+        with pytest.raises(Exception):
+            conn.execute("SELECT 1")
+
+
+def test_callback_labels_are_bounded(monkeypatch):
+    from telegram import CallbackQuery, Update, User
+    from utils import metrics
+
+    monkeypatch.setattr(metrics, "_seen_callbacks", set())
+    monkeypatch.setattr(metrics, "MAX_CALLBACK_LABELS", 2)
+
+    def label(data):
+        query = CallbackQuery("1", User(1, "Someone", False), "chat", data=data)
+        return metrics.update_command(Update(1, callback_query=query))
+
+    assert label("search:2:one piece") == label("search:3:#0a1b2c") == "callback:search"
+    assert label("settings_menu") == "callback:settings"
+    assert label("other_button") == "callback:other"  # Over the cap
+    assert label("search:1:naruto") == "callback:search"
+
+
+def test_log_rate_limit_filter(monkeypatch):
+    import logging
+    from utils import logger as log
+
+    monkeypatch.setitem(log._stats, "rate_limited", 0)
+    limit = log.RateLimitFilter(per_second=2)
+
+    def record(level=logging.INFO, created=100.0, lineno=1):
+        entry = logging.LogRecord("test", level, "test.py", lineno, "msg", None, None)
+        entry.created = created
+        return entry
+
+    assert [limit.filter(record()) for _ in range(3)] == [True, True, False]
+    assert limit.filter(record(lineno=2))  # Another call site
+    assert limit.filter(record(logging.WARNING))
+    assert limit.filter(record(created=101.0))  # Next second
+    assert log._stats["rate_limited"] == 1
+
+
+def test_log_queue_drops_when_full(monkeypatch):
+    import logging
+    import queue
+    from utils import logger as log
+    from utils.metrics import render_metrics
+
+    monkeypatch.setattr(log, "_listener", object())  # No writer thread, the queue stays full
+    monkeypatch.setattr(log, "_stats", {"queued": 0, "dropped": 0, "rate_limited": 0, "enqueue_seconds": 0.0})
+    handler = log._RoutedQueueHandler(queue.Queue(maxsize=1), "test.log", False)
+    for _ in range(3):
+        handler.handle(logging.LogRecord("test", logging.INFO, "test.py", 1, "msg", None, None))
+    assert log._stats["queued"] == 1 and log._stats["dropped"] == 2
+    metrics = render_metrics()
+    assert 'animenews_log_records_total{result="dropped"} 2' in metrics
+    assert "# TYPE animenews_log_records_total counter" in metrics
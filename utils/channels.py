@@ -0,0 +1,87 @@
+"""
+Background check that the bot can still post in the registered channels.
+
+my_chat_member updates (handlers/message_handlers.py) catch most changes as they happen,
+this sweep catches the ones we missed (bot down, rights changed without an update). Each
+sweep checks the channels whose last check is older than `check_ttl_hours`, but only its
+share of them (total * sweep_interval / ttl), so the checks are spread over the day
+instead of bursting. The calls go through the broadcast lane of the rate limiter, the
+lowest one, so they never take budget from replies or the news.
+"""
+import asyncio
+import math
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from telegram import ChatMember
+from telegram.ext import ContextTypes, ExtBot
+
+from config import config
+from models.database import SessionLocal
+from models.user import Channel
+from utils.delivery import is_gone_error
+from utils.logger import setup_logger
+from utils.metrics import CHANNEL_CHECKS
+from utils.rate_limiter import LANE_BROADCAST
+
+logger = setup_logger(__name__, config.paths.log_path+"/utils.log")
+
+
+def can_post(member: ChatMember) -> bool:
+    return member.status == ChatMember.ADMINISTRATOR and bool(getattr(member, "can_post_messages", False))
+
+
+async def check_channel(bot: ExtBot, channel_id: int) -> Optional[bool]:
+    """ Whether the bot can post in the channel, None if we could not tell (retried next sweep) """
+    try:
+        member = await bot.get_chat_member(chat_id=channel_id, user_id=bot.id,
+                                           rate_limit_args={"lane": LANE_BROADCAST})
+    except Exception as e:
+        if is_gone_error(e):
+            CHANNEL_CHECKS.inc(result="lost")
+            return False
+        CHANNEL_CHECKS.inc(result="error")
+        logger.warning(f"Could not check channel {channel_id}: {e}")
+        return None
+    allowed = can_post(member)
+    CHANNEL_CHECKS.inc(result="ok" if allowed else "lost")
+    return allowed
+
+
+async def revalidate_channels(bot: ExtBot, limit: Optional[int] = None) -> Dict[int, bool]:
+    """
+    Checks the channels that are due, `concurrency` at a time, and (de)activates them.
+    Returns {channel id: bot can post} for the channels that could be checked.
+    """
+    ttl = timedelta(hours=config.channels.check_ttl_hours)
+    now = datetime.utcnow()
+    with SessionLocal() as session:
+        if limit is None:
+            total = Channel.get_total_channels(session)
+            limit = max(1, math.ceil(total * config.channels.sweep_interval / ttl.total_seconds()))
+        due = Channel.get_due_for_check(session, now - ttl, limit)
+    if not due:
+        return {}
+
+    semaphore = asyncio.Semaphore(config.channels.concurrency)
+
+    async def check(channel_id: int) -> Optional[bool]:
+        async with semaphore:
+            return await check_channel(bot, channel_id)
+
+    checked = await asyncio.gather(*(check(channel_id) for channel_id in due))
+    results = {channel_id: allowed for channel_id, allowed in zip(due, checked) if allowed is not None}
+    with SessionLocal() as session:
+        Channel.record_checks(session, results, now)
+    lost = [channel_id for channel_id, allowed in results.items() if not allowed]
+    if lost:
+        logger.warning(f"Lost posting rights in {len(lost)} channel(s), disabled: {lost}")
+    logger.info(f"Checked {len(results)}/{len(due)} channel(s).")
+    return results
+
+
+async def revalidate_channels_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await revalidate_channels(context.bot)
+    except Exception as e:
+        logger.exception(f"Channel revalidation failed: {e}")
@@ -1,4 +1,7 @@
+import asyncio
+import time
 from functools import wraps
+from typing import Dict, Optional, Tuple
 from telegram import Update
 from telegram.ext import ContextTypes
 from telegram.constants import ChatAction
@@ -8,8 +11,33 @@ from utils.logger import setup_logger
 
 logger = setup_logger(__name__, "./data/logs/utils.log")
 
-def send_action(action):
-    """Sends `action` while processing func command.
+# Telegram shows a chat action for 5 seconds or until the next message arrives
+CHAT_ACTION_DURATION = 5
+_last_chat_action: Dict[Tuple[int, str], float] = {}
+
+
+async def _keep_chat_action(bot, chat_id: int, action: str, delay: float) -> None:
+    """ Shows `action` after `delay` seconds and refreshes it until cancelled. """
+    await asyncio.sleep(delay)
+    while True:
+        now = time.monotonic()
+        key = (chat_id, action)
+        # Another handler in this chat already shows it
+        if now - _last_chat_action.get(key, 0) >= CHAT_ACTION_DURATION:
+            _last_chat_action[key] = now
+            if len(_last_chat_action) > 1024:
+                for k, sent_at in list(_last_chat_action.items()):
+                    if now - sent_at >= CHAT_ACTION_DURATION:
+                        del _last_chat_action[k]
+            try:
+                await bot.send_chat_action(chat_id=chat_id, action=action)
+            except Exception as e:
+                logger.debug(f"Could not send chat action to {chat_id}: {e}")
+        await asyncio.sleep(CHAT_ACTION_DURATION)
+
+
+def send_action(action, delay: Optional[float] = None):
+    """Shows `action` while processing func command, if it takes long enough for the user to notice.
     You can decorate handler callbacks directly with @send_action(ChatAction.<Action>) or create aliases and decorate with them (more readable) .
 
     send_typing_action = send_action(ChatAction.TYPING)
@@ -25,13 +53,24 @@ def send_action(action):
     @send_action(ChatAction.TYPING)
     async def my_handler(update, context):
         pass  # user will see 'typing' while your bot is handling the request.
+
+    The action is sent in the background, only once the handler has been running for
+    `delay` seconds (`config.settings.chat_action_delay` by default), and at most once per
+    chat every 5 seconds. Fast handlers never send it. Don't use it on bulk paths.
     """
 
     def decorator(func):
         @wraps(func)
         async def command_func(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-            await context.bot.send_chat_action(chat_id=update.effective_message.chat_id, action=action)
-            return await func(update, context,  *args, **kwargs)
+            chat = update.effective_chat
+            if chat is None:
+                return await func(update, context, *args, **kwargs)
+            wait = config.settings.chat_action_delay if delay is None else delay
+            task = asyncio.create_task(_keep_chat_action(context.bot, chat.id, action, wait))
+            try:
+                return await func(update, context,  *args, **kwargs)
+            finally:
+                task.cancel()
         return command_func
     
     return decorator
@@ -0,0 +1,289 @@
+import asyncio
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterable, List, Dict, Optional, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Message
+from telegram.error import Forbidden, BadRequest, RetryAfter
+from telegram.ext import ContextTypes, ExtBot
+
+from config import config
+from models.database import SessionLocal
+from models.delivery import DeliveryTask, SentMessage
+from models.news import Article
+from models.user import Channel, User
+from utils.events import EVENTS, DELIVERED
+from utils.filters import FilterRouter, TagRouter
+from utils.logger import setup_logger
+from utils.media import MEDIA, is_fetch_error
+from utils.metrics import EDITS
+from utils.rate_limiter import LANE_BROADCAST
+
+logger = setup_logger(__name__, config.paths.log_path+"/utils.log")
+
+# Users get a single headline digest instead of one post per article from this many articles on
+DIGEST_THRESHOLD = 5
+
+
+def build_news_payloads(news: List[Article], chat_ids: List[int], router: Optional[FilterRouter] = None,
+                        tags: Optional[TagRouter] = None) -> List[Tuple[int, Dict]]:
+    """
+    Turns new articles into (chat_id, payload) pairs, in sending order.
+
+    Chats get the articles their tag subscriptions (`tags`) and, for users, keyword filters
+    (`router`) let through, all of them without routers. Channels (negative ids) get one
+    post per article. Users get one post per article, or a single digest of clickable
+    headlines if there are many articles.
+    """
+    if not news:
+        return []
+
+    article_payloads = [article_payload(article) for article in news]
+
+    digests: Dict[Tuple[int, ...], Dict] = {}
+
+    def digest_payload(indexes: Tuple[int, ...]) -> Dict:
+        # One digest per distinct set of articles, most users share the same one
+        if indexes not in digests:
+            headlines_text = "<b>Latest News:</b>\n\n"
+            for i in indexes:
+                headlines_text += f"- <a href='{news[i].link}'>{news[i].title}</a>\n"
+            digests[indexes] = {"kind": "message", "text": headlines_text}
+        return digests[indexes]
+
+    # Chats each article must skip, a few set operations per article whatever the number of chats
+    blocked = None
+    if router or tags:
+        blocked = [(router.blocked(article) if router else set()) | (tags.blocked(article) if tags else set())
+                   for article in news]
+        if not any(blocked):
+            blocked = None
+    everything = tuple(range(len(news)))
+
+    def allowed(chat_id: int) -> Tuple[int, ...]:
+        if blocked is None:
+            return everything
+        return tuple(i for i in everything if chat_id not in blocked[i])
+
+    messages = []
+    # Channels first, as before
+    for chat_id in chat_ids:
+        if chat_id < 0:
+            messages.extend((chat_id, article_payloads[i]) for i in allowed(chat_id))
+
+    for chat_id in chat_ids:
+        if chat_id > 0:
+            indexes = allowed(chat_id)
+            if not indexes:
+                continue
+            if len(indexes) < DIGEST_THRESHOLD:
+                messages.extend((chat_id, article_payloads[i]) for i in indexes)
+            else:
+                messages.append((chat_id, digest_payload(indexes)))
+    return messages
+
+
+def article_text(article: Article) -> str:
+    return f"<b>{article.title}</b>\n\n<i>{article.summary}</i>"
+
+
+def article_payload(article: Article) -> Dict:
+    """ The post of a single article, a photo with a caption if it has an image """
+    if article.image_url:
+        return {
+            "kind": "photo",
+            "photo": article.image_url,
+            "caption": article_text(article),
+            "link": article.link,
+            "article_id": article.id,
+        }
+    return {
+        "kind": "message",
+        "text": article_text(article),
+        "link": article.link,
+        "article_id": article.id,
+    }
+
+
+def read_more_keyboard(link: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📜 Read More", url=link)]
+    ])
+
+
+async def deliver_payload(bot: ExtBot, chat_id: int, payload: Dict, rate_limit_args: Optional[Dict] = None) -> Message:
+    """
+    Sends a single payload built by `build_news_payloads` (or a broadcast). Errors are
+    raised, the caller records DELIVERY_FAILED once it stops retrying.
+    """
+    keyboard = read_more_keyboard(payload["link"]) if payload.get("link") else None
+
+    if payload["kind"] == "photo":
+        message = await send_photo(bot, chat_id, payload["photo"], payload["caption"], keyboard, rate_limit_args)
+    else:
+        message = await bot.send_message(
+            chat_id=chat_id,
+            text=payload["text"],
+            reply_markup=keyboard,
+            rate_limit_args=rate_limit_args)
+    EVENTS.record(chat_id, DELIVERED)
+    return message
+
+
+def ledger_entry(chat_id: int, payload: Dict, message: Message) -> Optional[Tuple[str, int, int, str]]:
+    """ The `SentMessage` row of a sent article post, None for digests and broadcasts """
+    if not (config.edits.enabled and payload.get("article_id")):
+        return None
+    return payload["article_id"], chat_id, message.message_id, payload["kind"]
+
+
+def record_sent(entries: List[Tuple[str, int, int, str]]) -> None:
+    with SessionLocal() as session:
+        for i in range(0, len(entries), 5000):
+            SentMessage.record(session, entries[i:i + 5000])
+
+
+async def send_photo(bot: ExtBot, chat_id: int, url: str, caption: str,
+                     keyboard: Optional[InlineKeyboardMarkup], rate_limit_args: Optional[Dict] = None) -> Message:
+    """
+    Sends an article image by file_id once Telegram has it, else by URL or from the media
+    cache (utils/media.py). Falls back to our copy if Telegram can't fetch the URL.
+    """
+    photo = url
+    if config.media.enabled:
+        photo = MEDIA.file_id(url)
+        if photo is None:
+            path = await MEDIA.fetch(url) if config.media.mode == "local" else None
+            photo = Path(path) if path else url
+    try:
+        message = await bot.send_photo(
+            chat_id=chat_id, photo=photo, caption=caption,
+            reply_markup=keyboard, rate_limit_args=rate_limit_args)
+    except BadRequest as e:
+        if not (config.media.enabled and is_fetch_error(e)):
+            raise
+        MEDIA.forget(url)
+        path = await MEDIA.fetch(url)
+        if not path or photo == Path(path):
+            raise
+        logger.info(f"Telegram could not use {photo} ({e.message}), uploading the cached copy.")
+        message = await bot.send_photo(
+            chat_id=chat_id, photo=Path(path), caption=caption,
+            reply_markup=keyboard, rate_limit_args=rate_limit_args)
+    if config.media.enabled:
+        MEDIA.remember(url, message)
+    return message
+
+
+def is_permanent_error(exc: Exception) -> bool:
+    """ Errors that will not go away by retrying (blocked bot, deleted chat, bad markup...) """
+    if isinstance(exc, RetryAfter):
+        return False
+    return isinstance(exc, (Forbidden, BadRequest))
+
+
+def is_gone_error(exc: Exception) -> bool:
+    """ The chat can't be reached anymore: bot blocked, kicked from the channel, chat deleted """
+    if isinstance(exc, Forbidden):
+        return True
+    return isinstance(exc, BadRequest) and "chat not found" in exc.message.lower()
+
+
+def deactivate_chats(session, chat_ids: Iterable[int]) -> int:
+    """
+    Marks users (positive ids) and channels (negative ids) as inactive, for the chats
+    that left without us getting the my_chat_member update (e.g. while the bot was down).
+    """
+    chat_ids = set(chat_ids)
+    changed = User.set_active(session, [chat_id for chat_id in chat_ids if chat_id > 0], False, commit=False)
+    changed += Channel.set_active(session, [chat_id for chat_id in chat_ids if chat_id < 0], False, commit=False)
+    session.commit()
+    if changed:
+        logger.info(f"Deactivated {changed} chat(s) that can't be reached anymore.")
+    return changed
+
+
+def enqueue_payloads(messages: List[Tuple[int, Dict]]) -> int:
+    """ Puts the messages in the delivery outbox for the workers to send. """
+    with SessionLocal() as session:
+        return DeliveryTask.enqueue(session, messages, shards=config.delivery.shards)
+
+
+def is_not_modified(exc: Exception) -> bool:
+    return isinstance(exc, BadRequest) and "message is not modified" in exc.message.lower()
+
+
+async def edit_post(bot: ExtBot, chat_id: int, message_id: int, kind: str, article: Article,
+                    rate_limit_args: Optional[Dict] = None) -> None:
+    """ Rewrites a sent article post: the caption of a photo, the text of a message """
+    if kind == "photo":
+        await bot.edit_message_caption(
+            chat_id=chat_id, message_id=message_id, caption=article_text(article),
+            reply_markup=read_more_keyboard(article.link), rate_limit_args=rate_limit_args)
+    else:
+        await bot.edit_message_text(
+            text=article_text(article), chat_id=chat_id, message_id=message_id,
+            reply_markup=read_more_keyboard(article.link), rate_limit_args=rate_limit_args)
+
+
+async def edit_article_posts(bot: ExtBot, articles: List[Article]) -> int:
+    """
+    Edits in place the posts of articles MAL changed after we sent them, the ones still in
+    the edit window, instead of sending them again. The edits go `concurrency` at a time
+    through the broadcast lane of the rate limiter. Returns the number of edited posts.
+    """
+    by_id = {article.id: article for article in articles}
+    since = datetime.utcnow() - timedelta(hours=config.edits.window_hours)
+    with SessionLocal() as session:
+        posts = SentMessage.get_for_articles(session, list(by_id), since)
+    if not posts:
+        return 0
+
+    semaphore = asyncio.Semaphore(config.edits.concurrency)
+
+    async def edit(article_id: str, chat_id: int, message_id: int, kind: str) -> Optional[Exception]:
+        async with semaphore:
+            try:
+                await edit_post(bot, chat_id, message_id, kind, by_id[article_id],
+                                rate_limit_args={"lane": LANE_BROADCAST})
+            except Exception as e:
+                return e
+        return None
+
+    results = await asyncio.gather(*(edit(*post) for post in posts))
+    edited, stale, gone = 0, [], set()
+    for (article_id, chat_id, _, _), exc in zip(posts, results):
+        if exc is None:
+            edited += 1
+            EDITS.inc(result="edited")
+        elif is_not_modified(exc):
+            EDITS.inc(result="unchanged")
+        else:
+            EDITS.inc(result="failed")
+            if is_gone_error(exc):
+                gone.add(chat_id)
+            elif is_permanent_error(exc):
+                # Deleted, or can't be edited anymore
+                stale.append((article_id, chat_id))
+            else:
+                logger.warning(f"Could not edit the post of {article_id} in chat {chat_id}: {exc}")
+    if stale or gone:
+        with SessionLocal() as session:
+            SentMessage.forget(session, stale)
+            deactivate_chats(session, gone)
+    logger.info(f"Edited {edited}/{len(posts)} post(s) of {len(articles)} changed article(s).")
+    return edited
+
+
+def prune_sent_messages() -> int:
+    """ Drops the ledger rows of posts too old to be edited """
+    with SessionLocal() as session:
+        return SentMessage.prune(session, datetime.utcnow() - timedelta(hours=config.edits.window_hours))
+
+
+async def prune_sent_messages_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        deleted = await asyncio.to_thread(prune_sent_messages)
+        logger.debug(f"Pruned {deleted} sent message(s) from the ledger.")
+    except Exception as e:
+        logger.exception(f"Failed to prune the sent messages: {e}")
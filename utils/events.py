@@ -0,0 +1,128 @@
+"""
+Event recorder for the analytics: subscriptions, channel opt-ins, mutes, blocks and
+delivery outcomes, appended to `SubscriptionLog`.
+
+`EVENTS.record()` only appends to a list. The events are written with one batched
+INSERT every `flush_interval` seconds, or as soon as `batch_size` are waiting, from a
+thread. The `rollup_events` job then folds the log into `DailyEventCount` (one row per
+day and action) and purges raw events older than `retention_days`, so the stats read a
+small table whatever the traffic.
+"""
+import asyncio
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from telegram.ext import ContextTypes
+
+from config import config
+from models.database import SessionLocal
+from models.user import DailyEventCount, SubscriptionLog
+from utils.logger import setup_logger
+from utils.metrics import EVENTS_RECORDED
+
+logger = setup_logger(__name__, config.paths.log_path+"/utils.log")
+
+SUBSCRIBED = "subscribed"
+UNSUBSCRIBED = "unsubscribed"
+CHANNEL_OPT_IN = "channel_opt_in"
+CHANNEL_OPT_OUT = "channel_opt_out"
+MUTED = "muted"
+UNMUTED = "unmuted"
+DELIVERED = "delivered"
+DELIVERY_FAILED = "delivery_failed"
+BLOCKED = "blocked"
+UNBLOCKED = "unblocked"
+
+
+class EventRecorder:
+    def __init__(self, flush_interval: float, batch_size: int, max_pending: int):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._pending: List[Dict] = []
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def record(self, chat_id: int, action: str) -> None:
+        if not config.events.enabled:
+            return
+        if len(self._pending) >= self.max_pending:
+            # The database is not keeping up (or is down), analytics are not worth the memory
+            EVENTS_RECORDED.inc(result="dropped")
+            return
+        self._pending.append({"tg_user_id": chat_id, "action": action, "timestamp": datetime.utcnow()})
+        EVENTS_RECORDED.inc(result="recorded")
+        try:
+            self._start()
+        except RuntimeError:  # No running loop (scripts), flushed by the next record or close()
+            return
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    def _start(self) -> None:
+        if self._task is None or self._task.done():
+            asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception(f"Failed to write events: {e}")
+
+    async def flush(self) -> int:
+        async with self._lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except Exception:
+                # Retried with the next flush
+                self._pending[:0] = batch[:self.max_pending]
+                raise
+            return len(batch)
+
+    @staticmethod
+    def _write(batch: List[Dict]) -> None:
+        with SessionLocal() as session:
+            for i in range(0, len(batch), 5000):
+                SubscriptionLog.log_many(session, batch[i:i + 5000])
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Lost {len(self._pending)} event(s) on shutdown: {e}")
+
+
+EVENTS = EventRecorder(config.events.flush_interval, config.events.batch_size, config.events.max_pending)
+
+
+def rollup_events() -> int:
+    """ Updates the daily counts and purges old raw events. Returns the rows written. """
+    with SessionLocal() as session:
+        rows = DailyEventCount.rollup(session)
+        if config.events.retention_days:
+            SubscriptionLog.purge(session, datetime.utcnow() - timedelta(days=config.events.retention_days))
+    return rows
+
+
+async def rollup_events_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await EVENTS.flush()
+        rows = await asyncio.to_thread(rollup_events)
+        logger.debug(f"Rolled up {rows} daily event count(s)")
+    except Exception as e:
+        logger.exception(f"Failed to roll up events: {e}")
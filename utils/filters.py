@@ -0,0 +1,126 @@
+"""
+Routing of articles by the users' keyword filters (/filter, `UserFilter`).
+
+Once per news cycle every user's terms go into one Aho-Corasick automaton. Each article
+is then scanned once, whatever the number of users and terms, and the matched terms give
+the users who asked for it (include) or against it (exclude) through set operations.
+Terms match whole words: "one piece" matches "One Piece: Egghead" but not "someone".
+
+Tag subscriptions (/tags) are routed the same way by `TagRouter`, with the chats of each
+of the article's tags instead of matched terms.
+"""
+from collections import deque
+from typing import Dict, Iterable, List, Set, Tuple
+
+from models.database import SessionLocal
+from models.news import Article
+from models.user import TagSubscription, UserFilter, normalize_term
+
+
+class AhoCorasick:
+    """ Finds all the given patterns in a text in one pass over it """
+
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]  # Patterns ending at each state, fail chain included
+        self.patterns: List[str] = []
+        for pattern in patterns:
+            self._add(pattern)
+        self._link()
+
+    def _add(self, pattern: str) -> None:
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = next_state
+        self._out[state].append(len(self.patterns))
+        self.patterns.append(pattern)
+
+    def _link(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+
+    def find(self, text: str) -> Set[int]:
+        """ Indexes (in `patterns`) of the patterns found in `text` """
+        found: Set[int] = set()
+        state = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+def article_text(article: Article) -> str:
+    """ What filters are matched against: normalized title and summary, padded for whole words """
+    return f" {normalize_term(article.title)} {normalize_term(article.summary or '')} "
+
+
+class FilterRouter:
+    def __init__(self, filters: Iterable[Tuple[int, str, bool]]):
+        includes: Dict[str, Set[int]] = {}
+        excludes: Dict[str, Set[int]] = {}
+        for user_id, term, exclude in filters:
+            (excludes if exclude else includes).setdefault(term, set()).add(user_id)
+        terms = sorted(set(includes) | set(excludes))
+        self._includes = [includes.get(term, set()) for term in terms]
+        self._excludes = [excludes.get(term, set()) for term in terms]
+        # Users who only want the articles matching one of their include terms
+        self.restricted: Set[int] = set().union(*self._includes) if terms else set()
+        self._automaton = AhoCorasick(f" {term} " for term in terms)
+
+    @classmethod
+    def load(cls) -> "FilterRouter":
+        with SessionLocal() as session:
+            return cls(UserFilter.get_all_filters(session))
+
+    def blocked(self, article: Article) -> Set[int]:
+        """ Users who must not get the article """
+        wanted: Set[int] = set()
+        unwanted: Set[int] = set()
+        for index in self._automaton.find(article_text(article)):
+            wanted |= self._includes[index]
+            unwanted |= self._excludes[index]
+        return (self.restricted - wanted) | unwanted
+
+
+class TagRouter:
+    """
+    Routing by the tag subscriptions (/tags, `TagSubscription`): chat ids per tag, loaded
+    through the tag index for the tags of the cycle's articles only. Chats with
+    subscriptions only get the articles with one of their tags.
+    """
+
+    def __init__(self, subscribers: Dict[str, Set[int]], restricted: Set[int]):
+        self._subscribers = subscribers
+        self.restricted = restricted
+
+    @classmethod
+    def load(cls, news: Iterable[Article]) -> "TagRouter":
+        tags = {tag for article in news for tag in article.tags}
+        with SessionLocal() as session:
+            return cls(TagSubscription.get_subscribers(session, tags), TagSubscription.get_subscribed_chats(session))
+
+    def blocked(self, article: Article) -> Set[int]:
+        """ Chats that must not get the article """
+        if not self.restricted:
+            return set()
+        return self.restricted.difference(*(self._subscribers.get(tag, ()) for tag in article.tags))
@@ -1,4 +1,3 @@
-import requests
 import html
 import os
 import traceback
@@ -7,16 +6,15 @@ from datetime import datetime, timezone
 from telegram.ext import ContextTypes
 from telegram import error
 
-from PIL import Image
-from io import BytesIO
-from bs4 import BeautifulSoup
 from config import config
 from models.database import SessionLocal
 from models.user import Channel
-from models.news import NewsCache
+from models.news import NewsCache, normalize_tag
 from telegram import InlineKeyboardButton
 from utils.logger import setup_logger
-from typing import List, Dict, Optional, Union, Tuple
+from utils.metrics import FETCH_SECONDS, FETCH_RESPONSES, PARSE_SECONDS, ARTICLES_PER_TICK
+from utils.rate_limiter import LANE_ALERT
+from typing import List, Dict, Optional, Union
 import time
 import re
 from urllib.parse import urlparse, urlunparse
@@ -80,13 +78,22 @@ def get_clean_image_url(link:str) -> str:
 def fetch_news_page(url, retries=30, delay=5) -> str | None:
     """Fetch a page and return the text with retries support."""
     logger.info(f"Fetching: {url}")
+    with FETCH_SECONDS.time():
+        return _fetch_with_retries(url, retries, delay)
+
+def _fetch_with_retries(url, retries, delay) -> str | None:
+    import requests  # Lazy, only the news job needs it
+
     for attempt in range(retries):
         try:
             response = requests.get(url)
+            FETCH_RESPONSES.inc(status=response.status_code)
             response.raise_for_status()
             logger.info(f"Successfully fetched: {url}")
             return response.text
         except requests.exceptions.RequestException as e:
+            if e.response is None:
+                FETCH_RESPONSES.inc(status=type(e).__name__)
             logger.warning(f"Attempt {attempt + 1} failed: {e}")
             if attempt < retries - 1:
                 time.sleep(delay)
@@ -94,35 +101,75 @@ def fetch_news_page(url, retries=30, delay=5) -> str | None:
                 logger.exception(f"All {retries} attempts failed for: {url}")
                 return
 
-def extract_news_articles(page_html: str) -> List[Dict[str, Optional[str]]]:
+def extract_news_articles(page_html: str) -> List[Dict]:
     ''' For parsing and extracting the news content '''
+    with PARSE_SECONDS.time():
+        articles = _extract_news_articles(page_html)
+    ARTICLES_PER_TICK.set(len(articles))
+    return articles
+
+def _extract_news_articles(page_html: str) -> List[Dict]:
+    from bs4 import BeautifulSoup  # Lazy, only the news job needs it
+
     soup = BeautifulSoup(page_html, 'lxml')
     articles = []
 
     for article in soup.find_all('div', attrs={'class':'news-unit'}):
         title_tag = article.find('p', class_='title')
-        if not title_tag:
-            logger.info(f"Skipping article with no title: {article}")
+        link_tag = title_tag.find('a', href=True) if title_tag else None
+        if not link_tag:
+            logger.info(f"Skipping article with no title link: {str(article)[:300]}")
             continue
-        title = title_tag.get_text(strip=True)
-        link = title_tag.find('a')['href']
-        summary = article.find('div', class_='text').get_text(strip=True) if article.find('div', class_='text') else ''
-        date_str = article.find('p', class_='info').next_element.get_text(strip=True,)[:-2] if article.find('p', class_='info') else ''
-        # date_str_text = date_str.find(string=True, recursive=False)
-        image_url_tag = article.find('a', class_='image-link') if article.find('a', class_='image-link') else None
-        image_url = get_clean_image_url(image_url_tag.find('img')['src']) if image_url_tag else None
-        logger.info(f"Done extracting article info for: {title}")
+        title = title_tag.get_text(' ', strip=True)
+        link = link_tag['href']
+        summary = article.find('div', class_='text').get_text(' ', strip=True) if article.find('div', class_='text') else ''
+        # "Oct 18, 9:51 PM by <a>author</a>": the text before the author link
+        info_tag = article.find('p', class_='info')
+        date_node = info_tag.find(string=True) if info_tag else None
+        date_str = re.sub(r'\s*by$', '', date_node.strip()) if date_node else ''
+        image_tag = article.select_one('a.image-link img')
+        image_src = (image_tag.get('data-src') or image_tag.get('src')) if image_tag else None
+        image_url = get_clean_image_url(image_src) if image_src and image_src.startswith('http') else None
+        # Categories link to /news/tag/<slug>, the slug is the tag
+        tags = []
+        for tag_link in article.select('a[href*="/news/tag/"]'):
+            tag = normalize_tag(urlparse(tag_link['href']).path.rstrip('/').rsplit('/', 1)[-1] or tag_link.get_text())
+            if tag and tag not in tags:
+                tags.append(tag)
+        logger.debug(f"Done extracting article info for: {title}")
 
         articles.append({
             'title': title,
             'summary': summary,
             'link': link,
             'date': date_str,
-            'image_url': image_url
+            'image_url': image_url,
+            'tags': tags,
         })
     logger.info("Done extracting all articles for MAL site")
     return articles
 
+MAL_NEWS_LINK = "https://myanimelist.net/news/"
+
+def check_articles(articles: List[Dict[str, Optional[str]]]) -> List[str]:
+    """
+    Health check of a parse. Returns what looks wrong (nothing if all is well), which
+    usually means MAL changed its markup and the parser needs updating.
+    """
+    if not articles:
+        return ["no articles parsed"]
+    problems = []
+    for index, article in enumerate(articles):
+        if not article.get('title'):
+            problems.append(f"article {index}: empty title")
+        if not (article.get('link') or '').startswith(MAL_NEWS_LINK):
+            problems.append(f"article {index}: unexpected link {article.get('link')!r}")
+    # A field missing from one article happens, missing from all of them is a markup change
+    for field in ('summary', 'date', 'image_url'):
+        if not any(article.get(field) for article in articles):
+            problems.append(f"{field} missing from every article")
+    return problems
+
 def get_channels() -> list | None:
     ''' Get all channels in the db '''
     
@@ -218,43 +265,6 @@ def format_uptime(seconds: float) -> str:
 
     return " ".join(parts) if parts else "0s"
 
-def resize_and_process_image(
-    image_url: str, 
-    max_size: Tuple[int, int] = (800, 800)
-) -> BytesIO:
-    """
-    Downloads an image from a URL, resizes it, and returns the image data in a BytesIO object.
-    
-    Args:
-        image_url: The URL of the image to process.
-        max_size: A tuple (width, height) for the maximum dimensions.
-        
-    Returns:
-        A BytesIO object containing the processed image data, or None on failure.
-    """
-    try:
-        # Download the image data from the URL
-        response = requests.get(image_url, timeout=10)
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-
-        # Open the image using Pillow from the bytes data
-        image_data = BytesIO(response.content)
-        img = Image.open(image_data)
-
-        # Preserve aspect ratio while resizing
-        img.thumbnail(max_size, Image.Resampling.LANCZOS)
-
-        # Save the resized image to a new BytesIO object
-        output_data = BytesIO()
-        img.save(output_data, format=img.format)
-        output_data.seek(0) # Rewind the buffer to the beginning
-
-        return output_data
-    
-    except (requests.exceptions.RequestException, IOError) as e:
-        logger.exception(f"Error processing image from {image_url}: {e}")
-        return None
-
 def format_short_traceback(exc: Exception) -> str:
     """
     Formats an exception's traceback, stripping directory paths from file names.
@@ -335,6 +345,7 @@ async def send_critical_alert(
         await context.bot.send_message(
             chat_id=channel_id,
             text=alert_message,
+            rate_limit_args={"lane": LANE_ALERT},
         )
     except error.TelegramError as e:
         logger.critical(f"FATAL: Could not send critical alert to admin channel {channel_id}: {e}")
\ No newline at end of file
@@ -0,0 +1,124 @@
+"""
+Inline mode: `@bot <query>` in any chat lists matching articles.
+
+Answers come from `INLINE_INDEX`, the latest `max_articles` archived articles held in
+memory with a word index. It is loaded once, and reloaded when new articles are cached,
+so typing a query never touches the database. Every query word matches as a prefix
+("one pi" finds "One Piece"), title matches come first, then the newest.
+"""
+import bisect
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+from telegram.constants import ParseMode
+
+from config import config
+from models.database import SessionLocal
+from models.news import Article, NewsArchive, search_words
+from utils.helpers import escape_html
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__, config.paths.log_path+"/utils.log")
+
+# Telegram's limits on inline results
+MAX_RESULTS = 50
+MAX_DESCRIPTION = 200
+
+
+class _Snapshot:
+    """ The indexed articles (newest first, positions are used in the postings), never changed once built """
+    def __init__(self, articles: List[Article]):
+        self.articles = list(articles)
+        self.title: Dict[str, Set[int]] = {}
+        self.text: Dict[str, Set[int]] = {}  # Title and summary
+        for position, article in enumerate(self.articles):
+            title_words = search_words(article.title)
+            for word in title_words:
+                self.title.setdefault(word, set()).add(position)
+            for word in title_words + search_words(article.summary or ""):
+                self.text.setdefault(word, set()).add(position)
+        self.vocabulary = sorted(self.text)
+        # Query results are only valid for these articles, so the cache goes with them
+        self.matches: "OrderedDict[Tuple[str, ...], List[int]]" = OrderedDict()
+
+    def words_with_prefix(self, prefix: str) -> List[str]:
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        end = bisect.bisect_left(self.vocabulary, prefix + "\U0010ffff")
+        return self.vocabulary[start:end]
+
+    def match(self, words: Tuple[str, ...]) -> List[int]:
+        if not words:
+            return list(range(len(self.articles)))
+        found: Optional[Set[int]] = None
+        title_hits: Dict[int, int] = {}
+        for word in words:
+            positions: Set[int] = set()
+            for match in self.words_with_prefix(word):
+                positions |= self.text[match]
+                for position in self.title.get(match, ()):
+                    title_hits[position] = title_hits.get(position, 0) + 1
+            found = positions if found is None else found & positions
+            if not found:
+                return []
+        return sorted(found, key=lambda position: (-title_hits.get(position, 0), position))
+
+
+class NewsIndex:
+    def __init__(self, cache_size: int = 256):
+        self.cache_size = cache_size
+        self._snapshot = _Snapshot([])
+        self.loaded = False
+
+    @property
+    def articles(self) -> List[Article]:
+        return self._snapshot.articles
+
+    def load(self, articles: List[Article]) -> None:
+        """ Replaces the indexed articles (newest first) """
+        # Built aside and swapped in with one assignment: a query, even from another
+        # thread, sees either the old index or the new one, never a mix
+        self._snapshot = _Snapshot(articles)
+        self.loaded = True
+
+    def refresh(self) -> None:
+        """ Reloads the latest articles from the archive """
+        with SessionLocal() as session:
+            articles = NewsArchive.get_latest(session, config.inline.max_articles)
+        self.load(articles)
+        logger.debug(f"Inline index loaded with {len(articles)} article(s).")
+
+    def search(self, query: str, offset: int = 0, limit: int = MAX_RESULTS) -> Tuple[List[Article], bool]:
+        """ A page of the articles matching `query`, and whether there are more """
+        snapshot = self._snapshot  # Read once, a reload meanwhile doesn't affect this query
+        words = tuple(search_words(query))
+        matches = snapshot.matches.get(words)
+        if matches is None:
+            matches = snapshot.match(words)
+            # The next pages of a query ask again with an offset
+            snapshot.matches[words] = matches
+            if len(snapshot.matches) > self.cache_size:
+                snapshot.matches.popitem(last=False)
+        else:
+            snapshot.matches.move_to_end(words)
+        page = matches[offset:offset + limit]
+        return [snapshot.articles[position] for position in page], offset + limit < len(matches)
+
+
+INLINE_INDEX = NewsIndex(config.inline.query_cache_size)
+
+
+def build_inline_result(article: Article) -> InlineQueryResultArticle:
+    buttons = [InlineKeyboardButton("📜 Read More", url=article.link)]
+    if article.telegraph_url:
+        buttons.append(InlineKeyboardButton("⚡ Instant View", url=article.telegraph_url))
+    summary = article.summary or ""
+    return InlineQueryResultArticle(
+        id=article.id[:64],
+        title=article.title,
+        description=summary[:MAX_DESCRIPTION],
+        thumbnail_url=article.image_url,
+        input_message_content=InputTextMessageContent(
+            f"<b>{escape_html(article.title)}</b>\n\n<i>{escape_html(summary)}</i>", parse_mode=ParseMode.HTML),
+        reply_markup=InlineKeyboardMarkup([buttons]),
+    )
@@ -1,10 +1,201 @@
+import atexit
+import json
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Tuple
 from config import config
 
 THIRD_PARTY_LOG_PATH = "./data/logs/third_party.log"
 
+FILE_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+CONSOLE_FORMAT = '%(name)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line, for log shippers. """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "logger": record.name,
+            "level": record.levelname,
+            "msg": record.getMessage(),
+            "module": record.module,
+            "line": record.lineno,
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def _file_formatter() -> logging.Formatter:
+    return JsonFormatter() if config.logging.json_format else logging.Formatter(FILE_FORMAT)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most `per_second` INFO/DEBUG lines per call site through every second.
+    Warnings and errors always pass. Used for loggers listed in `config.logging.rate_limits`.
+    """
+
+    def __init__(self, per_second: int):
+        super().__init__()
+        self.per_second = per_second
+        self._windows: Dict[Tuple[str, int], Tuple[int, int]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        second = int(record.created)
+        window, count = self._windows.get(key, (second, 0))
+        if window != second:
+            window, count = second, 0
+        self._windows[key] = (window, count + 1)
+        if count < self.per_second:
+            return True
+        _stats["rate_limited"] += 1
+        return False
+
+
+# Counters for the logging overhead on the calling threads, see `logging_stats`
+_stats = {"queued": 0, "dropped": 0, "rate_limited": 0, "enqueue_seconds": 0.0}
+
+
+class _RoutedQueueHandler(QueueHandler):
+    """ Puts records on the shared queue, tagged with the file (and console) they go to. """
+
+    def __init__(self, log_queue: queue.Queue, log_file: str, console: bool):
+        super().__init__(log_queue)
+        self.log_file = log_file
+        self.console = console
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        record.log_file = self.log_file
+        record.log_console = self.console
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if _listener is None:
+            _ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+            _stats["queued"] += 1
+        except queue.Full:
+            # Never block the event loop on logging, drop instead
+            _stats["dropped"] += 1
+
+    def emit(self, record: logging.LogRecord) -> None:
+        started = time.perf_counter()
+        super().emit(record)
+        _stats["enqueue_seconds"] += time.perf_counter() - started
+
+
+class _LazyRotatingFileHandler(RotatingFileHandler):
+    """ Creates the directory and opens the file with the first record, not on import. """
+
+    def __init__(self, log_file: str, max_bytes: int, backup_count: int):
+        super().__init__(log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+
+class _FileRouter(logging.Handler):
+    """
+    Runs in the listener thread and writes each record to its own rotating file.
+    Files (and their directories) are only opened when the first record arrives.
+    """
+
+    def __init__(self, max_bytes: int, backup_count: int):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._files: Dict[str, RotatingFileHandler] = {}
+        self._console = logging.StreamHandler()
+        self._console.setLevel(logging.INFO)
+        self._console.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+
+    def _file_handler(self, log_file: str) -> RotatingFileHandler:
+        handler = self._files.get(log_file)
+        if handler is None:
+            handler = _LazyRotatingFileHandler(log_file, self.max_bytes, self.backup_count)
+            handler.setFormatter(_file_formatter())
+            self._files[log_file] = handler
+        return handler
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self._file_handler(record.log_file).handle(record)
+        if record.log_console and record.levelno >= self._console.level:
+            self._console.handle(record)
+
+    def close(self) -> None:
+        for handler in self._files.values():
+            handler.close()
+        super().close()
+
+
+_log_queue: queue.Queue = queue.Queue(maxsize=config.logging.queue_size)
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _ensure_listener() -> None:
+    """ Starts the single writer thread the first time a logger is set up. """
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            return
+        router = _FileRouter(config.logging.log_max_bytes, config.logging.log_backup_count)
+        _listener = QueueListener(_log_queue, router, respect_handler_level=False)
+        _listener.start()
+        atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """ Flushes the queue and stops the writer thread. """
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+            _listener = None
+
+
+def logging_stats() -> Dict[str, float]:
+    """ Records queued/dropped/rate limited so far, time spent queueing and the current backlog. """
+    return dict(_stats, backlog=_log_queue.qsize())
+
+
+def _attach_handlers(logger: logging.Logger, log_file: str, console: bool,
+                     max_bytes: int, backup_count: int) -> None:
+    # Nothing is opened or started here: the writer thread and the files come with the first record
+    if config.logging.async_logging:
+        logger.addHandler(_RoutedQueueHandler(_log_queue, log_file, console))
+        return
+
+    # Synchronous handlers, writes happen on the calling thread
+    file_handler = _LazyRotatingFileHandler(log_file, max_bytes, backup_count)
+    file_handler.setFormatter(_file_formatter())
+    logger.addHandler(file_handler)
+
+    # Optional console handler
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(logging.INFO)
+        console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+        logger.addHandler(console_handler)
+
+
 def setup_logger(
     name: str,
     log_file: str,
@@ -12,47 +203,27 @@ def setup_logger(
     max_bytes: int = config.logging.log_max_bytes,
     backup_count: int = config.logging.log_backup_count
 ) -> logging.Logger:
-    os.makedirs(os.path.dirname(log_file), exist_ok=True)
-    os.makedirs(os.path.dirname(THIRD_PARTY_LOG_PATH), exist_ok=True)
-
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG if config.settings.debug else logging.INFO)
 
     if not logger.handlers:
-        # File handler (main log)
-        file_handler = RotatingFileHandler(
-            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
-        )
-        file_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        file_handler.setFormatter(file_format)
-        logger.addHandler(file_handler)
-
-        # Optional console handler
-        if console:
-            console_handler = logging.StreamHandler()
-            console_handler.setLevel(logging.INFO)
-            console_handler.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
-            logger.addHandler(console_handler)
+        _attach_handlers(logger, log_file, console, max_bytes, backup_count)
+        per_second = config.logging.rate_limits.get(name)
+        if per_second:
+            logger.addFilter(RateLimitFilter(per_second))
 
     # Setup shared handler for noisy logs (only once)
     if config.settings.debug:
         shared_noisy_logger = logging.getLogger("third_party")
         if not shared_noisy_logger.handlers:
-            noisy_handler = RotatingFileHandler(
-                THIRD_PARTY_LOG_PATH,
-                maxBytes=max_bytes,
-                backupCount=backup_count,
-                encoding="utf-8"
-            )
-            noisy_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-            shared_noisy_logger.addHandler(noisy_handler)
+            _attach_handlers(shared_noisy_logger, THIRD_PARTY_LOG_PATH, False, max_bytes, backup_count)
             shared_noisy_logger.setLevel(logging.DEBUG)
 
         for noisy_name in config.logging.noisy_loggers:
             noisy = logging.getLogger(noisy_name)
-            noisy.handlers = []
+            noisy.handlers = list(shared_noisy_logger.handlers)  # Forward to "third_party"
             noisy.setLevel(logging.DEBUG)
-            noisy.propagate = True  # Forward to "third_party"
+            noisy.propagate = False
 
     else:
         for noisy_name in config.logging.noisy_loggers:
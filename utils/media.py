@@ -0,0 +1,213 @@
+"""
+Article images, downloaded once and kept on disk.
+
+Images are normalized for Telegram (at most `max_dimension` px, JPEG or WebP, at most
+`max_kb`) and stored under their content hash, so the bot and the delivery workers
+share one copy per image however often they fetch it. `index.json` maps image URLs to
+files. The least recently used files are evicted once the cache is over `max_cache_mb`.
+
+Sends keep using the MAL URL (mode "fallback") and upload our copy only when Telegram
+can't fetch it, or always upload it (mode "local"). Either way the file_id Telegram
+returns is reused for the following chats, so an image is fetched or uploaded once.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from io import BytesIO
+from typing import Dict, Iterable, Optional
+
+import httpx
+from telegram import Message
+from telegram.error import BadRequest
+
+from config import config
+from utils.logger import setup_logger
+from utils.metrics import MEDIA_REQUESTS, MEDIA_CACHE_BYTES
+
+logger = setup_logger(__name__, config.paths.log_path+"/utils.log")
+
+EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp"}
+
+
+def normalize_image(data: bytes, max_dimension: int, max_bytes: int, fmt: str = "JPEG", quality: int = 85) -> bytes:
+    """ Downscales and re-encodes an image, lowering the quality until it fits in `max_bytes`. """
+    from PIL import Image, ImageOps  # Only needed once an image is downloaded
+
+    with Image.open(BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+        for q in range(quality, 20, -10):
+            output = BytesIO()
+            image.save(output, fmt, quality=q, optimize=True)
+            if output.tell() <= max_bytes:
+                break
+        return output.getvalue()
+
+
+def is_fetch_error(exc: Exception) -> bool:
+    """ Telegram could not use the photo we gave it (URL unreachable, not an image, stale file_id) """
+    if not isinstance(exc, BadRequest):
+        return False
+    message = exc.message.lower()
+    return any(text in message for text in ("http url", "file identifier", "web page content", "image_process_failed"))
+
+
+class MediaCache:
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index_path = os.path.join(directory, "index.json")
+        self._index: Optional[Dict[str, str]] = None  # url -> file name, loaded on first use
+        self._file_ids: Dict[str, str] = {}
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._total = 0
+        # The index and the total are updated from the download threads
+        self._lock = threading.RLock()
+
+    def _load(self) -> Dict[str, str]:
+        with self._lock:
+            return self._load_index()
+
+    def _load_index(self) -> Dict[str, str]:
+        if self._index is None:
+            os.makedirs(self.directory, exist_ok=True)
+            try:
+                with open(self._index_path, encoding="utf-8") as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+            self._total = sum(entry.stat().st_size for entry in os.scandir(self.directory)
+                              if entry.is_file() and entry.name != "index.json")
+            MEDIA_CACHE_BYTES.set(self._total)
+        return self._index
+
+    def path(self, url: str) -> Optional[str]:
+        """ The cached file for `url`, if any. Marks it as recently used. """
+        name = self._load().get(url)
+        if not name:
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path)
+        except OSError:  # Evicted, possibly by another process
+            return None
+        return path
+
+    async def fetch(self, url: str) -> Optional[str]:
+        """ The cached file for `url`, downloading it first if needed. None if that fails. """
+        path = self.path(url)
+        if path:
+            MEDIA_REQUESTS.inc(result="hit")
+            return path
+        # One download per URL, however many sends are waiting for it
+        if url in self._pending:
+            return await asyncio.shield(self._pending[url])
+        future = asyncio.get_running_loop().create_future()
+        self._pending[url] = future
+        try:
+            path = await self._download(url)
+            future.set_result(path)
+            return path
+        except Exception as e:
+            future.set_result(None)
+            MEDIA_REQUESTS.inc(result="error")
+            logger.warning(f"Could not cache image {url}: {e}")
+            return None
+        finally:
+            if not future.done():  # Cancelled
+                future.cancel()
+            del self._pending[url]
+
+    async def _download(self, url: str) -> str:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=config.media.download_timeout, follow_redirects=True)
+            self._semaphore = asyncio.Semaphore(config.media.concurrency)
+        async with self._semaphore:
+            response = await self._client.get(url)
+            response.raise_for_status()
+            path = await asyncio.to_thread(self._store, url, response.content)
+        MEDIA_REQUESTS.inc(result="download")
+        return path
+
+    def _store(self, url: str, data: bytes) -> str:
+        fmt = config.media.format.upper()
+        data = normalize_image(data, config.media.max_dimension, config.media.max_kb * 1024, fmt, config.media.quality)
+        name = hashlib.sha256(data).hexdigest() + EXTENSIONS.get(fmt, ".img")
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            index = self._load_index()
+            if not os.path.exists(path):
+                self._write(path, data)
+                self._total += len(data)
+            index[url] = name
+            self._write(self._index_path, json.dumps(index).encode("utf-8"))
+            self._evict(keep=name)
+            MEDIA_CACHE_BYTES.set(self._total)
+        return path
+
+    def _write(self, path: str, data: bytes) -> None:
+        # Write then rename, so another process never reads a half written file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _evict(self, keep: str) -> None:
+        """ Called with the lock held """
+        if self._total <= self.max_bytes:
+            return
+        files = sorted(
+            (entry for entry in os.scandir(self.directory)
+             if entry.is_file() and entry.name not in ("index.json", keep) and not entry.name.endswith(".tmp")),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        # Down to 90% so we don't evict again on the next download
+        target = self.max_bytes * 0.9
+        removed = set()
+        for entry in files:
+            if self._total <= target:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self._total -= size
+            removed.add(entry.name)
+        if removed:
+            for url in [url for url, name in self._index.items() if name in removed]:
+                del self._index[url]
+            self._write(self._index_path, json.dumps(self._index).encode("utf-8"))
+            logger.info(f"Evicted {len(removed)} image(s) from the media cache.")
+
+    async def prefetch(self, urls: Iterable[str]) -> Dict[str, Optional[str]]:
+        """ Caches all `urls` concurrently (at most `concurrency` downloads at a time). """
+        urls = list(dict.fromkeys(url for url in urls if url))
+        paths = await asyncio.gather(*(self.fetch(url) for url in urls))
+        return dict(zip(urls, paths))
+
+    def file_id(self, url: str) -> Optional[str]:
+        return self._file_ids.get(url)
+
+    def remember(self, url: str, message: Optional[Message]) -> None:
+        """ Keeps the file_id of a sent photo, to send it again without fetching or uploading. """
+        if message is not None and message.photo:
+            self._file_ids[url] = message.photo[-1].file_id
+
+    def forget(self, url: str) -> None:
+        self._file_ids.pop(url, None)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+MEDIA = MediaCache(config.media.cache_dir, config.media.max_cache_mb * 1024 * 1024)
@@ -0,0 +1,326 @@
+import asyncio
+import bisect
+import contextlib
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from telegram import Update
+
+from config import config
+from utils.logger import logging_stats, setup_logger
+
+logger = setup_logger(__name__, config.paths.log_path+"/utils.log")
+
+# Seconds, from a fast DB query to a slow MAL fetch
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _Metric:
+    """ Base for the metric types, a value per set of label values. """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _label_str(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def expose(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        return dict(self._values)
+
+    def expose(self) -> List[str]:
+        lines = super().expose()
+        for key, value in self.values().items():
+            lines.append(f"{self.name}{self._label_str(key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class _CounterView(Gauge):
+    """ A counter kept elsewhere (without importing this module), copied in at each scrape. """
+    kind = "counter"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> (per bucket counts, count, sum, max)
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0, 0.0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+            series[3] = max(series[3], value)
+
+    def time(self, **labels) -> "_Timer":
+        """ Context manager observing the duration of the block. """
+        return _Timer(self, labels)
+
+    def summary(self, **labels) -> Dict[str, float]:
+        """ count, avg, max and bucket estimated p50/p95/p99 of one series. """
+        series = self._series.get(self._key(labels))
+        if not series:
+            return {"count": 0, "avg": 0.0, "max": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0}
+        counts, count, total, maximum = series
+        result = {"count": count, "avg": total / count, "max": maximum}
+        for pct in (50, 95, 99):
+            target, seen, estimate = count * pct / 100, 0, maximum
+            for bound, bucket_count in zip(self.buckets, counts):
+                seen += bucket_count
+                if seen >= target:
+                    estimate = min(bound, maximum)
+                    break
+            result[f"p{pct}"] = estimate
+        return result
+
+    def label_sets(self) -> List[Dict[str, str]]:
+        return [dict(zip(self.labelnames, key)) for key in list(self._series)]
+
+    def expose(self) -> List[str]:
+        lines = super().expose()
+        for key, (counts, count, total, _) in list(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{self._label_str(key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self._label_str(key, le)} {count}")
+            lines.append(f"{self.name}_sum{self._label_str(key)} {total}")
+            lines.append(f"{self.name}_count{self._label_str(key)} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+REGISTRY: List[_Metric] = []
+
+# Ingest
+FETCH_SECONDS = Histogram("animenews_fetch_seconds", "Time to fetch the MAL news page, retries included")
+FETCH_RESPONSES = Counter("animenews_fetch_responses_total", "MAL responses by HTTP status", ["status"])
+PARSE_SECONDS = Histogram("animenews_parse_seconds", "Time to extract articles from a page")
+ARTICLES_PER_TICK = Gauge("animenews_articles_parsed", "Articles parsed in the last fetch")
+ARTICLES = Counter("animenews_articles_total", "Parsed articles by cache result", ["result"])
+PARSE_FAILURES = Counter("animenews_parse_health_failures_total", "Fetches whose parse failed the health check")
+MIRRORS = Counter("animenews_mirrors_total", "Telegraph mirrors of new articles by result", ["result"])
+WRITE_BATCH_SIZE = Histogram("animenews_write_behind_batch_size", "Writes per group commit",
+                             buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+DB_QUERY_SECONDS = Histogram("animenews_db_query_seconds", "SQL statement duration", ["statement"])
+# Delivery
+SENDS = Counter("animenews_sends_total", "Telegram requests by lane and outcome", ["lane", "outcome"])
+MEDIA_REQUESTS = Counter("animenews_media_total", "Article image lookups by result", ["result"])
+MEDIA_CACHE_BYTES = Gauge("animenews_media_cache_bytes", "Size of the article image cache")
+RATE_LIMIT_WAIT = Histogram("animenews_ratelimit_wait_seconds", "Time requests waited in the rate limiter", ["lane"])
+CHANNEL_CHECKS = Counter("animenews_channel_checks_total", "Channel permission checks by result", ["result"])
+EVENTS_RECORDED = Counter("animenews_events_total", "Analytics events by result (recorded or dropped)", ["result"])
+EDITS = Counter("animenews_edits_total", "In-place edits of sent news posts by result", ["result"])
+# Bot
+HANDLER_SECONDS = Histogram("animenews_handler_seconds", "Time to process an update", ["command"])
+LOOP_LAG = Histogram("animenews_event_loop_lag_seconds", "How late the event loop ran a timer",
+                     buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+ERRORS = Counter("animenews_errors_total", "Unhandled errors caught by the global error handler")
+STALLS = Counter("animenews_event_loop_stalls_total", "Times the event loop was blocked longer than the watchdog threshold")
+# Logging overhead, from utils.logger.logging_stats
+LOG_RECORDS = _CounterView("animenews_log_records_total", "Log records by result (queued, dropped, rate_limited)",
+                           ["result"])
+LOG_ENQUEUE_SECONDS = _CounterView("animenews_log_enqueue_seconds_total",
+                                   "Time the logging threads spent handing records to the writer thread")
+LOG_BACKLOG = Gauge("animenews_log_backlog", "Records waiting for the log writer thread")
+
+
+def _collect_logging() -> None:
+    stats = logging_stats()
+    for result in ("queued", "dropped", "rate_limited"):
+        LOG_RECORDS.set(stats[result], result=result)
+    LOG_ENQUEUE_SECONDS.set(stats["enqueue_seconds"])
+    LOG_BACKLOG.set(stats["backlog"])
+
+
+def render_metrics() -> str:
+    """ All metrics in the Prometheus text exposition format. """
+    _collect_logging()
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+# Users can send any /text, keep the number of command labels bounded
+MAX_COMMAND_LABELS = 64
+_seen_commands = set()
+# Same for callback data, which may also carry user text (the /search query)
+MAX_CALLBACK_LABELS = 64
+_seen_callbacks = set()
+
+
+def update_command(update: object) -> str:
+    """ Label for an update: the /command, or the kind of update. """
+    if isinstance(update, Update):
+        message = update.effective_message
+        if update.message and message.text and message.text.startswith("/"):
+            command = message.text.split()[0].split("@")[0]
+            if command in _seen_commands:
+                return command
+            if len(_seen_commands) < MAX_COMMAND_LABELS and command[1:].replace("_", "").isalnum():
+                _seen_commands.add(command)
+                return command
+            return "/other"
+        if update.callback_query:
+            # Only the prefix names the button, "search:2:one piece" is "callback:search"
+            prefix = re.split(r"[_:]", update.callback_query.data or "", 1)[0]
+            label = "callback:" + prefix
+            if label in _seen_callbacks:
+                return label
+            if len(_seen_callbacks) < MAX_CALLBACK_LABELS and prefix.isalnum():
+                _seen_callbacks.add(label)
+                return label
+            return "callback:other"
+        if update.message:
+            return "message"
+        if update.inline_query:
+            return "inline_query"
+        if update.my_chat_member:
+            return "my_chat_member"
+    return "other"
+
+
+# Updates and jobs in progress: id -> (label, start time), read by the stall watchdog
+ACTIVE: Dict[int, Tuple[str, float]] = {}
+
+
+@contextlib.contextmanager
+def activity(label: str):
+    """ Marks `label` as in progress for the duration of the block. """
+    key = object()
+    ACTIVE[id(key)] = (label, time.monotonic())
+    try:
+        yield
+    finally:
+        ACTIVE.pop(id(key), None)
+
+
+async def monitor_loop_lag(interval: float = 0.5) -> None:
+    """ Sleeps `interval` over and over and records how late each wake up is. """
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - expected))
+
+
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Skip the headers
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render_metrics().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port: Optional[int] = None) -> Optional[asyncio.AbstractServer]:
+    """ Serves /metrics on `config.metrics.host`. Returns None if metrics are disabled or the port is taken. """
+    if not config.metrics.enabled:
+        return None
+    port = config.metrics.port if port is None else port
+    try:
+        server = await asyncio.start_server(_handle_http, config.metrics.host, port)
+    except OSError as e:
+        logger.error(f"Could not start the metrics endpoint on {config.metrics.host}:{port}: {e}")
+        return None
+    logger.info(f"Metrics available on http://{config.metrics.host}:{port}/metrics")
+    return server
+
+
+def format_metrics_summary() -> str:
+    """ Short summary of the metrics for /skfj_status. """
+    fetch = FETCH_SECONDS.summary()
+    parse = PARSE_SECONDS.summary()
+    lag = LOOP_LAG.summary()
+    sends: Dict[str, float] = {}
+    for (lane, outcome), value in SENDS.values().items():
+        sends[outcome] = sends.get(outcome, 0) + value
+    lines = [
+        "<b>📈 Metrics</b>",
+        f"  fetch: {fetch['count']} avg {fetch['avg']:.2f}s, max {fetch['max']:.2f}s",
+        f"  parse: avg {parse['avg'] * 1000:.1f}ms, last tick {ARTICLES_PER_TICK.value():.0f} articles",
+        f"  articles: {ARTICLES.value(result='new'):.0f} new / {ARTICLES.value(result='duplicate'):.0f} duplicate",
+        "  sends: " + (", ".join(f"{outcome} {count:.0f}" for outcome, count in sorted(sends.items())) or "none"),
+        f"  loop lag: p99 {lag['p99'] * 1000:.0f}ms, max {lag['max'] * 1000:.0f}ms",
+    ]
+    return "\n".join(lines)
@@ -0,0 +1,199 @@
+"""
+Full text mirrors of new articles on Telegraph, shown as "Instant View" next to "Read More".
+
+Runs after the fan-out, in the background: each new article page is fetched once, its
+main content converted to Telegraph nodes and published. The page URL is stored on
+`NewsCache.telegraph_url` and never refreshed. `MIRROR__BACKEND=local` publishes to
+`LocalTelegraph` instead, which keeps the pages in memory (tests, benchmarks).
+"""
+import asyncio
+import os
+import re
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urljoin
+
+import httpx
+
+from config import config
+from models.database import SessionLocal
+from models.news import Article, NewsCache
+from utils.logger import setup_logger
+from utils.metrics import MIRRORS
+
+logger = setup_logger(__name__, config.paths.log_path+"/utils.log")
+
+# Tags Telegraph accepts, the others are replaced by their content
+ALLOWED_TAGS = {
+    "a", "aside", "b", "blockquote", "br", "code", "em", "figcaption", "figure", "h3", "h4", "hr",
+    "i", "iframe", "img", "li", "ol", "p", "pre", "s", "strong", "u", "ul", "video",
+}
+RENAMED_TAGS = {"h1": "h3", "h2": "h3", "h5": "h4", "h6": "h4", "del": "s", "strike": "s"}
+SKIPPED_TAGS = {"script", "style", "noscript", "form", "button", "input", "select", "svg"}
+# Main content of a MAL article, most specific first
+CONTENT_SELECTORS = ("div.news-container div.content", "div.news-container", "article")
+
+
+def _to_nodes(element, base_url: str) -> List:
+    from bs4 import Comment, NavigableString, Tag
+
+    nodes = []
+    for child in element.children:
+        if isinstance(child, Comment):
+            continue
+        if isinstance(child, NavigableString):
+            text = re.sub(r"\s+", " ", str(child))
+            if text.strip():
+                nodes.append(text)
+            continue
+        if not isinstance(child, Tag) or child.name in SKIPPED_TAGS:
+            continue
+        tag = RENAMED_TAGS.get(child.name, child.name)
+        children = _to_nodes(child, base_url)
+        if tag not in ALLOWED_TAGS:
+            nodes.extend(children)
+            continue
+        node = {"tag": tag}
+        if tag == "a" and child.get("href"):
+            node["attrs"] = {"href": urljoin(base_url, child["href"])}
+        elif tag in ("img", "video", "iframe"):
+            src = child.get("data-src") or child.get("src")
+            if not src:
+                continue
+            node["attrs"] = {"src": urljoin(base_url, src)}
+        if children:
+            node["children"] = children
+        nodes.append(node)
+    return nodes
+
+
+def extract_article_content(html_page: str, base_url: str) -> Tuple[Optional[str], List]:
+    """ The title and main content (as Telegraph nodes) of an article page. """
+    from bs4 import BeautifulSoup  # Lazy, only needed when mirroring
+
+    soup = BeautifulSoup(html_page, "html.parser")
+    title_tag = soup.select_one("div.news-container h1.title") or soup.find("h1")
+    title = title_tag.get_text(" ", strip=True) if title_tag else None
+    for selector in CONTENT_SELECTORS:
+        content = soup.select_one(selector)
+        if content:
+            if title_tag and title_tag in content.descendants:
+                title_tag.decompose()
+            return title, _to_nodes(content, base_url)
+    return title, []
+
+
+class LocalTelegraph:
+    """ Stand-in for `telegraph.aio.Telegraph` that keeps the pages in memory. """
+
+    def __init__(self):
+        self.pages: Dict[str, Dict] = {}
+
+    async def create_page(self, title, content=None, html_content=None, author_name=None, author_url=None,
+                          return_content=False) -> Dict:
+        path = f"{re.sub(r'[^A-Za-z0-9]+', '-', title).strip('-')[:60]}-{len(self.pages) + 1}"
+        self.pages[path] = {"title": title, "content": content, "author_name": author_name}
+        return {"path": path, "url": f"https://telegra.ph/{path}"}
+
+
+_publisher = None
+
+
+async def get_publisher():
+    """ The Telegraph client, with a new account (saved in the data dir) if no token is set. """
+    global _publisher
+    if _publisher is not None:
+        return _publisher
+    if config.mirror.backend == "local":
+        _publisher = LocalTelegraph()
+        return _publisher
+
+    from telegraph.aio import Telegraph
+
+    token = config.mirror.access_token
+    token_path = os.path.join(config.paths.data_dir, "telegraph.token")
+    if not token and os.path.exists(token_path):
+        with open(token_path, encoding="utf-8") as f:
+            token = f.read().strip()
+    telegraph = Telegraph(token, domain=config.mirror.domain)
+    if not token:
+        account = await telegraph.create_account(short_name=config.bot.username[:32],
+                                                 author_name=config.mirror.author_name)
+        with open(token_path, "w", encoding="utf-8") as f:
+            f.write(account["access_token"])
+        logger.info(f"Created a Telegraph account, its token is in {token_path}.")
+    _publisher = telegraph
+    return _publisher
+
+
+async def fetch_article_page(client: httpx.AsyncClient, url: str) -> str:
+    response = await client.get(url, headers={"User-Agent": "Mozilla/5.0"})
+    response.raise_for_status()
+    return response.text
+
+
+async def _mirror_article(publisher, fetch: Callable[[str], Awaitable[str]], article: Article) -> Optional[str]:
+    from telegraph.exceptions import RetryAfterError
+
+    title, content = extract_article_content(await fetch(article.link), article.link)
+    if not content:
+        MIRRORS.inc(result="empty")
+        logger.warning(f"No content found in {article.link}, not mirrored.")
+        return None
+    # Link back to the source at the bottom
+    content.append({"tag": "p", "children": [{"tag": "a", "attrs": {"href": article.link},
+                                              "children": ["Source: MyAnimeList"]}]})
+    for attempt in range(3):
+        try:
+            page = await publisher.create_page(
+                title=(title or article.title)[:256], content=content,
+                author_name=config.mirror.author_name, author_url=config.mirror.author_url)
+            MIRRORS.inc(result="published")
+            return page["url"]
+        except RetryAfterError as e:
+            if attempt == 2:
+                raise
+            await asyncio.sleep(e.retry_after)
+
+
+async def mirror_articles(articles: List[Article], publisher=None,
+                          fetch: Optional[Callable[[str], Awaitable[str]]] = None) -> Dict[str, str]:
+    """
+    Mirrors the articles that don't have a Telegraph page yet, `concurrency` at a time, and
+    stores the URLs after every batch. Returns {article id: url} of the new pages.
+    """
+    with SessionLocal() as session:
+        mirrored = NewsCache.get_telegraph_urls(session, [article.id for article in articles])
+    pending = [article for article in articles if article.id not in mirrored]
+    if not pending:
+        return {}
+
+    publisher = publisher or await get_publisher()
+    client = None
+    if fetch is None:
+        client = httpx.AsyncClient(timeout=config.mirror.fetch_timeout, follow_redirects=True)
+        fetch = lambda url: fetch_article_page(client, url)
+    semaphore = asyncio.Semaphore(config.mirror.concurrency)
+
+    async def mirror(article: Article) -> Optional[str]:
+        async with semaphore:
+            try:
+                return await _mirror_article(publisher, fetch, article)
+            except Exception as e:
+                MIRRORS.inc(result="error")
+                logger.warning(f"Could not mirror {article.link}: {e}")
+                return None
+
+    urls = {}
+    try:
+        for i in range(0, len(pending), config.mirror.batch_size):
+            batch = pending[i:i + config.mirror.batch_size]
+            results = await asyncio.gather(*(mirror(article) for article in batch))
+            batch_urls = {article.id: url for article, url in zip(batch, results) if url}
+            with SessionLocal() as session:
+                NewsCache.set_telegraph_urls(session, batch_urls)
+            urls.update(batch_urls)
+    finally:
+        if client is not None:
+            await client.aclose()
+    logger.info(f"Mirrored {len(urls)}/{len(pending)} article(s) on Telegraph.")
+    return urls
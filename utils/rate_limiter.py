@@ -0,0 +1,426 @@
+import asyncio
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from config import config
+from utils.logger import setup_logger
+from utils.metrics import RATE_LIMIT_WAIT, SENDS
+from utils.tracing import add_api_time
+
+logger = setup_logger(__name__, config.paths.log_path+"/utils.log")
+
+# Outbound lanes, highest priority first, passed with `rate_limit_args={"lane": ...}`.
+# Requests without a lane are replies to a user and go in the interactive lane.
+LANE_INTERACTIVE = "interactive"
+LANE_ALERT = "alert"
+LANE_NEWS = "news"
+LANE_BROADCAST = "broadcast"
+LANES = (LANE_INTERACTIVE, LANE_ALERT, LANE_NEWS, LANE_BROADCAST)
+
+
+def _refill(tokens: Optional[float], updated: float, now: float,
+            rate: float, capacity: float, reserve: float) -> Tuple[float, float]:
+    """
+    Token bucket step shared by all stores.
+
+    Takes one token unless that would leave less than `reserve` tokens in the bucket.
+
+    Returns:
+        tuple: (tokens left in the bucket, seconds to wait before retrying or 0 if a token was taken)
+    """
+    if tokens is None:
+        tokens = capacity
+    else:
+        tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1 + reserve:
+        return tokens - 1, 0.0
+    return tokens, (1 + reserve - tokens) / rate
+
+
+class BucketStore(ABC):
+    """
+    Storage for the token buckets of `SharedRateLimiter`.
+
+    A store shared between processes (sqlite file, redis...) lets the bot and the delivery
+    workers spend one common budget instead of each assuming it owns the full limit.
+    """
+
+    # Whether calls do I/O and should be run off the event loop
+    blocking: bool = True
+    # Whether the buckets are visible to other processes
+    shared: bool = True
+
+    @abstractmethod
+    def acquire(self, key: str, rate: float, capacity: float, reserve: float = 0.0) -> float:
+        """ Tries to take a token from bucket `key`. Returns 0 on success, otherwise the seconds to wait. """
+
+    @abstractmethod
+    def pause_until(self, until: float) -> None:
+        """ Stops all requests until the `until` timestamp (after a 429 from Telegram). """
+
+    @abstractmethod
+    def paused_until(self) -> float:
+        """ Timestamp until which requests are paused, 0 if not paused. """
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryBucketStore(BucketStore):
+    """ Process local buckets, the default for a single bot process. """
+
+    blocking = False
+    shared = False
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._paused_until = 0.0
+
+    def acquire(self, key: str, rate: float, capacity: float, reserve: float = 0.0) -> float:
+        now = time.time()
+        # Drop idle group buckets once in a while, a full bucket is the same as a missing one
+        if len(self._buckets) > 512:
+            for k, (tokens, updated) in list(self._buckets.items()):
+                if k != key and now - updated > capacity / rate:
+                    del self._buckets[k]
+        tokens, updated = self._buckets.get(key, (None, now))
+        tokens, wait = _refill(tokens, updated, now, rate, capacity, reserve)
+        self._buckets[key] = (tokens, now)
+        return wait
+
+    def pause_until(self, until: float) -> None:
+        self._paused_until = max(self._paused_until, until)
+
+    def paused_until(self) -> float:
+        return self._paused_until
+
+
+class SQLiteBucketStore(BucketStore):
+    """
+    Buckets in a sqlite file, for several processes on the same host.
+    `BEGIN IMMEDIATE` takes the file lock so every take is atomic across processes.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._local = threading.local()
+        # Every thread's connection (asyncio.to_thread runs on pool threads), closed together
+        self._conns: List[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
+        self._calls = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS pauses (key TEXT PRIMARY KEY, until REAL NOT NULL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")  # Losing a bucket on power loss is harmless
+        return conn
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def acquire(self, key: str, rate: float, capacity: float, reserve: float = 0.0) -> float:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, wait = _refill(row[0] if row else None, row[1] if row else now, now, rate, capacity, reserve)
+            conn.execute(
+                "INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                (key, tokens, now))
+            self._calls += 1
+            if self._calls % 1000 == 0:
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - 3600,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def pause_until(self, until: float) -> None:
+        self._conn().execute(
+            "INSERT INTO pauses (key, until) VALUES ('global', ?) "
+            "ON CONFLICT(key) DO UPDATE SET until = max(until, excluded.until)", (until,))
+
+    def paused_until(self) -> float:
+        row = self._conn().execute("SELECT until FROM pauses WHERE key = 'global'").fetchone()
+        return row[0] if row else 0.0
+
+    def close(self) -> None:
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+            self._local = threading.local()
+        for conn in conns:
+            conn.close()
+
+
+class RedisBucketStore(BucketStore):
+    """
+    Buckets in redis, for processes on several hosts. Needs the optional `redis` package.
+    The refill runs in a Lua script on the server clock so hosts with skewed clocks agree.
+    """
+
+    _SCRIPT = """
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+    local rate, capacity, reserve = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local b = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(b[1])
+    if tokens == nil then
+        tokens = capacity
+    else
+        tokens = math.min(capacity, tokens + math.max(0, now - tonumber(b[2])) * rate)
+    end
+    local wait = 0
+    if tokens >= 1 + reserve then
+        tokens = tokens - 1
+    else
+        wait = (1 + reserve - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+    return tostring(wait)
+    """
+
+    # Like the sqlite store, a shorter pause never cuts a longer one short
+    _PAUSE_SCRIPT = """
+    local current = tonumber(redis.call('GET', KEYS[1]))
+    if current == nil or tonumber(ARGV[1]) > current then
+        redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    end
+    """
+
+    def __init__(self, url: str, prefix: str = "animenewsbot:rl:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("RATE_LIMIT__BACKEND=redis needs the 'redis' package (pip install redis)") from e
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+        self._acquire = self._client.register_script(self._SCRIPT)
+        self._pause = self._client.register_script(self._PAUSE_SCRIPT)
+
+    def acquire(self, key: str, rate: float, capacity: float, reserve: float = 0.0) -> float:
+        return float(self._acquire(keys=[self._prefix + key], args=[rate, capacity, reserve]))
+
+    def pause_until(self, until: float) -> None:
+        ttl = max(1, int(until - time.time()) + 1)
+        self._pause(keys=[self._prefix + "pause"], args=[until, ttl])
+
+    def paused_until(self) -> float:
+        value = self._client.get(self._prefix + "pause")
+        return float(value) if value else 0.0
+
+    def close(self) -> None:
+        self._client.close()
+
+
+class LaneStats:
+    """ Queue time (waiting for the rate limiter) of the requests of one lane. """
+
+    def __init__(self, samples: int = 1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._recent = deque(maxlen=samples)
+
+    def record(self, waited: float) -> None:
+        self.count += 1
+        self.total += waited
+        self.max = max(self.max, waited)
+        self._recent.append(waited)
+
+    def percentile(self, pct: float) -> float:
+        if not self._recent:
+            return 0.0
+        ordered = sorted(self._recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class SharedRateLimiter(BaseRateLimiter[Dict[str, Any]]):
+    """
+    Token bucket rate limiter whose buckets live in a `BucketStore`.
+
+    Like `AIORateLimiter` it throttles all requests to a chat against the overall limit,
+    and requests to groups/channels against a per-group limit as well.
+
+    On top of that every request belongs to a lane (`rate_limit_args={"lane": LANE_NEWS}`).
+    `lane_reserves` sets aside a share of the overall bucket for each lane: a request may
+    not take the tokens reserved for the lanes above it, so interactive replies keep a
+    budget of their own while news or a broadcast drain the rest.
+
+    `rate_limit_args` may also carry "max_retries" for requests that hit a 429.
+    """
+
+    def __init__(
+        self,
+        store: BucketStore,
+        overall_max_rate: float = 30,
+        overall_time_period: float = 1,
+        group_max_rate: float = 20,
+        group_time_period: float = 60,
+        max_retries: int = 0,
+        lane_reserves: Optional[Dict[str, float]] = None,
+    ):
+        self._store = store
+        self._overall_rate = overall_max_rate / overall_time_period if overall_max_rate else 0
+        self._overall_capacity = float(overall_max_rate)
+        self._group_rate = group_max_rate / group_time_period if group_max_rate else 0
+        self._group_capacity = float(group_max_rate)
+        self._max_retries = max_retries
+        # Tokens each lane must leave in the overall bucket for the lanes above it
+        lane_reserves = lane_reserves or {}
+        self._floors: Dict[str, float] = {}
+        reserved = 0.0
+        for lane in LANES:
+            # A small bucket can't hold the reserves and a token: every lane must still be
+            # able to send from a full bucket, or it would wait forever
+            self._floors[lane] = max(0.0, min(self._overall_capacity * reserved, self._overall_capacity - 1))
+            reserved += lane_reserves.get(lane, 0.0)
+        self.lane_stats: Dict[str, LaneStats] = {lane: LaneStats() for lane in LANES}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._store.close()
+
+    async def _call_store(self, func: Callable, *args) -> Any:
+        if self._store.blocking:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    async def _take(self, key: str, rate: float, capacity: float, reserve: float) -> None:
+        while True:
+            wait = await self._call_store(self._store.acquire, key, rate, capacity, reserve)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    async def _wait_for_pause(self) -> None:
+        while True:
+            wait = await self._call_store(self._store.paused_until) - time.time()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], list]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Union[bool, Dict[str, Any], list]:
+        rate_limit_args = rate_limit_args or {}
+        lane = rate_limit_args.get("lane", LANE_INTERACTIVE)
+        if lane not in self._floors:
+            lane = LANE_BROADCAST
+        max_retries = rate_limit_args.get("max_retries", self._max_retries)
+
+        chat_id = data.get("chat_id")
+        with contextlib.suppress(ValueError, TypeError):
+            chat_id = int(chat_id)
+        # Negative ids and @usernames are groups or channels
+        group = chat_id if (isinstance(chat_id, int) and chat_id < 0) or isinstance(chat_id, str) else None
+        reserve = self._floors[lane]
+
+        for i in range(max_retries + 1):
+            queued_at = time.monotonic()
+            await self._wait_for_pause()
+            if group is not None and self._group_rate:
+                await self._take(f"group:{group}", self._group_rate, self._group_capacity, 0.0)
+            if chat_id is not None and self._overall_rate:
+                await self._take("overall", self._overall_rate, self._overall_capacity, reserve)
+            waited = time.monotonic() - queued_at
+            self.lane_stats[lane].record(waited)
+            RATE_LIMIT_WAIT.observe(waited, lane=lane)
+            sent_at = time.monotonic()
+            try:
+                result = await callback(*args, **kwargs)
+                SENDS.inc(lane=lane, outcome="ok")
+                return result
+            except RetryAfter as exc:
+                SENDS.inc(lane=lane, outcome="retry_after")
+                # Make every process using the store back off, not just this one
+                retry_after = exc.retry_after.total_seconds() if hasattr(exc.retry_after, "total_seconds") else exc.retry_after
+                await self._call_store(self._store.pause_until, time.time() + retry_after + 0.1)
+                if i == max_retries:
+                    logger.exception(f"Rate limit hit after maximum of {max_retries} retries")
+                    raise
+                logger.info(f"Rate limit hit on {endpoint}. Retrying after {retry_after} seconds")
+            except Exception as exc:
+                SENDS.inc(lane=lane, outcome=type(exc).__name__)
+                raise
+            finally:
+                add_api_time(time.monotonic() - sent_at, waited)
+
+
+def build_bucket_store() -> BucketStore:
+    backend = config.rate_limit.backend
+    if backend == "sqlite":
+        return SQLiteBucketStore(config.rate_limit.sqlite_path)
+    if backend == "redis":
+        return RedisBucketStore(config.rate_limit.redis_url)
+    return MemoryBucketStore()
+
+
+def build_rate_limiter(share: int = 1) -> SharedRateLimiter:
+    """
+    Rate limiter configured from `config.settings` and `config.rate_limit`.
+
+    Args:
+        share (int): How many processes split the budget. Only used with the process local
+            memory backend, shared backends already coordinate through the store.
+    """
+    store = build_bucket_store()
+    divisor = 1 if store.shared else max(1, share)
+    return SharedRateLimiter(
+        store,
+        overall_max_rate=max(1, config.settings.overall_max_rate // divisor),
+        overall_time_period=config.settings.overall_time_period,
+        group_max_rate=config.settings.group_max_rate,
+        group_time_period=config.settings.group_time_period,
+        max_retries=config.rate_limit.max_retries,
+        lane_reserves=config.rate_limit.lane_reserves,
+    )
+
+
+def format_lane_stats(rate_limiter: Optional[BaseRateLimiter]) -> str:
+    """ Per-lane queue times for the /skfj_status message. """
+    if not isinstance(rate_limiter, SharedRateLimiter):
+        return ""
+    lines = ["<b>🚦 Rate limiter queue time</b> (avg / p99 / max)"]
+    for lane, stats in rate_limiter.lane_stats.items():
+        s = stats.as_dict()
+        lines.append(f"  {lane}: {s['count']} req, {s['avg']:.2f}s / {s['p99']:.2f}s / {s['max']:.2f}s")
+    return "\n".join(lines)
@@ -0,0 +1,70 @@
+"""
+Startup profile for `python main.py --profile-startup`.
+
+`enable()` must run before the other imports (it is the first thing main.py does) so
+that every module import is timed. Startup phases (init_db, build_application, the
+post_init steps...) are timed with `phase()`, and `report()` logs the slowest imports
+and the phases once the bot is up. Nothing here imports config or the project modules.
+"""
+import builtins
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+PROCESS_STARTED = time.perf_counter()
+
+_enabled = False
+_original_import = builtins.__import__
+_imports: Dict[str, float] = {}  # Module -> seconds, nested imports included
+_phases: List[Tuple[str, float]] = []
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    started = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _imports.setdefault(name, time.perf_counter() - started)
+
+
+def enable() -> None:
+    global _enabled
+    _enabled = True
+    builtins.__import__ = _timed_import
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def imports_done() -> None:
+    """ Stops timing imports, what is imported later is lazy anyway. """
+    builtins.__import__ = _original_import
+    if _enabled:
+        _phases.append(("imports", time.perf_counter() - PROCESS_STARTED))
+
+
+@contextmanager
+def phase(name: str):
+    """ Times a startup step (a no-op unless enabled) """
+    if not _enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((name, time.perf_counter() - started))
+
+
+def report(top: int = 15) -> str:
+    lines = [f"Startup profile: ready {time.perf_counter() - PROCESS_STARTED:.3f}s after start"]
+    for name, seconds in _phases:
+        lines.append(f"  {name:<40} {seconds * 1000:8.1f}ms")
+    lines.append(f"Slowest imports (of {len(_imports)}, nested imports included):")
+    for name, seconds in sorted(_imports.items(), key=lambda item: item[1], reverse=True)[:top]:
+        lines.append(f"  {name:<40} {seconds * 1000:8.1f}ms")
+    return "\n".join(lines)
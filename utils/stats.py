@@ -0,0 +1,102 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from telegram.ext import ContextTypes
+
+from config import config
+from models.database import SessionLocal
+from models.news import NewsCache
+from models.user import User, UserSettings, Channel, DailyEventCount
+from utils.events import DELIVERED, DELIVERY_FAILED, SUBSCRIBED, UNSUBSCRIBED
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__, config.paths.log_path+"/utils.log")
+
+
+def collect_stats(days: int = 7) -> Dict:
+    """ Counts for the admin dashboards, all done with SQL aggregates (no rows loaded). """
+    since = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+    with SessionLocal() as session:
+        stats = {
+            "users": User.get_total_users(session),
+            **UserSettings.count_settings(session),
+            "channels": Channel.get_total_channels(session),
+            "articles": NewsCache.get_total_articles(session),
+        }
+        # Rolled up by the rollup_events job, not counted from the raw log
+        events = DailyEventCount.counts_per_day(session, since)
+
+    per_day = []
+    for offset in range(days):
+        day = (since + timedelta(days=offset)).strftime("%Y-%m-%d")
+        counts = events.get(day, {})
+        per_day.append({
+            "day": day,
+            "delivered": counts.get(DELIVERED, 0),  # Messages, a chat can get several a day
+            "failed": counts.get(DELIVERY_FAILED, 0),
+            "subscribed": counts.get(SUBSCRIBED, 0),
+            "unsubscribed": counts.get(UNSUBSCRIBED, 0),
+        })
+    stats["per_day"] = per_day
+    return stats
+
+
+class StatsCache:
+    """
+    Latest `collect_stats` result. Refreshed by a repeating job so reading it costs
+    nothing whatever the number of users, at the price of being up to
+    `config.settings.stats_refresh_interval` seconds old.
+    """
+
+    def __init__(self, days: int = 7):
+        self.days = days
+        self._stats: Optional[Dict] = None
+        self.refreshed_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    async def refresh(self) -> Dict:
+        async with self._lock:
+            started = time.perf_counter()
+            # The queries are synchronous, keep them off the event loop
+            self._stats = await asyncio.to_thread(collect_stats, self.days)
+            self.refreshed_at = time.time()
+            logger.debug(f"Stats refreshed in {time.perf_counter() - started:.3f}s")
+            return self._stats
+
+    async def get(self) -> Dict:
+        """ Cached stats, only queried here if the job has not run yet. """
+        if self._stats is None:
+            return await self.refresh()
+        return self._stats
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.refreshed_at if self.refreshed_at else 0.0
+
+
+STATS = StatsCache(config.settings.stats_days)
+
+
+async def refresh_stats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """ Job callback keeping `STATS` fresh. """
+    try:
+        await STATS.refresh()
+    except Exception as e:
+        logger.exception(f"Failed to refresh stats: {e}")
+
+
+def format_stats(stats: Dict, age: float = 0.0) -> str:
+    """ Stats block for /skfj_status. """
+    lines = [
+        f"<b>👥 Total Users</b>: {stats['users']}",
+        f"<b>🔔 Subscribed</b>: {stats['subscribed']} (channel updates: {stats['channel_opted']})",
+        f"<b>📢 Channels</b>: {stats['channels']}",
+        f"<b>📰 Cached Articles</b>: {stats['articles']}",
+        "<b>📅 Per day</b> (messages delivered / failed / +sub / -sub)",
+    ]
+    for day in stats["per_day"]:
+        lines.append(f"  {day['day']}: {day['delivered']} / {day['failed']} / +{day['subscribed']} / -{day['unsubscribed']}")
+    lines.append(f"<i>updated {age:.0f}s ago</i>")
+    return "\n".join(lines)
@@ -0,0 +1,269 @@
+import asyncio
+import contextvars
+import functools
+import os
+import queue
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import Application, ConversationHandler
+
+from config import config
+from utils.logger import setup_logger
+from utils.metrics import HANDLER_SECONDS, activity, update_command
+
+logger = setup_logger(__name__, config.paths.log_path+"/utils.log")
+
+
+@dataclass(slots=True)
+class Span:
+    """ One update or job: where its time went. All durations in seconds. """
+    name: str
+    start: float                        # Unix time
+    trace_id: str = field(default_factory=lambda: os.urandom(16).hex())
+    span_id: str = field(default_factory=lambda: os.urandom(8).hex())
+    conversation_state: Optional[str] = None
+    duration: float = 0.0
+    db_time: float = 0.0
+    api_time: float = 0.0
+    rate_limit_time: float = 0.0
+    api_calls: int = 0
+    error: Optional[str] = None
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+SPANS: deque = deque(maxlen=config.tracing.buffer_size)
+
+
+def add_db_time(seconds: float) -> None:
+    span = _current_span.get()
+    if span is not None:
+        span.db_time += seconds
+
+
+def add_api_time(seconds: float, waited: float) -> None:
+    """ Time of a Telegram request and the time it waited in the rate limiter before. """
+    span = _current_span.get()
+    if span is not None:
+        span.api_time += seconds
+        span.rate_limit_time += waited
+        span.api_calls += 1
+
+
+class _SpanContext:
+    def __init__(self, name: str, conversation_state: Optional[str] = None):
+        self.span = Span(name=name, start=time.time(), conversation_state=conversation_state)
+
+    def __enter__(self) -> Span:
+        self._started = time.perf_counter()
+        self._token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.duration = time.perf_counter() - self._started
+        if exc is not None:
+            self.span.error = f"{exc_type.__name__}: {exc}"
+        _current_span.reset(self._token)
+        if config.tracing.enabled:
+            SPANS.append(self.span)
+            if _exporter is not None:
+                _exporter.submit(self.span)
+        return False
+
+
+def span(name: str, conversation_state: Optional[str] = None) -> _SpanContext:
+    """ Context manager recording a span for the block. """
+    return _SpanContext(name, conversation_state)
+
+
+def traced(name: str):
+    """ Decorator recording a span for a job callback (and marking it in progress for the watchdog). """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapped(*args, **kwargs):
+            with activity(name), span(name):
+                return await func(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def _conversation_state(app: Application, update: object) -> Optional[str]:
+    """ Current state of the conversations this update belongs to, e.g. "news:0". """
+    if not isinstance(update, Update):
+        return None
+    states = []
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            if not isinstance(handler, ConversationHandler):
+                continue
+            try:
+                state = handler._conversations.get(handler._get_key(update))
+            except (RuntimeError, AttributeError):
+                continue
+            if state is not None:
+                states.append(f"{handler.name or 'conversation'}:{state}")
+    return ",".join(states) or None
+
+
+class InstrumentedApplication(Application):
+    """
+    Application recording a span (see `SPANS`) and the processing time of every update
+    per command, and marking the update in progress for the watchdog.
+    """
+
+    async def process_update(self, update: object) -> None:
+        command = update_command(update)
+        state = _conversation_state(self, update) if config.tracing.enabled else None
+        started = time.perf_counter()
+        try:
+            with activity(command), span(command, state):
+                await super().process_update(update)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, command=command)
+
+
+def _percentile(ordered: List[float], pct: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def command_percentiles() -> Dict[str, Dict[str, float]]:
+    """ p50/p95/p99 duration and average DB/API/queue time per span name over the ring buffer. """
+    by_name: Dict[str, List[Span]] = {}
+    for s in list(SPANS):
+        by_name.setdefault(s.name, []).append(s)
+    result = {}
+    for name, spans in by_name.items():
+        durations = sorted(s.duration for s in spans)
+        count = len(spans)
+        result[name] = {
+            "count": count,
+            "p50": _percentile(durations, 50),
+            "p95": _percentile(durations, 95),
+            "p99": _percentile(durations, 99),
+            "db": sum(s.db_time for s in spans) / count,
+            "api": sum(s.api_time for s in spans) / count,
+            "queue": sum(s.rate_limit_time for s in spans) / count,
+            "errors": sum(1 for s in spans if s.error),
+        }
+    return result
+
+
+def format_trace_summary(limit: int = 8) -> str:
+    """ Per command latency for /skfj_status. """
+    stats = command_percentiles()
+    if not stats:
+        return ""
+    lines = ["<b>⏱️ Latency</b> (p50 / p95 / p99, avg db / api / queue, ms)"]
+    for name, s in sorted(stats.items(), key=lambda item: -item[1]["count"])[:limit]:
+        lines.append(
+            f"  {name}: {s['count']}x {s['p50'] * 1000:.0f} / {s['p95'] * 1000:.0f} / {s['p99'] * 1000:.0f}, "
+            f"{s['db'] * 1000:.0f} / {s['api'] * 1000:.0f} / {s['queue'] * 1000:.0f}"
+        )
+    return "\n".join(lines)
+
+
+class OTLPExporter:
+    """
+    Ships spans to an OpenTelemetry collector with OTLP/HTTP JSON, from a background thread
+    and in batches. Spans are dropped if the collector is down or slow.
+    """
+
+    def __init__(self, endpoint: str, service_name: str = "animenewsbot", batch_size: int = 200,
+                 flush_interval: float = 5.0):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue(maxsize=10 * batch_size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="otlp-exporter", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join(timeout=self.flush_interval + 5)
+
+    def submit(self, s: Span) -> None:
+        try:
+            self._queue.put_nowait(s)
+        except queue.Full:
+            pass
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._stop.wait(self.flush_interval)
+            while not self._queue.empty():
+                batch = []
+                while len(batch) < self.batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                self._send(batch)
+
+    @staticmethod
+    def _attribute(key: str, value) -> Dict:
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+
+    def _encode(self, s: Span) -> Dict:
+        start_ns = int(s.start * 1e9)
+        attributes = [
+            self._attribute("db.time_s", s.db_time),
+            self._attribute("telegram.api_time_s", s.api_time),
+            self._attribute("telegram.api_calls", s.api_calls),
+            self._attribute("ratelimit.queue_time_s", s.rate_limit_time),
+        ]
+        if s.conversation_state:
+            attributes.append(self._attribute("conversation.state", s.conversation_state))
+        encoded = {
+            "traceId": s.trace_id,
+            "spanId": s.span_id,
+            "name": s.name,
+            "kind": 2,  # SERVER
+            "startTimeUnixNano": str(start_ns),
+            "endTimeUnixNano": str(start_ns + int(s.duration * 1e9)),
+            "attributes": attributes,
+        }
+        if s.error:
+            encoded["status"] = {"code": 2, "message": s.error}
+        return encoded
+
+    def _send(self, batch: List[Span]) -> None:
+        body = {"resourceSpans": [{
+            "resource": {"attributes": [self._attribute("service.name", self.service_name)]},
+            "scopeSpans": [{"scope": {"name": "animenewsbot"}, "spans": [self._encode(s) for s in batch]}],
+        }]}
+        import requests
+
+        try:
+            requests.post(self.endpoint, json=body, timeout=5).raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Could not export {len(batch)} span(s) to {self.endpoint}: {e}")
+
+
+_exporter: Optional[OTLPExporter] = None
+
+
+def start_exporter() -> Optional[OTLPExporter]:
+    """ Starts exporting spans if `config.tracing.otlp_endpoint` is set. """
+    global _exporter
+    if not (config.tracing.enabled and config.tracing.otlp_endpoint):
+        return None
+    _exporter = OTLPExporter(config.tracing.otlp_endpoint)
+    _exporter.start()
+    logger.info(f"Exporting spans to {config.tracing.otlp_endpoint}")
+    return _exporter
+
+
+async def stop_exporter() -> None:
+    global _exporter
+    if _exporter is not None:
+        await asyncio.to_thread(_exporter.stop)
+        _exporter = None
@@ -0,0 +1,130 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, List, Optional
+
+from telegram.ext import Application
+
+from config import config
+from utils.helpers import send_critical_alert
+from utils.logger import setup_logger
+from utils.metrics import ACTIVE, STALLS
+
+logger = setup_logger(__name__, config.paths.log_path+"/utils.log")
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _own_frame(frames: List[traceback.FrameSummary]) -> Optional[traceback.FrameSummary]:
+    """ Innermost frame of our own code (not a library), i.e. the call that blocks. """
+    for frame in reversed(frames):
+        filename = os.path.abspath(frame.filename)
+        if filename.startswith(PROJECT_DIR) and filename != os.path.abspath(__file__) \
+                and "site-packages" not in filename:
+            return frame
+    return None
+
+
+class LoopWatchdog:
+    """
+    Detects event loop stalls: something synchronous (time.sleep, a slow query, Pillow...)
+    keeping the loop from running other tasks.
+
+    A task on the loop updates a heartbeat every `check_interval` seconds and a separate
+    thread checks it. When the heartbeat is older than `threshold`, the thread captures the
+    loop thread's stack and the updates/jobs in progress. Once the loop runs again, the
+    stall is logged and reported with `send_critical_alert`, at most once per `alert_interval`.
+    """
+
+    def __init__(self, app: Application, threshold: float, check_interval: float, alert_interval: float):
+        self.app = app
+        self.threshold = threshold
+        self.check_interval = check_interval
+        self.alert_interval = alert_interval
+        self._beat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._stall: Optional[Dict] = None  # Stall in progress, captured by the thread
+        self._last_alert = 0.0
+        self._suppressed = 0
+
+    def start(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat(), name="watchdog_heartbeat")
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"Event loop watchdog started (threshold {self.threshold}s).")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+
+    async def _heartbeat(self) -> None:
+        while True:
+            self._beat = time.monotonic()
+            stall = self._stall
+            if stall is not None:
+                self._stall = None
+                stall["duration"] = self._beat - stall["started"]
+                await self._report(stall)
+            await asyncio.sleep(self.check_interval)
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.check_interval / 2):
+            overdue = time.monotonic() - self._beat - self.check_interval
+            if overdue < self.threshold or self._stall is not None:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            frames = traceback.extract_stack(frame) if frame is not None else []
+            self._stall = {
+                "started": self._beat + self.check_interval,
+                "stack": "".join(traceback.format_list(frames[-15:])),
+                "blocking_call": _own_frame(frames),
+                "active": [label for label, _ in list(ACTIVE.values())],
+            }
+
+    async def _report(self, stall: Dict) -> None:
+        STALLS.inc()
+        where = stall["blocking_call"]
+        location = f"{os.path.relpath(where.filename, PROJECT_DIR)}:{where.lineno} in {where.name}" if where else "unknown"
+        active = ", ".join(stall["active"]) or "none"
+        logger.warning(
+            f"Event loop blocked for {stall['duration']:.1f}s at {location} (running: {active})\n{stall['stack']}"
+        )
+
+        now = time.monotonic()
+        if now - self._last_alert < self.alert_interval:
+            self._suppressed += 1
+            return
+        self._last_alert = now
+        context_data = {
+            "blocked for": f"{stall['duration']:.1f}s",
+            "blocking call": location,
+            "running": active,
+            "stack": stall["stack"][-1500:],
+        }
+        if self._suppressed:
+            context_data["stalls not alerted"] = self._suppressed
+            self._suppressed = 0
+        await send_critical_alert(self.app, "Event loop stall", context_data)
+
+
+def start_watchdog(app: Application) -> Optional[LoopWatchdog]:
+    """ Starts the watchdog on the running loop if enabled in the config. """
+    if not config.watchdog.enabled:
+        return None
+    watchdog = LoopWatchdog(
+        app,
+        threshold=config.watchdog.threshold,
+        check_interval=config.watchdog.check_interval,
+        alert_interval=config.watchdog.alert_interval,
+    )
+    watchdog.start()
+    return watchdog
@@ -0,0 +1,153 @@
+"""
+Group commits for the small writes of handlers (/start registrations, settings toggles).
+
+`run_write(op)` and `defer_write(op)` run `op(session)` and commit. With
+`DATABASE__WRITE_BEHIND=true` the ops are queued instead and committed together, in a
+thread and in one transaction: one commit (one fsync) for the whole batch.
+
+- `defer_write` (registrations) returns at once. Its op is committed with the next
+  batch, within `write_behind_interval` seconds or once `write_behind_max_batch` wait.
+- `run_write` (toggles, whose reply depends on the result) commits the queue right away
+  and returns its op's result. Updates are handled one at a time, so waiting for the
+  interval here would hold up every update behind it.
+
+If a batch fails, its ops are retried one commit each, so a bad op only fails itself.
+A deferred op that still fails is logged and passed to its `on_error` callback.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from config import config
+from models.database import SessionLocal
+from utils.logger import setup_logger
+from utils.metrics import WRITE_BATCH_SIZE
+
+logger = setup_logger(__name__, config.paths.log_path+"/utils.log")
+
+Op = Callable[[Session], Any]
+ErrorHandler = Callable[[Exception], Awaitable[None]]
+
+
+def _run_now(op: Op) -> Any:
+    with SessionLocal() as session:
+        result = op(session)
+        session.commit()
+        return result
+
+
+class WriteBehind:
+    def __init__(self, interval: float, max_batch: int):
+        self.interval = interval
+        self.max_batch = max_batch
+        # (op, future of run_write or None, on_error of defer_write or None)
+        self._pending: List[Tuple[Op, Optional[asyncio.Future], Optional[ErrorHandler]]] = []
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def _start(self) -> None:
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def defer(self, op: Op, on_error: Optional[ErrorHandler] = None) -> None:
+        """ Queues `op` for the next batch, `on_error` is awaited with the exception if it fails """
+        self._start()
+        self._pending.append((op, None, on_error))
+        if len(self._pending) >= self.max_batch:
+            self._wake.set()
+
+    async def submit(self, op: Op) -> Any:
+        """ Commits `op` with the queued ops now, returns its result """
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((op, future, None))
+        self._wake.set()
+        return await future
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+            if self._closing:
+                return
+
+    async def flush(self) -> None:
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        WRITE_BATCH_SIZE.observe(len(batch))
+        results = await asyncio.to_thread(self._commit, [op for op, _, _ in batch])
+        for (_, future, on_error), (ok, result) in zip(batch, results):
+            if future is None:
+                if not ok:
+                    logger.error(f"Deferred write failed: {result}")
+                    if on_error is not None:
+                        try:
+                            await on_error(result)
+                        except Exception as e:
+                            logger.exception(f"Error handler of a deferred write failed: {e}")
+                continue
+            if future.done():  # Caller cancelled
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    @staticmethod
+    def _commit(ops: List[Op]) -> List[Tuple[bool, Any]]:
+        try:
+            with SessionLocal() as session:
+                results = [op(session) for op in ops]
+                session.commit()
+            return [(True, result) for result in results]
+        except Exception as e:
+            logger.warning(f"Batch of {len(ops)} write(s) failed, retrying them one by one: {e}")
+        outcomes = []
+        for op in ops:
+            try:
+                outcomes.append((True, _run_now(op)))
+            except Exception as e:
+                outcomes.append((False, e))
+        return outcomes
+
+    async def close(self) -> None:
+        """ Stops the flusher and commits what is still queued """
+        if self._task is not None and not self._task.done():
+            self._closing = True
+            self._wake.set()
+            await self._task
+        self._task = None
+        self._closing = False
+        await self.flush()
+
+
+WRITES = WriteBehind(config.database.write_behind_interval, config.database.write_behind_max_batch)
+
+
+async def run_write(op: Op) -> Any:
+    """
+    Runs `op(session)` and commits, together with the queued writes if write-behind is
+    enabled. `op` must not commit itself (model methods take commit=False).
+    """
+    if config.database.write_behind:
+        return await WRITES.submit(op)
+    return _run_now(op)
+
+
+def defer_write(op: Op, on_error: Optional[ErrorHandler] = None) -> None:
+    """
+    Like `run_write` without the result: with write-behind, `op` waits for the next batch
+    and a failure is passed to `on_error`. Without it, `op` runs now and errors are raised.
+    """
+    if config.database.write_behind:
+        WRITES.defer(op, on_error)
+    else:
+        _run_now(op)
@@ -0,0 +1,163 @@
+"""
+Delivery worker: sends the messages queued in the delivery outbox.
+
+Run one process per shard next to the bot (with DELIVERY__USE_WORKERS=true):
+
+    python worker.py --shard 0 --shards 2
+    python worker.py --shard 1 --shards 2
+
+Each worker only claims the tasks of its own shard (recipients are split by chat id
+hash), so a chat is always served by the same worker and in order.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import socket
+from typing import Dict, List
+
+from telegram.constants import ParseMode
+from telegram.ext import Defaults, ExtBot
+
+from config import config
+from models.database import Base, db, SessionLocal, upgrade_schema
+from models.delivery import DeliveryTask, SentMessage
+from utils.delivery import deactivate_chats, deliver_payload, is_gone_error, is_permanent_error, ledger_entry
+from utils.media import MEDIA
+from utils.events import EVENTS, DELIVERY_FAILED
+from utils.logger import setup_logger
+from utils.metrics import monitor_loop_lag, start_metrics_server
+from utils.rate_limiter import build_rate_limiter, LANE_NEWS
+
+logger = setup_logger(__name__, config.paths.log_path+"/worker.log")
+
+
+async def _deliver(bot: ExtBot, task: DeliveryTask) -> tuple:
+    """ (task, error or None, ledger entry or None) """
+    try:
+        payload = task.data
+        message = await deliver_payload(bot, task.chat_id, payload,
+                                        rate_limit_args={"lane": payload.get("lane", LANE_NEWS)})
+        return task, None, ledger_entry(task.chat_id, payload, message)
+    except Exception as e:
+        return task, e, None
+
+
+def _gives_up(task: DeliveryTask, exc: Exception) -> bool:
+    return is_permanent_error(exc) or task.attempts >= config.delivery.max_attempts
+
+
+async def _deliver_chat(bot: ExtBot, tasks: List[DeliveryTask]) -> tuple:
+    """
+    Sends the tasks of one chat one after the other, in outbox order. After a failure that
+    will be retried, the chat's next tasks are held back so they can't overtake it.
+    Returns (results, held tasks).
+    """
+    results = []
+    for index, task in enumerate(tasks):
+        result = await _deliver(bot, task)
+        results.append(result)
+        if result[1] is not None and not _gives_up(task, result[1]):
+            return results, tasks[index + 1:]
+    return results, []
+
+
+async def process_batch(bot: ExtBot, shard: int, worker_id: str) -> int:
+    """ Claims and sends one batch. Returns the number of claimed tasks. """
+    with SessionLocal() as session:
+        tasks = DeliveryTask.claim_batch(
+            session, shard, worker_id,
+            limit=config.delivery.batch_size,
+            lease_secs=config.delivery.lease_secs)
+    if not tasks:
+        return 0
+
+    # In order within a chat, chats in parallel: the rate limiter spreads them out
+    by_chat: Dict[int, List[DeliveryTask]] = {}
+    for task in tasks:
+        by_chat.setdefault(task.chat_id, []).append(task)
+    outcomes = await asyncio.gather(*(_deliver_chat(bot, chat_tasks) for chat_tasks in by_chat.values()))
+    results = [result for chat_results, _ in outcomes for result in chat_results]
+    held = [task for _, chat_held in outcomes for task in chat_held]
+
+    sent = [task.id for task, exc, _ in results if exc is None]
+    with SessionLocal() as session:
+        DeliveryTask.mark_sent(session, sent)
+        SentMessage.record(session, [entry for _, _, entry in results if entry])
+        deactivate_chats(session, [task.chat_id for task, exc, _ in results if exc is not None and is_gone_error(exc)])
+        for task, exc, _ in results:
+            if exc is None:
+                continue
+            if _gives_up(task, exc):
+                logger.warning(f"Giving up on task {task.id} for chat {task.chat_id}: {exc}")
+                DeliveryTask.mark_failed(session, task.id, str(exc))
+                # Only the last attempt counts as a failed delivery
+                EVENTS.record(task.chat_id, DELIVERY_FAILED)
+            else:
+                logger.warning(f"Task {task.id} for chat {task.chat_id} failed, retrying: {exc}")
+                retry_in = config.delivery.retry_delay_secs * task.attempts
+                DeliveryTask.mark_failed(session, task.id, str(exc), retry_in=retry_in)
+                # Due with the failed task, claimed after it (by id)
+                DeliveryTask.release(session, [later.id for later in held if later.chat_id == task.chat_id], retry_in)
+    logger.info(f"Shard {shard}: {len(sent)}/{len(tasks)} message(s) delivered.")
+    return len(tasks)
+
+
+async def run_worker(shard: int, shards: int) -> None:
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{shard}"
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    bot = ExtBot(
+        config.bot.token,
+        base_url=config.bot.base_url,
+        defaults=Defaults(parse_mode=ParseMode.HTML),
+        rate_limiter=build_rate_limiter(share=shards + 1),
+    )
+    logger.info(f"Delivery worker {worker_id} started for shard {shard}/{shards}.")
+    metrics_server = await start_metrics_server(config.metrics.port + 1 + shard)
+    lag_monitor = asyncio.create_task(monitor_loop_lag(config.metrics.loop_lag_interval))
+    async with bot:
+        while not stop.is_set():
+            try:
+                claimed = await process_batch(bot, shard, worker_id)
+            except Exception as e:
+                logger.exception(f"Error in delivery worker loop: {e}")
+                claimed = 0
+            if not claimed:
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=config.delivery.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+    lag_monitor.cancel()
+    await MEDIA.close()
+    await EVENTS.close()
+    if metrics_server:
+        metrics_server.close()
+    logger.info(f"Delivery worker {worker_id} stopped.")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Anime news bot delivery worker")
+    parser.add_argument("--shard", type=int, default=0, help="Shard served by this worker (0-based)")
+    parser.add_argument("--shards", type=int, default=config.delivery.shards, help="Total number of shards")
+    args = parser.parse_args()
+    if not 0 <= args.shard < args.shards:
+        parser.error("--shard must be between 0 and --shards - 1")
+    if args.shards != config.delivery.shards:
+        logger.warning(f"--shards={args.shards} differs from DELIVERY__SHARDS={config.delivery.shards}, "
+                       "tasks are sharded with the bot's setting.")
+
+    config.initialize()
+    Base.metadata.create_all(db)
+    upgrade_schema(db)
+    asyncio.run(run_worker(args.shard, args.shards))
+
+
+if __name__ == "__main__":
+    main()